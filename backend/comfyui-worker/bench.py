@@ -0,0 +1,418 @@
+"""
+Worker micro-benchmarks.
+
+Usage:
+    python bench.py builders [--iterations 20000]
+    python bench.py microbatch [--jobs 16] [--concurrency 4] [--spread 1.0] [--windows 0,100,250]
+    python bench.py delivery [--jobs 4] [--images 1] [--output-mb 8] [--modes json,multipart,raw,url]
+    python bench.py pipeline [--jobs 8] [--upload-ms 150] [--image-kb 512]
+    python bench.py normalize [--jobs 4] [--size 4032x3024] [--upload-mbps 100] [--formats png,jpeg,webp]
+    python bench.py offload [--jobs 4] [--image-mb 12] [--executors inline,thread,process]
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import uvicorn
+from PIL import Image
+
+import fake_comfyui
+import worker
+
+FAKE_PORT = 18299
+
+
+async def start_fake_comfyui(args):
+    """Serve fake_comfyui in this event loop and point the worker at it"""
+    fake_comfyui.app.state.sample_seconds = args.sample_seconds
+    fake_comfyui.app.state.prompt_overhead = args.prompt_overhead
+    fake_comfyui.app.state.steps = 2
+    server = uvicorn.Server(uvicorn.Config(fake_comfyui.app, host='127.0.0.1', port=FAKE_PORT,
+                                           log_level='warning'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    url = f'http://127.0.0.1:{FAKE_PORT}'
+    worker.comfy = worker.ComfyUIClient(url, worker.CLIENT_ID, on_call=worker.observe_comfyui_call)
+    worker.RESULT_CACHE_ENABLED = False
+    return server, task
+
+
+async def stop_fake_comfyui(server, task):
+    server.should_exit = True
+    await task
+
+
+def sample_params(workflow_type, i):
+    return dict(
+        image1='input_0123456789abcdef.png',
+        image2='input_fedcba9876543210.png' if workflow_type in ('apply_pattern', 'merge_images', 'draping_sim') else None,
+        prompt='turn this floral print into an indigo block print on linen',
+        negative_prompt='ugly, blurry, bad quality, distorted',
+        seed=1000 + i, steps=25, guidance=2.5, structure_strength=0.5,
+        width=1344, height=768, job_id=f'job{i:08d}',
+    )
+
+
+def bench_builders(args):
+    """Per-request graph cost: builder dict + json.dumps vs compiled template render"""
+    print(f"{'workflow':<20} {'builder µs':>12} {'template µs':>12} {'speedup':>8}")
+    for name, builder in worker.WORKFLOW_BUILDERS.items():
+        params = [sample_params(name, i) for i in range(args.iterations)]
+
+        start = time.perf_counter()
+        for p in params:
+            guidance, steps, denoise = worker.tune_params(name, p['guidance'], p['steps'], p['structure_strength'])
+            json.dumps(builder(p['image1'], p['image2'], p['prompt'], p['negative_prompt'], p['seed'],
+                               steps, guidance, denoise, p['width'], p['height'], p['job_id']))
+        before = (time.perf_counter() - start) / args.iterations * 1e6
+
+        start = time.perf_counter()
+        for p in params:
+            worker.render_workflow(name, **p)
+        after = (time.perf_counter() - start) / args.iterations * 1e6
+
+        print(f"{name:<20} {before:>12.1f} {after:>12.1f} {before / after:>7.1f}x")
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def microbatch_round(client, args, window_ms):
+    """Post `jobs` requests to /generate/async at random offsets; latency runs until each job's callback"""
+    worker.batcher = worker.MicroBatcher(window_ms, args.max_batch, args.concurrency)
+    rng = random.Random(7)
+    arrivals = sorted(rng.uniform(0, args.spread) for _ in range(args.jobs))
+    latencies = []
+    finished = {}
+
+    async def send_callback(webhook_url, job_id, *_, **__):
+        finished[job_id].set()
+    worker.send_callback = send_callback
+
+    async def one(i, offset):
+        job_id = f'bench{i:04d}'
+        finished[job_id] = asyncio.Event()
+        await asyncio.sleep(offset)
+        arrived = time.perf_counter()
+        resp = await client.post('/generate/async', json={
+            'job_id': job_id, 'image_base64': worker.base64.b64encode(f'img{i}'.encode()).decode(),
+            'prompt': f'variation {i}', 'seed': i + 1, 'workflow_type': 'color_swap',
+            'webhook_url': 'http://bench.invalid/webhook'})
+        resp.raise_for_status()
+        await finished[job_id].wait()
+        latencies.append(time.perf_counter() - arrived)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i, offset) for i, offset in enumerate(arrivals)))
+    total = time.perf_counter() - start
+    print(f"{window_ms:>9.0f} {statistics.mean(latencies):>9.2f} {percentile(latencies, 0.95):>9.2f} "
+          f"{total:>8.2f} {args.jobs / total:>9.2f} {worker.batcher.stats()['avg_batch_size']:>6.2f}")
+
+
+async def bench_microbatch_async(args):
+    server, task = await start_fake_comfyui(args)
+    worker.jobs = worker.JobQueue(args.jobs, args.concurrency)
+    transport = worker.httpx.ASGITransport(app=worker.app)
+    send_callback = worker.send_callback
+    try:
+        async with worker.lifespan(worker.app), \
+                worker.httpx.AsyncClient(transport=transport, base_url='http://worker') as client:
+            await asyncio.sleep(0.2)  # let the event stream connect
+            print(f"{args.jobs} jobs over {args.spread}s via /generate/async, JOB_CONCURRENCY {args.concurrency}, "
+                  f"prompt overhead {args.prompt_overhead}s, {args.sample_seconds}s/image, "
+                  f"max batch {min(args.max_batch, args.concurrency)}")
+            print(f"{'window ms':>9} {'mean s':>9} {'p95 s':>9} {'total s':>8} {'jobs/s':>9} {'batch':>6}")
+            for window_ms in (float(w) for w in args.windows.split(',')):
+                await microbatch_round(client, args, window_ms)
+    finally:
+        worker.send_callback = send_callback
+        await stop_fake_comfyui(server, task)
+
+
+def bench_microbatch(args):
+    """Latency/throughput of cross-job micro-batching against the fake ComfyUI"""
+    asyncio.run(bench_microbatch_async(args))
+
+
+async def delivery_round(webhook_url, args):
+    """Send `jobs` callbacks at once, return each callback's seconds"""
+    deliver = worker.DELIVERY_MODES[worker.DELIVERY_MODE]
+
+    async def one(i):
+        start = time.perf_counter()
+        payload = {'success': True, 'job_id': f'bench{i:04d}', 'is_upscale': False, 'execution_time': 1.0}
+        names = [f'out_{i}_{n}.png' for n in range(args.images)]
+        await deliver(webhook_url, payload, [(name, worker.stream_output(name)) for name in names])
+        return time.perf_counter() - start
+    return await asyncio.gather(*(one(i) for i in range(args.jobs)))
+
+
+async def bench_delivery_async(args):
+    url = f'http://127.0.0.1:{FAKE_PORT}'
+    # Separate process, so tracemalloc only sees the worker side of the transfer
+    fake = subprocess.Popen([sys.executable, 'fake_comfyui.py', '--port', str(FAKE_PORT),
+                             '--output-bytes', str(int(args.output_mb * 1024 ** 2))])
+    try:
+        async with worker.httpx.AsyncClient() as client:
+            while True:
+                try:
+                    await client.get(f'{url}/system_stats')
+                    break
+                except worker.httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            worker.comfy = worker.ComfyUIClient(url, worker.CLIENT_ID, on_call=worker.observe_comfyui_call)
+            worker.object_store = worker.LocalObjectStore(tempfile.mkdtemp(), f'{url}/results', 3600)
+            print(f"{args.jobs} concurrent callbacks x {args.images} image(s) of {args.output_mb} MB")
+            print(f"{'mode':<10} {'mean s':>8} {'max s':>8} {'MB/s':>8} {'peak MB':>9} {'received MB':>12}")
+            for mode in args.modes.split(','):
+                worker.DELIVERY_MODE = mode
+                await delivery_round(f'{url}/webhook', args)  # warm the pools
+                times = await delivery_round(f'{url}/webhook', args)
+
+                tracemalloc.start()
+                await delivery_round(f'{url}/webhook', args)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                received = (await client.get(f'{url}/webhooks')).json()[-1]['bytes']
+                total_mb = args.jobs * args.images * args.output_mb
+                print(f"{mode:<10} {statistics.mean(times):>8.3f} {max(times):>8.3f} "
+                      f"{total_mb / max(times):>8.1f} {peak / 1024 ** 2:>9.1f} {received / 1024 ** 2:>12.1f}")
+    finally:
+        await worker.comfy.aclose()
+        for pool in list(worker.POOLS.values()):
+            await pool.aclose()
+        worker.POOLS.clear()
+        fake.terminate()
+        fake.wait()
+
+
+def bench_delivery(args):
+    """Callback time and worker peak memory per DELIVERY_MODE against the fake webhook sink"""
+    asyncio.run(bench_delivery_async(args))
+
+
+TWO_IMAGE_WORKFLOWS = ('apply_pattern', 'merge_images', 'draping_sim')
+
+
+def histogram_totals(histogram):
+    """(sum, count) over every label set"""
+    series = histogram.series.values()
+    return sum(s[-2] for s in series), sum(s[-1] for s in series)
+
+
+async def pipeline_round(workflow_type, args, rng):
+    """Run `jobs` two-image jobs one at a time, return mean time to prompt_id in ms"""
+    before = histogram_totals(worker.TIME_TO_PROMPT)
+    for i in range(args.jobs):
+        # Fresh bytes every job so the upload cache never short-circuits an upload
+        images = [worker.base64.b64encode(rng.randbytes(args.image_kb * 1024)).decode() for _ in range(2)]
+        r = worker.GenerateReq(job_id=f'bench{i:04d}', image_base64=images[0], image2_base64=images[1],
+                               prompt=f'pipeline {i}', seed=i + 1, workflow_type=workflow_type)
+        await worker.process_generate(r)
+    after = histogram_totals(worker.TIME_TO_PROMPT)
+    return (after[0] - before[0]) / (after[1] - before[1]) * 1000
+
+
+async def bench_pipeline_async(args):
+    server, task = await start_fake_comfyui(args)
+    fake_comfyui.app.state.upload_seconds = args.upload_ms / 1000
+    worker.batcher = worker.MicroBatcher(0, 1, 1)
+    rng = random.Random(7)
+    try:
+        async with worker.lifespan(worker.app):
+            print(f"{args.jobs} jobs per workflow, 2 x {args.image_kb} KB inputs, {args.upload_ms:.0f} ms per upload")
+            print(f"{'workflow':<16} {'serial ms':>10} {'pipelined ms':>13} {'speedup':>8}")
+            for workflow_type in TWO_IMAGE_WORKFLOWS:
+                results = []
+                for pipelined in (False, True):
+                    worker.PIPELINE_UPLOADS = pipelined
+                    results.append(await pipeline_round(workflow_type, args, rng))
+                print(f"{workflow_type:<16} {results[0]:>10.1f} {results[1]:>13.1f} {results[0] / results[1]:>7.2f}x")
+    finally:
+        await stop_fake_comfyui(server, task)
+
+
+def bench_pipeline(args):
+    """Time to prompt_id for two-image workflows, uploads one after another vs pipelined"""
+    asyncio.run(bench_pipeline_async(args))
+
+
+def sample_photo(width, height, seed):
+    """A phone-photo-like PNG: smooth gradients plus sensor noise, rotated by EXIF"""
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 12 + seed)
+    img = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotate 90° on display, as portrait phone shots are stored
+    out = io.BytesIO()
+    img.save(out, format='PNG', exif=exif)
+    return out.getvalue()
+
+
+async def normalize_round(photos):
+    """Upload every photo (fresh hashes, no cache hits), return (bytes sent, mean upload ms, mean total ms)"""
+    sent = 0
+    upload_ms, total_ms = [], []
+    for data in photos:
+        digest = worker.content_hash(data, worker.normalizer.key)
+        started = time.perf_counter()
+        img = await worker.normalizer.run(data)
+        uploading = time.perf_counter()
+        await worker.comfy.upload_image(img, worker.input_name(digest), worker.normalizer.content_type)
+        sent += len(img)
+        upload_ms.append((time.perf_counter() - uploading) * 1000)
+        total_ms.append((time.perf_counter() - started) * 1000)
+    return sent, statistics.mean(upload_ms), statistics.mean(total_ms)
+
+
+async def bench_normalize_async(args):
+    width, height = (int(v) for v in args.size.split('x'))
+    photos = [sample_photo(width, height, i) for i in range(args.jobs)]
+    server, task = await start_fake_comfyui(args)
+    fake_comfyui.app.state.upload_mbps = args.upload_mbps
+    try:
+        worker.cpu = worker.CPUExecutor(args.executor, worker.CPU_WORKERS, worker.CPU_OFFLOAD_MIN_BYTES)
+        print(f"{args.jobs} x {width}x{height} PNG ({statistics.mean(map(len, photos)) / 1e6:.1f} MB), "
+              f"{args.upload_mbps:.0f} Mbit/s to ComfyUI, {args.executor} pool")
+        print(f"{'mode':<10} {'MB sent':>8} {'upload ms':>10} {'total ms':>9}")
+        for fmt in ['off'] + args.formats.split(','):
+            worker.normalizer = worker.InputNormalizer(fmt != 'off', fmt if fmt != 'off' else 'png', args.quality)
+            sent, upload_ms, total_ms = await normalize_round(photos)
+            print(f"{fmt:<10} {sent / 1e6:>8.1f} {upload_ms:>10.0f} {total_ms:>9.0f}")
+    finally:
+        worker.cpu.stop()
+        await worker.comfy.aclose()
+        await stop_fake_comfyui(server, task)
+
+
+def bench_normalize(args):
+    """Bytes and time to get large photos into ComfyUI, as sent vs normalized per format"""
+    asyncio.run(bench_normalize_async(args))
+
+
+async def offload_round(webhook_url, images_b64):
+    """Decode every input and deliver a json callback per job, all at once"""
+    async def one(i, img_b64):
+        await worker.decode_image(img_b64)
+        payload = {'success': True, 'job_id': f'bench{i:04d}', 'is_upscale': False, 'execution_time': 1.0}
+        name = f'out_{i}.png'
+        await worker.deliver_json(webhook_url, payload, [(name, worker.stream_output(name))])
+    await asyncio.gather(*(one(i, img_b64) for i, img_b64 in enumerate(images_b64)))
+
+
+async def bench_offload_async(args):
+    url = f'http://127.0.0.1:{FAKE_PORT}'
+    size = int(args.image_mb * 1024 ** 2)
+    # Separate process, so only the worker's own work shows up as event-loop lag
+    fake = subprocess.Popen([sys.executable, 'fake_comfyui.py', '--port', str(FAKE_PORT), '--output-bytes', str(size)])
+    images_b64 = [worker.base64.b64encode(random.Random(i).randbytes(size)).decode() for i in range(args.jobs)]
+    try:
+        async with worker.httpx.AsyncClient() as client:
+            while True:
+                try:
+                    await client.get(f'{url}/system_stats')
+                    break
+                except worker.httpx.TransportError:
+                    await asyncio.sleep(0.1)
+        worker.comfy = worker.ComfyUIClient(url, worker.CLIENT_ID, on_call=worker.observe_comfyui_call)
+        print(f"{args.jobs} concurrent jobs: decode {args.image_mb} MB input + json callback with a "
+              f"{args.image_mb} MB output, lag sampled every {args.interval_ms:.0f} ms")
+        print(f"{'executor':<10} {'total s':>8} {'max lag ms':>11} {'stalls':>7} {'stalled ms':>11}")
+        for kind in args.executors.split(','):
+            # 'inline' never offloads: the pre-executor behaviour
+            min_bytes = float('inf') if kind == 'inline' else worker.CPU_OFFLOAD_MIN_BYTES
+            worker.cpu = worker.CPUExecutor('thread' if kind == 'inline' else kind, args.workers, min_bytes)
+            worker.cpu.start()
+            await offload_round(f'{url}/webhook', images_b64[:1])  # warm the pools
+            monitor = worker.LoopLagMonitor(args.interval_ms, args.threshold_ms)
+            monitor.start()
+            start = time.perf_counter()
+            await offload_round(f'{url}/webhook', images_b64)
+            total = time.perf_counter() - start
+            await monitor.stop()
+            worker.cpu.stop()
+            stats = monitor.stats()
+            print(f"{kind:<10} {total:>8.2f} {stats['max_lag_ms']:>11.1f} {stats['stalls']:>7} {stats['stalled_ms']:>11.1f}")
+    finally:
+        await worker.comfy.aclose()
+        for pool in list(worker.POOLS.values()):
+            await pool.aclose()
+        worker.POOLS.clear()
+        fake.terminate()
+        fake.wait()
+
+
+def bench_offload(args):
+    """Event-loop lag while jobs decode inputs and encode json callbacks, inline vs in the CPU executor"""
+    asyncio.run(bench_offload_async(args))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('builders', help=bench_builders.__doc__)
+    p.add_argument('--iterations', type=int, default=20000)
+    p.set_defaults(func=bench_builders)
+
+    p = sub.add_parser('microbatch', help=bench_microbatch.__doc__)
+    p.add_argument('--jobs', type=int, default=16)
+    p.add_argument('--spread', type=float, default=1.0, help='arrival window in seconds')
+    p.add_argument('--windows', default='0,100,250', help='batching windows to compare (ms)')
+    p.add_argument('--max-batch', type=int, default=4)
+    p.add_argument('--concurrency', type=int, default=worker.JOB_CONCURRENCY, help='JOB_CONCURRENCY')
+    p.add_argument('--prompt-overhead', type=float, default=0.0,
+                   help='fake per-prompt cost in seconds; 0 models a warm ComfyUI where sampling dominates')
+    p.add_argument('--sample-seconds', type=float, default=0.2)
+    p.set_defaults(func=bench_microbatch)
+
+    p = sub.add_parser('delivery', help=bench_delivery.__doc__)
+    p.add_argument('--jobs', type=int, default=4, help='concurrent callbacks')
+    p.add_argument('--images', type=int, default=1, help='output images per callback')
+    p.add_argument('--output-mb', type=float, default=8)
+    p.add_argument('--modes', default=','.join(worker.DELIVERY_MODES))
+    p.set_defaults(func=bench_delivery)
+
+    p = sub.add_parser('pipeline', help=bench_pipeline.__doc__)
+    p.add_argument('--jobs', type=int, default=8, help='jobs per workflow and mode')
+    p.add_argument('--upload-ms', type=float, default=150, help='fake ComfyUI latency per upload')
+    p.add_argument('--image-kb', type=int, default=512)
+    p.add_argument('--prompt-overhead', type=float, default=0.05)
+    p.add_argument('--sample-seconds', type=float, default=0.05)
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser('normalize', help=bench_normalize.__doc__)
+    p.add_argument('--jobs', type=int, default=4)
+    p.add_argument('--size', default='4032x3024', help='input photo WIDTHxHEIGHT')
+    p.add_argument('--upload-mbps', type=float, default=100, help='simulated bandwidth to ComfyUI')
+    p.add_argument('--formats', default=','.join(worker.NORMALIZE_CODECS))
+    p.add_argument('--quality', type=int, default=95)
+    p.add_argument('--executor', default='thread', choices=('thread', 'process'))
+    p.add_argument('--prompt-overhead', type=float, default=0.05)
+    p.add_argument('--sample-seconds', type=float, default=0.05)
+    p.set_defaults(func=bench_normalize)
+
+    p = sub.add_parser('offload', help=bench_offload.__doc__)
+    p.add_argument('--jobs', type=int, default=4)
+    p.add_argument('--image-mb', type=float, default=12)
+    p.add_argument('--executors', default='inline,thread,process')
+    p.add_argument('--workers', type=int, default=worker.CPU_WORKERS)
+    p.add_argument('--interval-ms', type=float, default=10)
+    p.add_argument('--threshold-ms', type=float, default=20)
+    p.set_defaults(func=bench_offload)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,85 +1,726 @@
 """
 ComfyUI API Client
 Handles communication with the ComfyUI server to execute workflows
+
+ComfyUIClient owns everything that talks to one ComfyUI server: a pooled
+HTTP connection, the /ws event stream that resolves prompts as soon as their
+outputs are saved (with /history polling while the socket is down), and
+per-call latency counters. worker.py and execute_workflow share it.
 """
 
 import json
 import httpx
 import asyncio
+import os
+import time
 import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Optional
-import base64
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 
+try:
+    import websockets
+except ImportError:  # completion falls back to /history polling
+    websockets = None
 
-COMFYUI_URL = "http://localhost:8188"
 
+COMFYUI_URL = os.getenv("COMFYUI_URL", "http://localhost:18188")
+
+# {node_id: [output filenames]} for one prompt
+Outputs = Dict[str, List[str]]
+
+
+class ComfyUIError(Exception):
+    """ComfyUI rejected a prompt or reported an execution error"""
 
-async def get_system_stats() -> dict:
-    """Check if ComfyUI is running and get system stats"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{COMFYUI_URL}/system_stats")
-        return response.json()
 
+@dataclass
+class Timeouts:
+    """Per-call timeouts in seconds"""
+    default: float = 30.0
+    prompt: float = 300.0   # /prompt validates the whole graph
+    history: float = 5.0
+    probe: float = 2.0      # /system_stats and HEAD /view liveness checks
 
-async def upload_image(image_data: bytes, filename: str) -> str:
-    """Upload an image to ComfyUI and return the filename"""
-    async with httpx.AsyncClient() as client:
-        files = {
-            "image": (filename, image_data, "image/png"),
-            "overwrite": (None, "true"),
+
+@dataclass
+class CallStats:
+    count: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.total_seconds / self.count * 1000, 1) if self.count else 0.0,
+            "max_ms": round(self.max_seconds * 1000, 1),
         }
-        response = await client.post(
-            f"{COMFYUI_URL}/upload/image",
-            files=files
-        )
-        result = response.json()
-        return result.get("name", filename)
-
-
-async def queue_prompt(workflow: dict, client_id: str) -> str:
-    """Queue a workflow for execution and return the prompt_id"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{COMFYUI_URL}/prompt",
-            json={
-                "prompt": workflow,
-                "client_id": client_id
-            }
-        )
-        result = response.json()
-        return result.get("prompt_id")
 
 
-async def get_history(prompt_id: str) -> Optional[dict]:
-    """Get the execution history for a prompt"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{COMFYUI_URL}/history/{prompt_id}")
-        history = response.json()
-        return history.get(prompt_id)
+@dataclass
+class WorkflowResult:
+    success: bool
+    execution_time: float
+    image_data: Optional[bytes] = None
+    filename: Optional[str] = None
+    prompt_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+# =============================================================================
+# CONNECTION POOL
+# =============================================================================
+
+class TrackedStream(httpx.AsyncByteStream):
+    """Response body that calls `release` once it is closed (the connection is free again)"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self.stream = stream
+        self.release = release
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.release()
+            self.release = lambda: None
+
+
+class PoolTransport(httpx.AsyncHTTPTransport):
+    """httpx transport that counts requests, and those which had to wait for a free connection.
+
+    A request holds a connection from send until its response body is closed; one
+    arriving while `max_connections` are held waits in the pool.
+    """
+
+    def __init__(self, max_connections: int, **kwargs):
+        super().__init__(**kwargs)
+        self.max_connections = max_connections
+        self.requests = 0
+        self.waits = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+
+    def release(self):
+        self.in_use -= 1
+
+    def connections(self) -> Tuple[int, int]:
+        """(open, idle) connections in the underlying httpcore pool"""
+        connections = self._pool.connections
+        return len(connections), sum(1 for conn in connections if conn.is_idle())
+
+    async def handle_async_request(self, request):
+        self.requests += 1
+        if self.in_use >= self.max_connections:
+            self.waits += 1
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self.release()
+            raise
+        response.stream = TrackedStream(response.stream, self.release)
+        return response
+
+
+class HTTPPool:
+    """A long-lived AsyncClient plus the transport that tracks its usage"""
+
+    def __init__(self, name: str, max_connections: int, timeout: float = 30.0, keepalive: float = 30.0):
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_connections,
+                              keepalive_expiry=keepalive)
+        self.name = name
+        self.transport = PoolTransport(max_connections, limits=limits)
+        self.client = httpx.AsyncClient(transport=self.transport, timeout=timeout)
+
+    def stats(self) -> dict:
+        open_connections, idle = self.transport.connections()
+        return {
+            "max_connections": self.transport.max_connections,
+            "open": open_connections,
+            "idle": idle,
+            "in_use": self.transport.in_use,
+            "peak_in_use": self.transport.peak_in_use,
+            "requests": self.transport.requests,
+            "waits": self.transport.waits,
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# =============================================================================
+# EVENT STREAM (one /ws listener per client)
+# =============================================================================
+
+class PromptTracker:
+    """Completion state for one prompt, fed by websocket events.
 
+    Resolves to {node_id: [filenames]} once `expected` output nodes have
+    reported images, or when the prompt ends.
+    """
+
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        self.outputs = {}
+        self.expected = 1
+        self.ended = False
+        self.progress = (0, 0)
+        self.node = None
+
+    def expect(self, count: int):
+        """Wait for `count` output nodes (merged micro-batch prompts have several)"""
+        self.expected = count
+        if (self.future.done() and not self.ended and self.future.exception() is None
+                and len(self.outputs) < count):
+            self.future = asyncio.get_running_loop().create_future()
+
+    def finish(self, error: Optional[str] = None):
+        if self.future.done():
+            return
+        if error:
+            self.future.set_exception(ComfyUIError(error))
+        else:
+            self.future.set_result(dict(self.outputs))
+
+
+class ComfyEventListener:
+    """Long-lived ComfyUI /ws?clientId=... connection that resolves per-prompt futures.
+
+    Prompts must be queued with the same client_id so ComfyUI routes their
+    events to this socket. While the socket is down `disconnected` is set and
+    waiters fall back to /history polling.
+    """
+
+    MAX_TRACKED = 256
 
-async def get_image(filename: str, subfolder: str = "", folder_type: str = "output") -> bytes:
-    """Download a generated image from ComfyUI"""
-    async with httpx.AsyncClient() as client:
-        params = {
-            "filename": filename,
-            "subfolder": subfolder,
-            "type": folder_type
+    def __init__(self, base_url: str, client_id: str):
+        self.url = base_url.replace("http://", "ws://").replace("https://", "wss://") + f"/ws?clientId={client_id}"
+        self.trackers = {}
+        self.connected = False
+        self.disconnected = asyncio.Event()
+        self.disconnected.set()
+        self.reconnects = 0
+        self.messages = 0
+
+    def track(self, prompt_id: str) -> PromptTracker:
+        tracker = self.trackers.get(prompt_id)
+        if tracker is None:
+            tracker = self.trackers[prompt_id] = PromptTracker()
+            while len(self.trackers) > self.MAX_TRACKED:
+                self.trackers.pop(next(iter(self.trackers)))
+        return tracker
+
+    def release(self, prompt_id: str):
+        self.trackers.pop(prompt_id, None)
+
+    def handle(self, message: dict):
+        """Route one decoded ComfyUI event to its prompt tracker"""
+        kind = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+        self.messages += 1
+        tracker = self.track(prompt_id)
+
+        if kind == "progress":
+            tracker.progress = (data.get("value", 0), data.get("max", 0))
+        elif kind == "executing":
+            tracker.node = data.get("node")
+            if tracker.node is None:
+                # node=None marks the end of the prompt. Cached nodes send no
+                # `executed`, so missing outputs are looked up in /history
+                tracker.ended = True
+                tracker.finish()
+        elif kind == "executed":
+            images = (data.get("output") or {}).get("images") or []
+            if images:
+                tracker.outputs[data.get("node")] = [img["filename"] for img in images]
+                if len(tracker.outputs) >= tracker.expected:
+                    tracker.finish()
+        elif kind == "execution_error":
+            tracker.finish(error=data.get("exception_message") or "ComfyUI execution error")
+
+    async def run(self):
+        backoff = 1.0
+        while True:
+            try:
+                async with websockets.connect(self.url, max_size=None) as ws:
+                    self.connected = True
+                    self.disconnected.clear()
+                    backoff = 1.0
+                    print("🔗 ComfyUI event stream connected")
+                    async for raw in ws:
+                        if isinstance(raw, bytes):
+                            continue  # binary preview frames
+                        try:
+                            self.handle(json.loads(raw))
+                        except ValueError:
+                            continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ ComfyUI event stream error: {e}")
+            finally:
+                self.connected = False
+                self.disconnected.set()
+            self.reconnects += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            "messages": self.messages,
+            "tracked_prompts": len(self.trackers),
         }
-        response = await client.get(f"{COMFYUI_URL}/view", params=params)
+
+
+# =============================================================================
+# CLIENT
+# =============================================================================
+
+def header_quote(value: str) -> str:
+    """Escape a multipart header value the way browsers do (quote, CR, LF percent-encoded)"""
+    return value.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+async def multipart_body(boundary: str, filename: str, content_type: str, chunks: AsyncIterator[bytes]):
+    """Encode a ComfyUI /upload/image form around an async byte stream"""
+    filename, content_type = header_quote(filename), header_quote(content_type)
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="overwrite"\r\n\r\ntrue\r\n'
+           f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+           f"Content-Type: {content_type}\r\n\r\n").encode()
+    async for chunk in chunks:
+        yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+class ComfyUIClient:
+    """
+    One ComfyUI server: pooled HTTP, websocket completion events, call latency.
+
+    The HTTP pool is opened on first use and the event stream by start();
+    aclose() shuts both down (the client can be started again afterwards).
+    Every call is timed into `calls` and passed to `on_call(name, seconds)`
+    when given, so callers can feed their own metrics.
+    """
+
+    def __init__(self, base_url: str = COMFYUI_URL, client_id: Optional[str] = None,
+                 max_connections: int = 20, keepalive: float = 30.0,
+                 timeouts: Optional[Timeouts] = None, ws_enabled: bool = True,
+                 poll_interval: float = 2.0, on_call: Optional[Callable[[str, float], None]] = None):
+        self.base_url = base_url.rstrip("/")
+        self.client_id = client_id or uuid.uuid4().hex
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        self.timeouts = timeouts or Timeouts()
+        self.ws_enabled = ws_enabled and websockets is not None
+        self.poll_interval = poll_interval
+        self.on_call = on_call
+        self.events = ComfyEventListener(self.base_url, self.client_id)
+        self.calls: Dict[str, CallStats] = {}
+        self.pool: Optional[HTTPPool] = None
+        self.listener: Optional[asyncio.Task] = None
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self.pool is None:
+            self.pool = HTTPPool("comfyui", self.max_connections, self.timeouts.default, self.keepalive)
+        return self.pool.client
+
+    def start(self):
+        """Open the pool and, if enabled, the /ws event stream"""
+        self.http  # creates the pool
+        if self.ws_enabled and self.listener is None:
+            self.listener = asyncio.create_task(self.events.run())
+
+    async def aclose(self):
+        if self.listener:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+        if self.pool:
+            await self.pool.aclose()
+            self.pool = None
+
+    @contextmanager
+    def timed(self, name: str):
+        """Record the enclosed call's latency under `name`"""
+        stats = self.calls.setdefault(name, CallStats())
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.count += 1
+            stats.total_seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            if self.on_call:
+                self.on_call(name, elapsed)
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    # ---- server ------------------------------------------------------------
+
+    async def system_stats(self) -> dict:
+        """Check if ComfyUI is running and get system stats"""
+        with self.timed("system_stats"):
+            response = await self.http.get(self.url("/system_stats"), timeout=self.timeouts.probe)
+        response.raise_for_status()
+        return response.json()
+
+    async def is_up(self) -> bool:
+        """True if the event stream is connected or /system_stats answers"""
+        if self.events.connected:
+            return True
+        try:
+            await self.system_stats()
+            return True
+        except httpx.HTTPError:
+            return False
+
+    # ---- inputs ------------------------------------------------------------
+
+    async def upload_image(self, image_data: bytes, filename: str, content_type: str = "image/png") -> str:
+        """Upload an image to ComfyUI and return the name it was stored under"""
+        with self.timed("upload"):
+            response = await self.http.post(self.url("/upload/image"),
+                files={"image": (filename, image_data, content_type)},
+                data={"overwrite": "true"})
+        response.raise_for_status()
+        return response.json().get("name", filename)
+
+    async def upload_stream(self, chunks: AsyncIterator[bytes], filename: str,
+                            content_type: str = "image/png") -> str:
+        """Upload an image from an async chunk iterator without buffering it"""
+        boundary = uuid.uuid4().hex
+        with self.timed("upload"):
+            response = await self.http.post(self.url("/upload/image"),
+                content=multipart_body(boundary, filename, content_type, chunks),
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        response.raise_for_status()
+        return response.json().get("name", filename)
+
+    async def image_exists(self, filename: str, folder_type: str = "input") -> bool:
+        """True if ComfyUI still serves filename (HEAD /view)"""
+        try:
+            with self.timed("exists"):
+                response = await self.http.head(self.url("/view"),
+                    params={"filename": filename, "type": folder_type}, timeout=self.timeouts.probe)
+            return response.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    # ---- prompts -----------------------------------------------------------
+
+    async def queue_prompt(self, workflow: Union[dict, str]) -> str:
+        """Queue a graph (dict or pre-rendered JSON string) on this client's id, return its prompt_id"""
+        if not isinstance(workflow, str):
+            workflow = json.dumps(workflow)
+        body = f'{{"prompt":{workflow},"client_id":"{self.client_id}"}}'
+        with self.timed("prompt"):
+            response = await self.http.post(self.url("/prompt"), content=body,
+                headers={"Content-Type": "application/json"}, timeout=self.timeouts.prompt)
+        result = response.json()
+        prompt_id = result.get("prompt_id")
+        if not prompt_id:
+            raise ComfyUIError(f"Queue failed: {result}")
+        return prompt_id
+
+    async def get_history(self, prompt_id: str) -> Optional[dict]:
+        """Get the execution history for a prompt"""
+        with self.timed("history"):
+            response = await self.http.get(self.url(f"/history/{prompt_id}"), timeout=self.timeouts.history)
+        return response.json().get(prompt_id)
+
+    async def get_outputs(self, prompt_id: str) -> Optional[Outputs]:
+        """Output filenames from /history, None while the prompt is still running"""
+        entry = await self.get_history(prompt_id)
+        if entry:
+            outputs = {node_id: [img["filename"] for img in node_output["images"]]
+                       for node_id, node_output in entry.get("outputs", {}).items()
+                       if node_output.get("images")}
+            if outputs:
+                return outputs
+            if entry.get("status", {}).get("status_str") == "error":
+                raise ComfyUIError("ComfyUI execution error")
+        return None
+
+    async def wait_for_outputs(self, prompt_id: str, timeout: float = 240, expected: int = 1) -> Optional[Outputs]:
+        """Return {node_id: [filenames]} for prompt_id, or None on timeout.
+
+        Resolves from websocket events as soon as `expected` SaveImage nodes report
+        output; polls /history only while the event stream is disconnected.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        tracker = self.events.track(prompt_id)
+        tracker.expect(expected)
+
+        async def resolved():
+            outputs = tracker.future.result()
+            if len(outputs) >= tracker.expected:
+                return outputs
+            # Ended with output nodes unreported: ComfyUI cached them
+            outputs = await self.get_outputs(prompt_id)
+            if not outputs:
+                raise ComfyUIError("Prompt finished without output images")
+            return outputs
+
+        try:
+            while loop.time() < deadline:
+                if tracker.future.done():
+                    return await resolved()
+
+                if self.events.connected:
+                    dropped = asyncio.ensure_future(self.events.disconnected.wait())
+                    done, _ = await asyncio.wait({tracker.future, dropped},
+                                                 timeout=deadline - loop.time(),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    dropped.cancel()
+                    if tracker.future in done:
+                        return await resolved()
+                    # Socket dropped (or timed out): check history once before polling
+                else:
+                    await asyncio.sleep(self.poll_interval)
+
+                outputs = await self.get_outputs(prompt_id)
+                if outputs:
+                    return outputs
+            return None
+        finally:
+            self.events.release(prompt_id)
+
+    # ---- outputs -----------------------------------------------------------
+
+    async def get_image(self, filename: str, subfolder: str = "", folder_type: str = "output") -> bytes:
+        """Download a generated image from ComfyUI"""
+        with self.timed("view"):
+            response = await self.http.get(self.url("/view"),
+                params={"filename": filename, "subfolder": subfolder, "type": folder_type})
+        response.raise_for_status()
         return response.content
 
+    async def stream_image(self, filename: str, chunk_size: int = 256 * 1024,
+                           subfolder: str = "", folder_type: str = "output") -> AsyncIterator[bytes]:
+        """Yield a generated image chunk by chunk (time to first byte is recorded)"""
+        with self.timed("view_stream"):
+            request = self.http.build_request("GET", self.url("/view"),
+                params={"filename": filename, "subfolder": subfolder, "type": folder_type})
+            response = await self.http.send(request, stream=True)
+        try:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size):
+                yield chunk
+        finally:
+            await response.aclose()
+
+    # ---- whole workflow ----------------------------------------------------
+
+    async def execute(self, build: Callable[[str], dict], input_image_data: bytes, input_filename: str,
+                      timeout: float = 120) -> WorkflowResult:
+        """Upload the input, run the graph `build(uploaded_name)` returns and download the first output"""
+        start_time = time.time()
+        try:
+            uploaded_name = await self.upload_image(input_image_data, input_filename)
+            prompt_id = await self.queue_prompt(build(uploaded_name))
+            outputs = await self.wait_for_outputs(prompt_id, timeout)
+            if not outputs:
+                return WorkflowResult(False, time.time() - start_time, prompt_id=prompt_id,
+                                      error="Workflow execution timed out")
+            filename = next(iter(outputs.values()))[0]
+            image_data = await self.get_image(filename)
+            return WorkflowResult(True, time.time() - start_time, image_data=image_data,
+                                  filename=filename, prompt_id=prompt_id)
+        except Exception as e:
+            return WorkflowResult(False, time.time() - start_time, error=str(e))
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "pool": self.pool.stats() if self.pool else None,
+            "events": self.events.stats(),
+            "calls": {name: stats.as_dict() for name, stats in self.calls.items()},
+        }
+
+
+# =============================================================================
+# WORKFLOW FILES
+# =============================================================================
+
+WORKFLOWS_DIR = os.getenv("WORKFLOWS_DIR", "/app/workflows")
+
+# Node types prepare_workflow fills, and the inputs it sets on them
+SLOT_TYPES = ("LoadImage", "CLIPTextEncode", "KSampler", "FluxGuidance")
+
+
+class Workflow:
+    """
+    A parsed API-format graph, shared read-only between jobs.
+
+    fill() returns a per-job graph copy-on-write style: nodes that get new
+    inputs are shallow-copied with a fresh `inputs` dict, every other node is
+    the shared original. Nothing may mutate the result's untouched nodes.
+    """
+
+    def __init__(self, name: str, graph: dict, mtime: float = 0.0):
+        self.name = name
+        self.graph = graph
+        self.mtime = mtime
+        self.slots: Dict[str, List[str]] = {class_type: [] for class_type in SLOT_TYPES}
+        for node_id, node in graph.items():
+            if isinstance(node, dict) and node.get("class_type") in self.slots:
+                self.slots[node["class_type"]].append(node_id)
+
+    def fill(self, overrides: Dict[str, dict]) -> dict:
+        """Graph with overrides[node_id] merged into those nodes' inputs"""
+        graph = dict(self.graph)
+        for node_id, inputs in overrides.items():
+            node = graph[node_id]
+            graph[node_id] = {**node, "inputs": {**node.get("inputs", {}), **inputs}}
+        return graph
+
+
+def validate_workflow(graph: Any) -> Optional[str]:
+    """Problem with an API-format graph, or None if it looks runnable"""
+    if not isinstance(graph, dict) or not graph:
+        return "not a non-empty {node_id: node} object"
+    for node_id, node in graph.items():
+        if not isinstance(node, dict) or not isinstance(node.get("class_type"), str):
+            return f"node {node_id} has no class_type"
+        inputs = node.get("inputs", {})
+        if not isinstance(inputs, dict):
+            return f"node {node_id} inputs is not an object"
+        for name, value in inputs.items():
+            # Links are [source_node_id, output_index]
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int) \
+                    and str(value[0]) not in graph:
+                return f"node {node_id} input {name} links to missing node {value[0]}"
+    return None
+
+
+class WorkflowRegistry:
+    """
+    Every *.json workflow in a directory, parsed and validated once.
+
+    get() re-stats a file at most every `check_interval` seconds and reloads it
+    when its mtime changed; a file that no longer parses or validates keeps
+    its previous version (the error is in stats()).
+    """
+
+    def __init__(self, directory: str = WORKFLOWS_DIR, check_interval: float = 2.0):
+        self.directory = Path(directory)
+        self.check_interval = check_interval
+        self.workflows: Dict[str, Workflow] = {}
+        self.checked: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self.load_seconds = 0.0
+        self.reloads = 0
+
+    def load_file(self, name: str) -> Optional[Workflow]:
+        path = self.directory / name
+        try:
+            mtime = path.stat().st_mtime
+            with open(path, "r") as f:
+                graph = json.load(f)
+        except (OSError, ValueError) as e:
+            self.errors[name] = str(e)
+            return None
+        problem = validate_workflow(graph)
+        if problem:
+            self.errors[name] = problem
+            print(f"⚠️ Workflow {name} rejected: {problem}")
+            return None
+        self.errors.pop(name, None)
+        workflow = self.workflows[name] = Workflow(name, graph, mtime)
+        return workflow
+
+    def load_all(self) -> "WorkflowRegistry":
+        start = time.perf_counter()
+        names = sorted(path.name for path in self.directory.glob("*.json")) if self.directory.is_dir() else []
+        for name in names:
+            self.load_file(name)
+            self.checked[name] = time.monotonic()
+        self.load_seconds = time.perf_counter() - start
+        print(f"📋 Loaded {len(self.workflows)} workflow file(s) from {self.directory} "
+              f"in {self.load_seconds * 1000:.1f} ms")
+        return self
+
+    def get(self, name: str) -> Workflow:
+        now = time.monotonic()
+        workflow = self.workflows.get(name)
+        if workflow is None or now - self.checked.get(name, 0.0) >= self.check_interval:
+            self.checked[name] = now
+            try:
+                changed = workflow is None or (self.directory / name).stat().st_mtime != workflow.mtime
+            except OSError:
+                changed = False
+            if changed:
+                reloaded = self.load_file(name)
+                if reloaded and workflow is not None:
+                    self.reloads += 1
+                    print(f"🔄 Workflow {name} reloaded")
+                workflow = reloaded or workflow
+        if workflow is None:
+            raise KeyError(f"Workflow {name} not found in {self.directory}: {self.errors.get(name, 'missing')}")
+        return workflow
+
+    def stats(self) -> dict:
+        return {
+            "directory": str(self.directory),
+            "workflows": sorted(self.workflows),
+            "errors": self.errors,
+            "load_ms": round(self.load_seconds * 1000, 1),
+            "reloads": self.reloads,
+        }
+
 
-def load_workflow(workflow_name: str = "flatlay_api.json") -> dict:
-    """Load a workflow JSON file"""
-    workflow_path = Path("/app/workflows") / workflow_name
-    with open(workflow_path, "r") as f:
-        return json.load(f)
+# Shared instances for the module-level helpers below
+default_client: Optional[ComfyUIClient] = None
+default_registry: Optional[WorkflowRegistry] = None
+
+
+def get_client() -> ComfyUIClient:
+    global default_client
+    if default_client is None:
+        default_client = ComfyUIClient()
+    return default_client
+
+
+def get_registry() -> WorkflowRegistry:
+    """The WORKFLOWS_DIR registry, loaded on first use"""
+    global default_registry
+    if default_registry is None:
+        default_registry = WorkflowRegistry().load_all()
+    return default_registry
+
+
+def load_workflow(workflow_name: str = "flatlay_api.json") -> Workflow:
+    """Get a parsed workflow from the registry (reloaded if the file changed)"""
+    return get_registry().get(workflow_name)
 
 
 def prepare_workflow(
-    workflow: dict,
+    workflow: Union[Workflow, dict],
     input_image_name: str,
     prompt: str,
     seed: Optional[int] = None,
@@ -89,9 +730,12 @@ def prepare_workflow(
 ) -> dict:
     """
     Prepare a workflow by setting the input parameters
-    
+
+    Only the nodes that get new values are copied (see Workflow.fill); the
+    rest of the graph is shared with the registry.
+
     Args:
-        workflow: The base workflow dict
+        workflow: The base workflow (registry entry or plain graph dict)
         input_image_name: Name of the uploaded input image
         prompt: The text prompt for generation
         seed: Random seed (None for random)
@@ -99,38 +743,20 @@ def prepare_workflow(
         denoise: Denoise strength (default 0.98)
         steps: Number of sampling steps (default 25)
     """
-    # Deep copy the workflow
-    import copy
-    prepared = copy.deepcopy(workflow)
-    
-    # Find and update nodes by type
-    for node_id, node in prepared.items():
-        if not isinstance(node, dict):
-            continue
-            
-        class_type = node.get("class_type", "")
-        
-        # Update LoadImage node with input image
-        if class_type == "LoadImage":
-            node["inputs"]["image"] = input_image_name
-            
-        # Update CLIPTextEncode (Prompt) node
-        elif class_type == "CLIPTextEncode":
-            node["inputs"]["text"] = prompt
-            
-        # Update KSampler parameters
-        elif class_type == "KSampler":
-            if seed is not None:
-                node["inputs"]["seed"] = seed
-            node["inputs"]["cfg"] = guidance
-            node["inputs"]["denoise"] = denoise
-            node["inputs"]["steps"] = steps
-            
-        # Update FluxGuidance
-        elif class_type == "FluxGuidance":
-            node["inputs"]["guidance"] = guidance
-    
-    return prepared
+    if not isinstance(workflow, Workflow):
+        workflow = Workflow("inline", workflow)
+
+    sampler = {"cfg": guidance, "denoise": denoise, "steps": steps}
+    if seed is not None:
+        sampler["seed"] = seed
+    values = {
+        "LoadImage": {"image": input_image_name},
+        "CLIPTextEncode": {"text": prompt},
+        "KSampler": sampler,
+        "FluxGuidance": {"guidance": guidance},
+    }
+    return workflow.fill({node_id: values[class_type]
+                          for class_type, node_ids in workflow.slots.items() for node_id in node_ids})
 
 
 async def execute_workflow(
@@ -140,98 +766,24 @@ async def execute_workflow(
     guidance: float = 3.0,
     denoise: float = 0.98,
     steps: int = 25,
-    workflow_name: str = "flatlay_api.json"
+    workflow_name: str = "flatlay_api.json",
+    client: Optional[ComfyUIClient] = None
 ) -> dict:
     """
     Execute a complete workflow and return the result
-    
+
     Returns:
         dict with 'success', 'image_data', 'filename', 'execution_time'
+        (plus 'prompt_id' and 'error')
     """
-    import time
-    start_time = time.time()
-    
-    # Generate unique IDs
-    client_id = str(uuid.uuid4())
-    input_filename = f"input_{uuid.uuid4().hex[:8]}.png"
-    
+    client = client or get_client()
     try:
-        # 1. Upload input image
-        uploaded_name = await upload_image(input_image_data, input_filename)
-        
-        # 2. Load and prepare workflow
         workflow = load_workflow(workflow_name)
-        prepared_workflow = prepare_workflow(
-            workflow,
-            input_image_name=uploaded_name,
-            prompt=prompt,
-            seed=seed,
-            guidance=guidance,
-            denoise=denoise,
-            steps=steps
-        )
-        
-        # 3. Convert workflow to API format (node_id: node_data)
-        api_workflow = {}
-        for node in prepared_workflow.get("nodes", []):
-            node_id = str(node["id"])
-            api_workflow[node_id] = {
-                "class_type": node["type"],
-                "inputs": {}
-            }
-            # Map widget values to inputs
-            if "widgets_values" in node:
-                # This is simplified - full implementation would need proper mapping
-                pass
-        
-        # For our simplified workflow, use the prepared dict directly
-        # (assuming flatlay_api.json is in API format)
-        
-        # 4. Queue the prompt
-        prompt_id = await queue_prompt(prepared_workflow, client_id)
-        
-        # 5. Poll for completion
-        max_wait = 120  # seconds
-        poll_interval = 2  # seconds
-        elapsed = 0
-        
-        while elapsed < max_wait:
-            history = await get_history(prompt_id)
-            
-            if history and "outputs" in history:
-                # Find the output image
-                for node_id, output in history["outputs"].items():
-                    if "images" in output:
-                        image_info = output["images"][0]
-                        filename = image_info["filename"]
-                        subfolder = image_info.get("subfolder", "")
-                        
-                        # Download the image
-                        image_data = await get_image(filename, subfolder)
-                        
-                        execution_time = time.time() - start_time
-                        
-                        return {
-                            "success": True,
-                            "image_data": image_data,
-                            "filename": filename,
-                            "execution_time": execution_time,
-                            "prompt_id": prompt_id
-                        }
-            
-            await asyncio.sleep(poll_interval)
-            elapsed += poll_interval
-        
-        # Timeout
-        return {
-            "success": False,
-            "error": "Workflow execution timed out",
-            "execution_time": time.time() - start_time
-        }
-        
-    except Exception as e:
-        return {
-            "success": False,
-            "error": str(e),
-            "execution_time": time.time() - start_time
-        }
+    except KeyError as e:
+        return asdict(WorkflowResult(False, 0.0, error=e.args[0]))
+
+    def build(uploaded_name: str) -> dict:
+        return prepare_workflow(workflow, uploaded_name, prompt, seed, guidance, denoise, steps)
+
+    result = await client.execute(build, input_image_data, f"input_{uuid.uuid4().hex[:8]}.png")
+    return asdict(result)
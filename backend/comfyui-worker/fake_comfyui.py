@@ -0,0 +1,246 @@
+"""
+Fake ComfyUI server for local development and benchmarks.
+
+Implements the parts of the ComfyUI HTTP/websocket API the worker uses:
+/system_stats, /upload/image, /prompt, /history/{prompt_id}, /view and
+/ws?clientId=... (progress, executing, executed events). It also serves a
+webhook sink at /webhook so callbacks can be pointed back at it; the sink
+accepts every worker DELIVERY_MODE (JSON, multipart, raw body).
+
+Like ComfyUI it executes one prompt at a time. A prompt takes
+`prompt_overhead` seconds (validation, queueing) plus `sample_seconds` per
+output image. The first prompt also pays `model_load_seconds`, like ComfyUI
+loading models lazily. The default overhead is synthetic; a warm real ComfyUI
+spends far less per prompt, so pass a measured value when benchmarking prompt
+merging.
+
+Run:
+    python fake_comfyui.py --port 18188 --sample-seconds 1.5
+    COMFYUI_URL=http://localhost:18188 python worker.py
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import uuid
+
+from fastapi import FastAPI, File, Form, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response
+import uvicorn
+
+# 1x1 transparent PNG returned by /view
+PIXEL_PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+)
+
+app = FastAPI()
+app.state.sample_seconds = 1.5
+app.state.prompt_overhead = 0.5
+app.state.steps = 5
+app.state.fail_prompts = False
+app.state.cached_outputs = False  # like a re-run prompt: no `executed` events, outputs only in /history
+app.state.model_load_seconds = 0.0
+app.state.models_loaded = False
+app.state.output_bytes = 0  # /view output size; 0 serves a 1x1 PNG
+app.state.upload_seconds = 0.0  # simulated /upload/image latency
+app.state.upload_mbps = 0.0  # simulated upload bandwidth (0 = unlimited)
+execution_lock = asyncio.Lock()
+
+uploads = {}
+history = {}
+sockets = {}
+webhooks = []
+counters = {'uploads': 0, 'prompts': 0, 'history_polls': 0, 'views': 0}
+
+
+async def emit(client_id, kind, data):
+    targets = [sockets[client_id]] if client_id in sockets else list(sockets.values())
+    for ws in targets:
+        try:
+            await ws.send_json({'type': kind, 'data': data})
+        except Exception:
+            pass
+
+
+def output_batch(workflow):
+    """Number of images the graph would produce (batched latents)"""
+    for node in workflow.values():
+        inputs = node.get('inputs', {})
+        if node.get('class_type') == 'RepeatLatentBatch':
+            return int(inputs.get('amount', 1))
+        if node.get('class_type') == 'EmptySD3LatentImage':
+            return int(inputs.get('batch_size', 1))
+    return 1
+
+
+async def execute(prompt_id, workflow, client_id):
+    async with execution_lock:
+        await run_prompt(prompt_id, workflow, client_id)
+
+
+async def run_prompt(prompt_id, workflow, client_id):
+    steps = app.state.steps
+    saves = [nid for nid, node in workflow.items() if node.get('class_type') == 'SaveImage']
+    images = max(len(saves), 1) * output_batch(workflow)
+    await emit(client_id, 'execution_start', {'prompt_id': prompt_id})
+    if not app.state.models_loaded:
+        await asyncio.sleep(app.state.model_load_seconds)
+        app.state.models_loaded = True
+    await asyncio.sleep(app.state.prompt_overhead)
+    for step in range(1, steps + 1):
+        await asyncio.sleep(app.state.sample_seconds * images / steps)
+        await emit(client_id, 'progress', {'prompt_id': prompt_id, 'value': step, 'max': steps, 'node': '31'})
+
+    if app.state.fail_prompts:
+        history[prompt_id] = {'outputs': {}, 'status': {'status_str': 'error', 'completed': False}}
+        await emit(client_id, 'execution_error', {'prompt_id': prompt_id, 'exception_message': 'fake failure'})
+        return
+
+    outputs = {}
+    for node_id, node in workflow.items():
+        if node.get('class_type') != 'SaveImage':
+            continue
+        prefix = node.get('inputs', {}).get('filename_prefix', 'ComfyUI')
+        images = [{'filename': f'{prefix}_{i:05d}_.png', 'subfolder': '', 'type': 'output'}
+                  for i in range(1, output_batch(workflow) + 1)]
+        outputs[node_id] = {'images': images}
+        if app.state.cached_outputs:
+            continue
+        await emit(client_id, 'executing', {'prompt_id': prompt_id, 'node': node_id})
+        await emit(client_id, 'executed', {'prompt_id': prompt_id, 'node': node_id, 'output': {'images': images}})
+
+    history[prompt_id] = {'outputs': outputs, 'status': {'status_str': 'success', 'completed': True}}
+    if app.state.cached_outputs:
+        await emit(client_id, 'execution_cached', {'prompt_id': prompt_id, 'nodes': list(outputs)})
+    await emit(client_id, 'executing', {'prompt_id': prompt_id, 'node': None})
+
+
+@app.get('/system_stats')
+async def system_stats():
+    return {'system': {'os': 'fake'}, 'devices': [], 'counters': counters}
+
+
+@app.post('/upload/image')
+async def upload_image(image: UploadFile = File(...), overwrite: str = Form('false')):
+    data = await image.read()
+    await asyncio.sleep(app.state.upload_seconds)
+    if app.state.upload_mbps:
+        await asyncio.sleep(len(data) * 8 / (app.state.upload_mbps * 1e6))
+    uploads[image.filename] = len(data)
+    counters['uploads'] += 1
+    return {'name': image.filename, 'subfolder': '', 'type': 'input'}
+
+
+@app.post('/prompt')
+async def prompt(body: dict):
+    prompt_id = str(uuid.uuid4())
+    counters['prompts'] += 1
+    asyncio.create_task(execute(prompt_id, body.get('prompt', {}), body.get('client_id')))
+    return {'prompt_id': prompt_id, 'number': counters['prompts'], 'node_errors': {}}
+
+
+@app.get('/history/{prompt_id}')
+async def get_history(prompt_id: str):
+    counters['history_polls'] += 1
+    if prompt_id in history:
+        return {prompt_id: history[prompt_id]}
+    return {}
+
+
+@app.api_route('/view', methods=['GET', 'HEAD'])
+async def view(filename: str, subfolder: str = '', type: str = 'output'):
+    if type == 'input':
+        if filename not in uploads:
+            return Response(status_code=404)
+        return Response(b'\0' * uploads[filename], media_type='image/png')
+    counters['views'] += 1
+    if app.state.output_bytes:
+        return Response(output_image(app.state.output_bytes), media_type='image/png')
+    return Response(PIXEL_PNG, media_type='image/png')
+
+
+def output_image(size):
+    """PNG signature padded to `size` bytes, cached so every /view serves the same buffer"""
+    if len(output_image.cache) != size:
+        output_image.cache = PIXEL_PNG + b'\0' * max(size - len(PIXEL_PNG), 0)
+    return output_image.cache
+
+output_image.cache = b''
+
+
+@app.post('/webhook')
+async def webhook(request: Request):
+    content_type = request.headers.get('content-type', '')
+    received = 0
+    if content_type.startswith('multipart/form-data'):
+        form = await request.form()
+        body = json.loads(form['metadata'])
+        files = form.getlist('image')
+        for f in files:
+            received += len(await f.read())
+        images = len(files)
+    elif content_type.startswith('image/'):
+        body = json.loads(request.headers.get('x-job-metadata', '{}'))
+        async for chunk in request.stream():
+            received += len(chunk)
+        images = 1
+    else:
+        body = await request.json()
+        if 'batch' in body:
+            for item in body['batch']:
+                webhooks.append({'job_id': item.get('job_id'), 'success': item.get('success'),
+                                 'images': len(item.get('image_urls') or []) or int(bool(item.get('image_url'))),
+                                 'bytes': 0, 'error': item.get('error'), 'batch': len(body['batch'])})
+            return {'success': True}
+        encoded = body.get('images_base64') or ([body['image_base64']] if body.get('image_base64') else [])
+        received = sum(len(image) * 3 // 4 for image in encoded)
+        images = len(encoded) or len(body.get('image_urls') or []) or int(bool(body.get('image_url')))
+    webhooks.append({
+        'job_id': body.get('job_id'),
+        'success': body.get('success'),
+        'images': images,
+        'bytes': received,
+        'error': body.get('error'),
+    })
+    return {'success': True}
+
+
+@app.get('/webhooks')
+async def list_webhooks():
+    return webhooks
+
+
+@app.websocket('/ws')
+async def ws(websocket: WebSocket, clientId: str = ''):
+    await websocket.accept()
+    sockets[clientId] = websocket
+    await websocket.send_json({'type': 'status', 'data': {'sid': clientId}})
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sockets.pop(clientId, None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=18188)
+    parser.add_argument('--sample-seconds', type=float, default=1.5)
+    parser.add_argument('--prompt-overhead', type=float, default=0.5)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--model-load-seconds', type=float, default=0.0)
+    parser.add_argument('--output-bytes', type=int, default=0, help='size of each output image (0 = 1x1 PNG)')
+    parser.add_argument('--upload-seconds', type=float, default=0.0, help='latency of each /upload/image')
+    parser.add_argument('--upload-mbps', type=float, default=0.0, help='upload bandwidth (0 = unlimited)')
+    args = parser.parse_args()
+    app.state.sample_seconds = args.sample_seconds
+    app.state.prompt_overhead = args.prompt_overhead
+    app.state.steps = args.steps
+    app.state.model_load_seconds = args.model_load_seconds
+    app.state.output_bytes = args.output_bytes
+    app.state.upload_seconds = args.upload_seconds
+    app.state.upload_mbps = args.upload_mbps
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
@@ -3,16 +3,13 @@
 # Start ComfyUI in background
 echo "Starting ComfyUI server..."
 cd /app/ComfyUI
-python main.py --listen 0.0.0.0 --port 8188 --disable-auto-launch &
+COMFYUI_PORT=${COMFYUI_PORT:-8188}
+python main.py --listen 0.0.0.0 --port $COMFYUI_PORT --disable-auto-launch &
 
-# Wait for ComfyUI to be ready
+# Wait for ComfyUI to be ready (poll often: every second here is cold-start latency)
 echo "Waiting for ComfyUI to initialize..."
-sleep 10
-
-# Check if ComfyUI is running
-until curl -s http://localhost:8188/system_stats > /dev/null; do
-    echo "Waiting for ComfyUI..."
-    sleep 5
+until curl -s http://localhost:$COMFYUI_PORT/system_stats > /dev/null; do
+    sleep 1
 done
 
 echo "ComfyUI is ready!"
@@ -20,6 +17,7 @@ echo "ComfyUI is ready!"
 # Start our HTTP API worker
 echo "Starting HTTP API worker..."
 cd /app
+export COMFYUI_URL=${COMFYUI_URL:-http://localhost:$COMFYUI_PORT}
 python -m uvicorn worker:app --host 0.0.0.0 --port 8000
 
 # Keep container running
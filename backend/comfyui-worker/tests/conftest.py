@@ -0,0 +1,56 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_comfyui  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def comfyui_server():
+    """fake_comfyui.app served on a thread for the whole session; yields its base URL"""
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(fake_comfyui.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f'http://127.0.0.1:{port}'
+    server.should_exit = True
+    thread.join(5)
+
+
+@pytest.fixture
+def fake_comfyui_url(comfyui_server):
+    """Fast, freshly reset fake ComfyUI"""
+    state = fake_comfyui.app.state
+    state.sample_seconds, state.prompt_overhead, state.steps = 0.0, 0.0, 2
+    state.fail_prompts, state.cached_outputs = False, False
+    state.models_loaded, state.model_load_seconds = True, 0.0
+    state.output_bytes = state.upload_seconds = state.upload_mbps = 0
+    for store in (fake_comfyui.uploads, fake_comfyui.history, fake_comfyui.webhooks):
+        store.clear()
+    for name in fake_comfyui.counters:
+        fake_comfyui.counters[name] = 0
+    return comfyui_server
+
+
+@pytest.fixture
+def worker_app(fake_comfyui_url, monkeypatch):
+    """The worker module talking to the fake ComfyUI (websocket off, fast polling)"""
+    import worker
+    from comfyui_api import ComfyUIClient
+    monkeypatch.setattr(worker, 'comfy', ComfyUIClient(fake_comfyui_url, ws_enabled=False, poll_interval=0.05))
+    return worker
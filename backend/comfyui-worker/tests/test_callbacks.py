@@ -0,0 +1,106 @@
+"""Callback queue: retry classification, backoff, drops and the disk spool"""
+
+import asyncio
+import json
+import os
+
+import httpx
+import pytest
+
+from worker import CallbackQueue, retryable
+
+
+def status_error(status):
+    request = httpx.Request('POST', 'http://webhook.test/callback')
+    return httpx.HTTPStatusError('error', request=request, response=httpx.Response(status, request=request))
+
+
+@pytest.mark.parametrize('status', [408, 429, 500, 502, 503])
+def test_retryable_statuses(status):
+    assert retryable(status_error(status))
+
+
+@pytest.mark.parametrize('status', [400, 401, 404, 413, 422])
+def test_client_errors_are_final(status):
+    assert not retryable(status_error(status))
+
+
+def test_network_errors_are_retryable():
+    assert retryable(httpx.ConnectError('refused'))
+    assert retryable(httpx.ReadTimeout('timed out'))
+
+
+def make_queue(spool_dir, max_attempts=3):
+    return CallbackQueue(str(spool_dir), max_attempts, backoff=0.01, backoff_max=0.05,
+                         concurrency=1, batch_max=1, batch_window=0.0)
+
+
+async def submitted(queue):
+    await queue.submit('http://webhook.test/callback', {'job_id': 'job-1', 'status': 'failed'})
+    return next(iter(queue.entries.values()))
+
+
+def test_retryable_failure_is_rescheduled(tmp_path):
+    async def main():
+        queue = make_queue(tmp_path)
+        entry = await submitted(queue)
+        await queue.failed(entry, status_error(503))
+        return queue, entry
+    queue, entry = asyncio.run(main())
+    assert entry['id'] in queue.entries
+    assert entry['attempts'] == 1
+    assert queue.retries == 1 and queue.dropped == 0
+    assert os.path.exists(queue.spool_path(entry['id']))
+
+
+def test_client_error_is_dropped_at_once(tmp_path):
+    async def main():
+        queue = make_queue(tmp_path)
+        entry = await submitted(queue)
+        await queue.failed(entry, status_error(400))
+        return queue, entry
+    queue, entry = asyncio.run(main())
+    assert not queue.entries
+    assert queue.dropped == 1 and queue.retries == 0
+    assert os.path.exists(queue.spool_path(entry['id'], '.failed'))
+    assert not os.path.exists(queue.spool_path(entry['id']))
+
+
+def test_dropped_after_max_attempts(tmp_path):
+    async def main():
+        queue = make_queue(tmp_path, max_attempts=3)
+        entry = await submitted(queue)
+        for _ in range(3):
+            await queue.failed(entry, httpx.ConnectError('refused'))
+        return queue, entry
+    queue, entry = asyncio.run(main())
+    assert queue.retries == 2 and queue.dropped == 1
+    assert os.path.exists(queue.spool_path(entry['id'], '.failed'))
+
+
+def test_spooled_callbacks_are_reloaded(tmp_path):
+    async def main():
+        entry = await submitted(make_queue(tmp_path))
+        restarted = make_queue(tmp_path)
+        restarted.load()
+        return entry, restarted
+    entry, restarted = asyncio.run(main())
+    assert list(restarted.entries) == [entry['id']]
+
+
+
+def test_send_failure_goes_through_failed(tmp_path, monkeypatch):
+    import worker
+    monkeypatch.setattr(worker, 'POOLS', {})
+
+    async def main():
+        queue = make_queue(tmp_path)
+        await queue.submit('http://127.0.0.1:9/callback', {'job_id': 'job-1', 'success': False})
+        entry = next(iter(queue.entries.values()))
+        await queue.send([entry])
+        await worker.get_pool('webhook').client.aclose()
+        return queue, entry
+    queue, entry = asyncio.run(main())
+    assert entry['attempts'] == 1 and queue.retries == 1
+    with open(queue.spool_path(entry['id'])) as f:
+        assert json.load(f)['attempts'] == 1
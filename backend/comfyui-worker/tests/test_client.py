@@ -0,0 +1,71 @@
+"""ComfyUIClient against the fake ComfyUI: uploads, call timing, errors, restart"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import fake_comfyui
+from comfyui_api import ComfyUIClient
+
+
+async def chunked(data, size=7):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def test_uploads_and_exists_are_timed(fake_comfyui_url):
+    seen = []
+
+    async def main():
+        client = ComfyUIClient(fake_comfyui_url, ws_enabled=False, on_call=lambda name, _: seen.append(name))
+        try:
+            names = [await client.upload_image(b'a' * 100, 'one.png'),
+                     await client.upload_stream(chunked(b'b' * 100), 'two.png')]
+            exists = [await client.image_exists('two.png'), await client.image_exists('three.png')]
+        finally:
+            await client.aclose()
+        return client, names, exists
+    client, names, exists = asyncio.run(main())
+    assert names == ['one.png', 'two.png']
+    assert fake_comfyui.uploads == {'one.png': 100, 'two.png': 100}
+    assert exists == [True, False]
+    assert client.calls['upload'].count == 2 and client.calls['exists'].count == 2
+    assert seen == ['upload', 'upload', 'exists', 'exists']
+
+
+def test_unreachable_server_counts_errors():
+    async def main():
+        client = ComfyUIClient('http://127.0.0.1:9', ws_enabled=False)
+        try:
+            return client, await client.is_up(), await client.image_exists('x.png')
+        finally:
+            await client.aclose()
+    client, up, exists = asyncio.run(main())
+    assert not up and not exists
+    assert client.calls['system_stats'].errors == 1
+    assert client.calls['exists'].errors == 1
+
+
+def test_http_error_status_raises(fake_comfyui_url):
+    async def main():
+        client = ComfyUIClient(f'{fake_comfyui_url}/missing', ws_enabled=False)
+        try:
+            await client.upload_image(b'a', 'one.png')
+        finally:
+            await client.aclose()
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(main())
+
+
+def test_client_reopens_after_aclose(fake_comfyui_url):
+    async def main():
+        client = ComfyUIClient(fake_comfyui_url, ws_enabled=False)
+        first = await client.system_stats()
+        await client.aclose()
+        assert client.pool is None
+        second = await client.system_stats()
+        await client.aclose()
+        return first, second
+    first, second = asyncio.run(main())
+    assert first == second
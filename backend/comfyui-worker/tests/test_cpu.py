@@ -0,0 +1,79 @@
+"""CPU offload: executor routing, slice-wise base64, and the loop lag monitor"""
+
+import asyncio
+import base64
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from worker import B64_SLICE_BYTES, CPUExecutor, LoopLagMonitor, decode_b64, json_callback
+
+
+def current_thread():
+    return threading.get_ident()
+
+
+def test_small_inputs_run_inline():
+    cpu = CPUExecutor('thread', 2, min_bytes=1000)
+
+    async def main():
+        try:
+            return [await cpu.run(current_thread, size=size) for size in (10, 5000, None)]
+        finally:
+            cpu.stop()
+    inline, offloaded, unsized = asyncio.run(main())
+    assert inline == threading.get_ident()
+    assert offloaded != inline and unsized != inline
+    calls = cpu.stats()['calls']['current_thread']
+    assert (calls['offloaded'], calls['inline']) == (2, 1)
+
+
+def test_process_pool_runs_module_functions():
+    cpu = CPUExecutor('process', 1, min_bytes=0)
+    data = os.urandom(1000)
+
+    async def main():
+        try:
+            return await cpu.run(decode_b64, base64.b64encode(data).decode(), b'k')
+        finally:
+            cpu.stop()
+    img, digest = asyncio.run(main())
+    assert img == data and digest == decode_b64(base64.b64encode(data).decode(), b'k')[1]
+
+
+def test_base64_slices_round_trip():
+    images = [os.urandom(B64_SLICE_BYTES * 2 + 5), b'small']
+    body = json.loads(json_callback({'job_id': 'j', 'success': True}, images))
+    assert body['job_id'] == 'j'
+    assert body['image_base64'] == base64.b64encode(images[0]).decode()
+    assert [base64.b64decode(s) for s in body['images_base64']] == images
+    encoded = body['image_base64']
+    assert decode_b64(encoded)[0] == images[0]
+    # Whitespace shifts the slice boundaries: still decoded
+    assert decode_b64(encoded[:100] + '\n' + encoded[100:])[0] == images[0]
+
+
+@pytest.mark.parametrize('offload', [True, False])
+def test_lag_monitor_sees_blocking_work(offload):
+    cpu = CPUExecutor('thread', 1, min_bytes=1)
+    monitor = LoopLagMonitor(interval_ms=20, threshold_ms=100)
+
+    async def main():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        try:
+            await cpu.run(time.sleep, 0.3, size=1 if offload else 0)
+            await asyncio.sleep(0.05)
+        finally:
+            await monitor.stop()
+            cpu.stop()
+    asyncio.run(main())
+    stats = monitor.stats()
+    if offload:
+        assert stats['stalls'] == 0
+    else:
+        assert stats['stalls'] == 1 and stats['max_lag_ms'] >= 200
+    assert monitor.task is None
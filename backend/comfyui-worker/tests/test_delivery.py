@@ -0,0 +1,72 @@
+"""Result delivery modes against the fake webhook sink, and the local object store"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import fake_comfyui
+from worker import LocalObjectStore, iter_image
+
+IMAGES = [b'\x89PNG first' * 99, b'\x89PNG second' * 99]  # sizes divisible by 3: the sink counts base64 as 3/4 bytes
+
+
+def deliver(worker, mode, webhook_url):
+    outputs = [(f'out_{i}.png', iter_image(image)) for i, image in enumerate(IMAGES)]
+    payload = {'job_id': mode, 'success': True}
+
+    async def main():
+        try:
+            await worker.DELIVERY_MODES[mode](webhook_url, payload, outputs)
+        finally:
+            await worker.get_pool('webhook').client.aclose()
+    asyncio.run(main())
+    return payload
+
+
+@pytest.fixture
+def store(worker_app, monkeypatch, tmp_path):
+    store = LocalObjectStore(str(tmp_path), 'http://worker/results/', 3600)
+    monkeypatch.setattr(worker_app, 'object_store', store)
+    monkeypatch.setattr(worker_app, 'POOLS', {})
+    return store
+
+
+@pytest.mark.parametrize('mode', ['json', 'multipart'])
+def test_single_post_carries_every_image(worker_app, store, fake_comfyui_url, mode):
+    deliver(worker_app, mode, f'{fake_comfyui_url}/webhook')
+    [received] = fake_comfyui.webhooks
+    assert received['job_id'] == mode and received['success']
+    assert received['images'] == 2
+    assert received['bytes'] == sum(map(len, IMAGES))
+
+
+def test_raw_posts_once_per_image(worker_app, store, fake_comfyui_url):
+    deliver(worker_app, 'raw', f'{fake_comfyui_url}/webhook')
+    assert [hook['bytes'] for hook in fake_comfyui.webhooks] == [len(image) for image in IMAGES]
+    assert {hook['job_id'] for hook in fake_comfyui.webhooks} == {'raw'}
+
+
+def test_url_mode_sends_links_to_stored_images(worker_app, store, fake_comfyui_url):
+    payload = deliver(worker_app, 'url', f'{fake_comfyui_url}/webhook')
+    [received] = fake_comfyui.webhooks
+    assert received['images'] == 2 and received['bytes'] == 0
+    assert payload['image_url'] == payload['image_urls'][0]
+    for url, image in zip(payload['image_urls'], IMAGES):
+        assert url.startswith('http://worker/results/')
+        with open(store.path(url.rsplit('/', 1)[1]), 'rb') as f:
+            assert f.read() == image
+
+
+def test_results_endpoint_serves_the_store(worker_app, store):
+    async def main():
+        url = await store.put('../abc_out.png', iter_image(b'png bytes'))
+        transport = httpx.ASGITransport(app=worker_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://worker') as client:
+            found = await client.get(f'/results/{url.rsplit("/", 1)[1]}')
+            missing = await client.get('/results/nope.png')
+        return url, found, missing
+    url, found, missing = asyncio.run(main())
+    assert url == 'http://worker/results/abc_out.png'  # keys cannot leave the store directory
+    assert found.status_code == 200 and found.content == b'png bytes'
+    assert missing.status_code == 404
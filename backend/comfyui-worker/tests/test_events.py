@@ -0,0 +1,51 @@
+"""Prompt completion tracking: websocket events and the /history fallback"""
+
+import asyncio
+
+import pytest
+
+import fake_comfyui
+from comfyui_api import ComfyUIClient, ComfyUIError
+
+GRAPH = {
+    '1': {'class_type': 'EmptySD3LatentImage', 'inputs': {'batch_size': 2}},
+    '9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test', 'images': ['1', 0]}},
+}
+
+
+def run_prompt(url, ws_enabled=True):
+    async def main():
+        client = ComfyUIClient(url, ws_enabled=ws_enabled, poll_interval=0.05)
+        client.start()
+        try:
+            if ws_enabled:
+                while not client.events.connected:
+                    await asyncio.sleep(0.01)
+            prompt_id = await client.queue_prompt(GRAPH)
+            return await client.wait_for_outputs(prompt_id, timeout=5)
+        finally:
+            await client.aclose()
+    return asyncio.run(main())
+
+
+def test_websocket_completion(fake_comfyui_url):
+    assert run_prompt(fake_comfyui_url) == {'9': ['test_00001_.png', 'test_00002_.png']}
+    assert fake_comfyui.counters['history_polls'] == 0
+
+
+def test_cached_outputs_come_from_history(fake_comfyui_url):
+    fake_comfyui.app.state.cached_outputs = True
+    assert run_prompt(fake_comfyui_url) == {'9': ['test_00001_.png', 'test_00002_.png']}
+    assert fake_comfyui.counters['history_polls'] == 1
+
+
+def test_polling_without_websocket(fake_comfyui_url):
+    assert run_prompt(fake_comfyui_url, ws_enabled=False) == {'9': ['test_00001_.png', 'test_00002_.png']}
+    assert fake_comfyui.counters['history_polls'] >= 1
+
+
+@pytest.mark.parametrize('ws_enabled', [True, False])
+def test_execution_error_raises(fake_comfyui_url, ws_enabled):
+    fake_comfyui.app.state.fail_prompts = True
+    with pytest.raises(ComfyUIError):
+        run_prompt(fake_comfyui_url, ws_enabled)
@@ -0,0 +1,61 @@
+"""Prometheus metrics: histogram rendering, label escaping and bounded job labels"""
+
+import asyncio
+import base64
+import io
+import re
+
+import httpx
+from PIL import Image
+
+import worker
+from worker import GenerateReq, Histogram, UploadCache, escape_label, labels_for
+
+SAMPLE = re.compile(r'^[a-z_]+(\{([a-z_]+="([^"\\]|\\.)*",?)*\})? -?[0-9.e+-]+$')
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = Histogram('h', 'help', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        hist.observe(value, stage='x')
+    lines = hist.render()
+    assert 'h_bucket{stage="x",le="0.1"} 1' in lines
+    assert 'h_bucket{stage="x",le="1"} 2' in lines
+    assert 'h_bucket{stage="x",le="+Inf"} 3' in lines
+    assert 'h_sum{stage="x"} 5.550000' in lines and 'h_count{stage="x"} 3' in lines
+
+
+def test_label_values_are_escaped():
+    assert escape_label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+    hist = Histogram('h', 'help')
+    hist.observe(1, workflow_type='x"}\n')
+    assert all(SAMPLE.match(line) for line in hist.render() if not line.startswith('#'))
+
+
+def test_client_values_cannot_add_series():
+    r = GenerateReq(job_id='j', prompt='p', image_base64='', workflow_type='made_up"', aspect_ratio='7:3')
+    assert labels_for(r) == {'workflow_type': 'creative_edit', 'aspect_ratio': '1:1'}
+    r = GenerateReq(job_id='j', prompt='p', image_base64='', workflow_type='color_swap', aspect_ratio='16:9')
+    assert labels_for(r) == {'workflow_type': 'color_swap', 'aspect_ratio': '16:9'}
+
+
+def test_job_stages_show_up_on_metrics(worker_app, monkeypatch):
+    monkeypatch.setattr(worker_app, 'upload_cache', UploadCache(10, 10**6))
+    monkeypatch.setattr(worker_app, 'STAGE_SECONDS', Histogram('worker_stage_seconds', 'help'))
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'black').save(buffer, 'PNG')
+    r = GenerateReq(job_id='metrics', prompt='p', workflow_type='color_swap', aspect_ratio='16:9',
+                    image_base64=base64.b64encode(buffer.getvalue()).decode())
+
+    async def main():
+        worker.job_labels.set(labels_for(r))
+        await worker.process_generate(r)
+        transport = httpx.ASGITransport(app=worker.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://worker') as client:
+            return (await client.get('/metrics')).text
+    text = asyncio.run(main())
+    labels = 'aspect_ratio="16:9",stage="{}",workflow_type="color_swap",le="+Inf"'
+    for stage in ('decode', 'upload', 'graph_build', 'submit', 'sampling'):
+        assert f'worker_stage_seconds_bucket{{{labels.format(stage)}}} 1' in text
+    assert 'worker_jobs_total{aspect_ratio="16:9",status="success",workflow_type="color_swap"}' in text
+    assert all(SAMPLE.match(line) for line in text.splitlines() if line and not line.startswith('#'))
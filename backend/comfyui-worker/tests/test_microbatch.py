@@ -0,0 +1,54 @@
+"""Micro-batching: merging job graphs into one prompt and splitting the outputs"""
+
+import asyncio
+
+import worker
+from worker import MicroBatcher, batch_key, merge_graphs, split_outputs
+
+import fake_comfyui
+
+
+def job_graph(workflow_type, i):
+    return worker.build_workflow(workflow_type, image1=f'input_{i}.png', image2=None, prompt=f'job {i}',
+                                 negative_prompt='', seed=i, steps=20, guidance=2.5, structure_strength=0.5,
+                                 width=1024, height=1024, job_id=f'job{i}')
+
+
+def test_merge_shares_loaders_and_renames_the_rest():
+    graphs = [job_graph('creative_edit', 0), job_graph('fabric_texture', 1)]
+    merged, save_nodes = merge_graphs(graphs)
+    for nid in worker.SHARED_NODES:
+        assert merged[nid] == graphs[0][nid]
+    per_job = sum(len(g) - len(worker.SHARED_NODES) for g in graphs)
+    assert len(merged) == per_job + len(worker.SHARED_NODES)
+    for i, graph in enumerate(graphs):
+        assert merged[f'b{i}_31']['inputs']['seed'] == i
+        # Links point at the job's own nodes, or at the shared loaders
+        assert merged[f'b{i}_31']['inputs']['positive'][0].startswith(f'b{i}_')
+        assert merged[f'b{i}_31']['inputs']['model'] == ['37', 0]
+        assert save_nodes[i] == [f'b{i}_{nid}' for nid, node in graph.items() if node['class_type'] == 'SaveImage']
+
+
+def test_split_returns_each_jobs_outputs():
+    outputs = {'b0_9': ['a_1.png', 'a_2.png'], 'b2_9': ['c_1.png']}
+    assert split_outputs(outputs, [['b0_9'], ['b1_9'], ['b2_9']]) == [['a_1.png', 'a_2.png'], None, ['c_1.png']]
+
+
+def test_any_workflows_share_a_key():
+    keys = {batch_key(job_graph(name, i)) for i, name in enumerate(['creative_edit', 'apply_pattern', 'color_swap'])}
+    assert len(keys) == 1
+    other = job_graph('creative_edit', 0)
+    other['37'] = dict(other['37'], inputs=dict(other['37']['inputs'], unet_name='other.safetensors'))
+    assert batch_key(other) not in keys
+
+
+def test_batcher_runs_one_prompt_per_group(worker_app):
+    async def main():
+        batcher = MicroBatcher(window_ms=100, max_batch=3, slots=3)
+        graphs = [job_graph('creative_edit', i) for i in range(3)]
+        results = await asyncio.gather(*(batcher.run(batch_key(g), g) for g in graphs))
+        return batcher, results
+    batcher, results = asyncio.run(main())
+    assert fake_comfyui.counters['prompts'] == 1
+    assert results == [[f'edit_job{i}_00001_.png'] for i in range(3)]
+    assert batcher.stats()['avg_batch_size'] == 3
@@ -0,0 +1,72 @@
+"""Input normalization: orientation, downscale to the Kontext size, re-encode"""
+
+import asyncio
+import io
+
+from PIL import Image
+
+from worker import InputNormalizer, kontext_size, normalize_image
+
+
+def encoded(size, mode='RGB', fmt='PNG', orientation=None):
+    buffer = io.BytesIO()
+    img = Image.new(mode, size, 'red')
+    if orientation:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        img.save(buffer, fmt, exif=exif)
+    else:
+        img.save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def opened(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+
+def test_large_image_is_downscaled_but_covers_kontext_size():
+    out = opened(normalize_image(encoded((3000, 2000)), 'jpeg', 90))
+    target_w, target_h = kontext_size(3000, 2000)
+    assert out.format == 'JPEG'
+    assert out.width < 3000 and out.width >= target_w and out.height >= target_h
+    assert abs(out.width / out.height - 1.5) < 0.01
+
+
+def test_small_upright_image_is_left_alone():
+    assert normalize_image(encoded((512, 512)), 'png', 95) is None
+
+
+def test_exif_rotation_is_applied():
+    out = opened(normalize_image(encoded((300, 200), fmt='JPEG', orientation=6), 'png', 95))
+    assert out.size == (200, 300)
+    assert out.getexif().get(0x0112, 1) == 1
+
+
+def test_alpha_is_dropped_for_jpeg():
+    out = opened(normalize_image(encoded((3000, 3000), mode='RGBA'), 'jpeg', 90))
+    assert out.mode == 'RGB'
+
+
+def test_normalizer_counts_and_falls_back():
+    normalizer = InputNormalizer(True, 'webp', 80)
+    small, large = encoded((64, 64)), encoded((3000, 2000))
+
+    async def main():
+        return [await normalizer.run(data) for data in (small, large, b'not an image')]
+    out_small, out_large, out_broken = asyncio.run(main())
+    assert out_small == small and out_broken == b'not an image'
+    assert opened(out_large).format == 'WEBP'
+    stats = normalizer.stats()
+    assert (stats['images'], stats['unchanged'], stats['errors']) == (2, 1, 1)
+    assert stats['bytes_in'] == len(small) + len(large)
+    assert stats['bytes_out'] == len(small) + len(out_large)
+
+
+def test_settings_change_names_and_hashes():
+    assert InputNormalizer(False, 'webp', 80).key == b''
+    assert InputNormalizer(False, 'webp', 80).extension == '.png'
+    enabled = InputNormalizer(True, 'webp', 80)
+    assert (enabled.extension, enabled.content_type) == ('.webp', 'image/webp')
+    assert enabled.key != InputNormalizer(True, 'webp', 90).key
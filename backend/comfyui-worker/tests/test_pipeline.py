@@ -0,0 +1,65 @@
+"""Pipelined input uploads: overlapped with each other and with the graph build"""
+
+import asyncio
+import base64
+import io
+import time
+
+import pytest
+from PIL import Image
+
+from worker import GenerateReq, UploadCache, decode_b64
+
+import fake_comfyui
+
+
+def png_b64(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture
+def pipeline_worker(worker_app, monkeypatch):
+    monkeypatch.setattr(worker_app, 'upload_cache', UploadCache(10, 10**6))
+    submitted = []
+    queue_prompt = worker_app.comfy.queue_prompt
+
+    async def recording(workflow):
+        submitted.append(workflow)
+        return await queue_prompt(workflow)
+    monkeypatch.setattr(worker_app.comfy, 'queue_prompt', recording)
+    monkeypatch.setattr(worker_app, 'submitted', submitted, raising=False)
+    return worker_app
+
+
+def run_two_image_job(worker, image1, image2):
+    r = GenerateReq(job_id='pipe', prompt='p', workflow_type='apply_pattern',
+                    image_base64=image1, image2_base64=image2)
+    started = time.perf_counter()
+    asyncio.run(worker.process_generate(r))
+    return time.perf_counter() - started
+
+
+@pytest.mark.parametrize('pipelined', [True, False])
+def test_uploads_overlap_when_pipelined(pipeline_worker, monkeypatch, pipelined):
+    monkeypatch.setattr(pipeline_worker, 'PIPELINE_UPLOADS', pipelined)
+    fake_comfyui.app.state.upload_seconds = 0.3
+    elapsed = run_two_image_job(pipeline_worker, png_b64('red'), png_b64('blue'))
+    assert fake_comfyui.counters['uploads'] == 2
+    [graph] = pipeline_worker.submitted
+    assert all(name in graph for name in fake_comfyui.uploads)
+    assert (elapsed < 0.55) if pipelined else (elapsed >= 0.6)
+
+
+def test_graph_is_rebuilt_with_cached_names(pipeline_worker, monkeypatch):
+    monkeypatch.setattr(pipeline_worker, 'PIPELINE_UPLOADS', True)
+    image1 = png_b64('red')
+    # A multipart upload of the same bytes left them in ComfyUI under another name
+    _, digest = decode_b64(image1, pipeline_worker.normalizer.key)
+    pipeline_worker.upload_cache.put(digest, 'input_from_multipart.png', 100)
+    run_two_image_job(pipeline_worker, image1, png_b64('blue'))
+    [graph] = pipeline_worker.submitted
+    assert 'input_from_multipart.png' in graph
+    assert pipeline_worker.input_name(digest) not in graph
+    assert fake_comfyui.counters['uploads'] == 1
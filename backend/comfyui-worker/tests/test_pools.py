@@ -0,0 +1,23 @@
+"""HTTPPool usage stats against the fake ComfyUI"""
+
+import asyncio
+
+from comfyui_api import HTTPPool
+
+
+def test_stats_count_open_idle_and_in_use(fake_comfyui_url):
+    async def main():
+        pool = HTTPPool('test', max_connections=2)
+        try:
+            async with pool.client.stream('GET', f'{fake_comfyui_url}/system_stats') as response:
+                during = pool.stats()
+                await response.aread()
+            await asyncio.gather(*(pool.client.get(f'{fake_comfyui_url}/system_stats') for _ in range(4)))
+            return during, pool.stats()
+        finally:
+            await pool.aclose()
+    during, after = asyncio.run(main())
+    assert during['in_use'] == 1 and during['open'] == 1 and during['idle'] == 0
+    assert after['in_use'] == 0 and after['peak_in_use'] == 4
+    assert after['requests'] == 5 and after['waits'] == 2
+    assert after['open'] == after['idle'] == 2
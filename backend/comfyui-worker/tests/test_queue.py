@@ -0,0 +1,53 @@
+"""Job queue admission: depth limit, reserved slots, multipart uploads"""
+
+import asyncio
+import json
+
+import httpx
+
+from worker import JobQueue
+
+import fake_comfyui
+
+
+def test_job_queue_rejects_when_full():
+    async def main():
+        queue = JobQueue(depth=2, concurrency=1)
+        accepted = [queue.submit(None, None) for _ in range(3)]
+        return queue, accepted
+    queue, accepted = asyncio.run(main())
+    assert accepted == [True, True, False]
+    assert queue.stats()['rejected'] == 1
+
+
+def test_reserved_slots_count_against_depth():
+    async def main():
+        queue = JobQueue(depth=2, concurrency=1)
+        assert queue.reserve()
+        assert queue.submit(None, None)
+        assert not queue.reserve() and not queue.submit(None, None)
+        assert queue.submit(None, None, reserved=True)
+        assert queue.stats()['reserved'] == 0 and queue.queue.qsize() == 2
+        queue.queue.get_nowait()
+        assert queue.reserve()
+        queue.release()
+        return queue
+    assert asyncio.run(main()).rejected == 2
+
+
+def test_upload_burst_is_admitted_up_to_depth(worker_app, monkeypatch):
+    fake_comfyui.app.state.upload_seconds = 0.2
+    monkeypatch.setattr(worker_app, 'jobs', JobQueue(depth=1, concurrency=1))
+
+    async def main():
+        transport = httpx.ASGITransport(app=worker_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://worker') as client:
+            async def post(i):
+                params = {'job_id': f'burst-{i}', 'prompt': 'test', 'webhook_url': 'http://webhook.test/cb'}
+                return await client.post('/generate/async/upload', data={'params': json.dumps(params)},
+                                         files={'image': (f'{i}.png', bytes([i]) * 64, 'image/png')})
+            return await asyncio.gather(*(post(i) for i in range(4)))
+    responses = asyncio.run(main())
+    assert sorted(r.status_code for r in responses) == [200, 429, 429, 429]
+    assert fake_comfyui.counters['uploads'] == 1
+    assert worker_app.jobs.stats()['reserved'] == 0
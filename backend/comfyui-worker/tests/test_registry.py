@@ -0,0 +1,59 @@
+"""WorkflowRegistry: validation and hot reload on mtime change"""
+
+import json
+import os
+
+import pytest
+
+from comfyui_api import WorkflowRegistry
+
+GRAPH = {
+    '1': {'class_type': 'LoadImage', 'inputs': {'image': 'in.png'}},
+    '2': {'class_type': 'SaveImage', 'inputs': {'images': ['1', 0], 'filename_prefix': 'v1'}},
+}
+
+
+def write(path, content, mtime):
+    path.write_text(content if isinstance(content, str) else json.dumps(content))
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def workflow_file(tmp_path):
+    path = tmp_path / 'flow.json'
+    write(path, GRAPH, 1000)
+    return path
+
+
+def prefix(workflow):
+    return workflow.graph['2']['inputs']['filename_prefix']
+
+
+def test_changed_file_is_reloaded(workflow_file):
+    registry = WorkflowRegistry(str(workflow_file.parent), check_interval=0).load_all()
+    assert prefix(registry.get('flow.json')) == 'v1'
+    write(workflow_file, {**GRAPH, '2': {**GRAPH['2'], 'inputs': {**GRAPH['2']['inputs'], 'filename_prefix': 'v2'}}}, 2000)
+    assert prefix(registry.get('flow.json')) == 'v2'
+    assert registry.stats()['reloads'] == 1
+
+
+def test_broken_edit_keeps_previous_version(workflow_file):
+    registry = WorkflowRegistry(str(workflow_file.parent), check_interval=0).load_all()
+    write(workflow_file, '{"2": {"class_type": "SaveImage"', 2000)
+    assert prefix(registry.get('flow.json')) == 'v1'
+    write(workflow_file, {'2': {'class_type': 'SaveImage', 'inputs': {'images': ['9', 0]}}}, 3000)
+    assert prefix(registry.get('flow.json')) == 'v1'
+    assert 'missing node 9' in registry.stats()['errors']['flow.json']
+    assert registry.stats()['reloads'] == 0
+
+
+def test_files_are_not_restated_within_the_interval(workflow_file):
+    registry = WorkflowRegistry(str(workflow_file.parent), check_interval=3600).load_all()
+    write(workflow_file, {**GRAPH, '3': {'class_type': 'Note', 'inputs': {}}}, 2000)
+    assert '3' not in registry.get('flow.json').graph
+
+
+def test_unknown_workflow_raises(tmp_path):
+    registry = WorkflowRegistry(str(tmp_path), check_interval=0).load_all()
+    with pytest.raises(KeyError):
+        registry.get('missing.json')
@@ -0,0 +1,82 @@
+"""Result cache: seeded duplicates are answered from disk instead of another prompt"""
+
+import asyncio
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from worker import GenerateReq, ResultCache, UploadCache
+
+import fake_comfyui
+
+
+def png_b64():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'green').save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture
+def cached_worker(worker_app, monkeypatch, tmp_path):
+    monkeypatch.setattr(worker_app, 'RESULT_CACHE_ENABLED', True)
+    monkeypatch.setattr(worker_app, 'result_cache', ResultCache(str(tmp_path), 10**8, 3600))
+    monkeypatch.setattr(worker_app, 'upload_cache', UploadCache(10, 10**6))
+    return worker_app
+
+
+def run_jobs(worker, seeds, concurrent=False):
+    image = png_b64()
+    requests = [GenerateReq(job_id=f'job-{i}', prompt='same prompt', image_base64=image, seed=seed)
+                for i, seed in enumerate(seeds)]
+
+    async def main():
+        if concurrent:
+            await asyncio.gather(*(worker.process_generate(r) for r in requests))
+        else:
+            for r in requests:
+                await worker.process_generate(r)
+    asyncio.run(main())
+    return worker.result_cache.stats()
+
+
+def test_seeded_repeat_hits_without_webhook(cached_worker):
+    stats = run_jobs(cached_worker, [7, 7])
+    assert (stats['stores'], stats['hits'], stats['misses']) == (1, 1, 1)
+    assert fake_comfyui.counters['prompts'] == 1
+
+
+def test_concurrent_duplicate_waits_for_the_first(cached_worker):
+    fake_comfyui.app.state.sample_seconds = 0.2
+    stats = run_jobs(cached_worker, [7, 7], concurrent=True)
+    assert (stats['stores'], stats['hits']) == (1, 1)
+    assert fake_comfyui.counters['prompts'] == 1
+    assert not cached_worker.result_cache.inflight
+
+
+def test_failed_job_lets_the_waiter_run(cached_worker):
+    fake_comfyui.app.state.fail_prompts = True
+    stats = run_jobs(cached_worker, [7, 7], concurrent=True)
+    assert stats['stores'] == 0 and stats['misses'] == 2
+    assert fake_comfyui.counters['prompts'] == 2
+
+
+def test_random_seed_jobs_skip_the_cache(cached_worker):
+    stats = run_jobs(cached_worker, [None, None])
+    assert (stats['stores'], stats['hits'], stats['misses']) == (0, 0, 0)
+    assert fake_comfyui.counters['prompts'] == 2
+
+
+def test_entries_survive_a_restart_and_expire(tmp_path):
+    cache = ResultCache(str(tmp_path), 10**6, 3600)
+    part = tmp_path / 'key.part'
+    part.mkdir()
+    (part / '0.png').write_bytes(b'image')
+    cache.commit('key', str(part))
+    reloaded = ResultCache(str(tmp_path), 10**6, 3600)
+    reloaded.load()
+    assert reloaded.get('key') == [b'image']
+    expired = ResultCache(str(tmp_path), 10**6, 0)
+    expired.load()
+    assert expired.get('key') is None and expired.evictions == 1
@@ -0,0 +1,30 @@
+"""Compiled workflow templates render the same graphs as the builders they replaced"""
+
+import json
+import os
+
+import pytest
+
+import worker
+
+# Graphs produced by the per-request builders before templates (30 cases, every workflow
+# with and without image2; prompts with quotes, newlines, backslashes and non-ASCII)
+with open(os.path.join(os.path.dirname(__file__), 'data', 'legacy_graphs.json')) as f:
+    LEGACY = json.load(f)
+
+
+@pytest.mark.parametrize('case', LEGACY, ids=lambda c: f"{c['workflow_type']}-{bool(c['params']['image2'])}")
+def test_template_matches_legacy_builder(case):
+    assert worker.build_workflow(case['workflow_type'], **case['params']) == case['graph']
+
+
+def test_render_is_valid_json_for_any_text():
+    params = dict(LEGACY[1]['params'], prompt='"}] \\u0022 @@seed@@', job_id='a"b\\c')
+    graph = json.loads(worker.render_workflow('creative_edit', **params))
+    assert graph['6']['inputs']['text'] == params['prompt']
+    assert any(node['inputs'].get('filename_prefix', '').endswith('a"b\\c') for node in graph.values())
+
+
+def test_unknown_workflow_falls_back_to_creative_edit():
+    params = LEGACY[0]['params']
+    assert worker.render_workflow('nope', **params) == worker.render_workflow('creative_edit', **params)
@@ -0,0 +1,53 @@
+"""Upload cache: content-addressed input uploads are skipped when ComfyUI has them"""
+
+import asyncio
+import base64
+import io
+
+from PIL import Image
+
+from worker import UploadCache
+
+import fake_comfyui
+
+
+def png_b64(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_same_image_is_uploaded_once(worker_app, monkeypatch):
+    monkeypatch.setattr(worker_app, 'upload_cache', UploadCache(10, 10**6))
+    image = png_b64('red')
+
+    async def main():
+        return [await worker_app.upload_image(image) for _ in range(2)]
+    first, second = asyncio.run(main())
+    assert first == second and first.startswith('input_')
+    assert fake_comfyui.counters['uploads'] == 1
+    assert worker_app.upload_cache.stats()['hits'] == 1
+
+
+def test_stale_entry_is_uploaded_again(worker_app, monkeypatch):
+    monkeypatch.setattr(worker_app, 'upload_cache', UploadCache(10, 10**6))
+    monkeypatch.setattr(worker_app, 'UPLOAD_CACHE_VERIFY_SECONDS', 0)
+    image = png_b64('blue')
+
+    async def main():
+        await worker_app.upload_image(image)
+        fake_comfyui.uploads.clear()  # ComfyUI restarted and lost its input folder
+        return await worker_app.upload_image(image)
+    assert asyncio.run(main()) in fake_comfyui.uploads
+    assert fake_comfyui.counters['uploads'] == 2
+    assert worker_app.upload_cache.stats()['stale'] == 1
+
+
+def test_eviction_by_count_and_bytes():
+    cache = UploadCache(max_entries=2, max_bytes=100)
+    cache.put('a', 'input_a.png', 40)
+    cache.put('b', 'input_b.png', 40)
+    cache.put('c', 'input_c.png', 40)
+    assert list(cache.entries) == ['b', 'c']
+    cache.put('d', 'input_d.png', 90)
+    assert list(cache.entries) == ['d'] and cache.total_bytes == 90
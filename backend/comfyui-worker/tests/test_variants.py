@@ -0,0 +1,56 @@
+"""n_variants: several images from one batched prompt"""
+
+import asyncio
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+import worker
+from worker import GenerateReq, UploadCache
+
+import fake_comfyui
+
+ARGS = dict(image1='input_a.png', image2=None, prompt='p', negative_prompt='', seed=1, steps=20,
+            guidance=2.5, structure_strength=0.5, width=1024, height=1024, job_id='j')
+
+
+def latent_batch(graph):
+    """(node class, batch size) of the latent the KSampler samples"""
+    source = graph[graph['31']['inputs']['latent_image'][0]]
+    return source['class_type'], source['inputs'].get('batch_size', source['inputs'].get('amount'))
+
+
+@pytest.mark.parametrize('workflow_type, batched_by', [
+    ('apply_pattern', 'EmptySD3LatentImage'),
+    ('batch_colorways', 'RepeatLatentBatch'),
+    ('creative_edit', 'RepeatLatentBatch'),
+])
+def test_n_variants_sets_the_latent_batch(workflow_type, batched_by):
+    assert latent_batch(worker.build_workflow(workflow_type, **ARGS, batch=3)) == (batched_by, 3)
+    single = worker.build_workflow(workflow_type, **ARGS)
+    assert 'batch' not in single and latent_batch(single)[1] in (1, None)
+
+
+def test_variant_count_defaults_to_one_and_is_capped():
+    assert worker.variant_count(None) == 1
+    assert worker.variant_count(3) == 3
+    assert worker.variant_count(10**6) == worker.MAX_VARIANTS
+
+
+@pytest.mark.parametrize('n_variants, images', [(None, 1), (3, 3)])
+def test_colorways_job_samples_n_variants(worker_app, monkeypatch, n_variants, images):
+    monkeypatch.setattr(worker_app, 'upload_cache', UploadCache(10, 10**6))
+    sent = []
+
+    async def record(webhook_url, job_id, filenames, success, **kwargs):
+        sent.append(filenames)
+    monkeypatch.setattr(worker_app, 'send_callback', record)
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'white').save(buffer, 'PNG')
+    r = GenerateReq(job_id='colorways', prompt='p', workflow_type='batch_colorways', n_variants=n_variants,
+                    image_base64=base64.b64encode(buffer.getvalue()).decode(), webhook_url='http://webhook.test')
+    asyncio.run(worker_app.process_generate(r))
+    assert len(sent[0]) == images
+    assert fake_comfyui.counters['prompts'] == 1
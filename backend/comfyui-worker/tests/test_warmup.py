@@ -0,0 +1,38 @@
+"""Model warm-up: ready, failed graph, and ComfyUI never coming up"""
+
+import asyncio
+
+import fake_comfyui
+from comfyui_api import ComfyUIClient
+
+
+def test_warmup_loads_models(worker_app):
+    fake_comfyui.app.state.models_loaded, fake_comfyui.app.state.model_load_seconds = False, 0.2
+    warmup = worker_app.WarmUp(True)
+    assert warmup.state == 'warming' and not warmup.models_loaded
+    asyncio.run(warmup.run())
+    assert warmup.state == 'ready' and warmup.error is None
+    assert warmup.seconds >= 0.2
+    assert fake_comfyui.app.state.models_loaded
+    assert fake_comfyui.counters['prompts'] == 1
+
+
+def test_failed_warmup_graph_still_serves_jobs(worker_app):
+    fake_comfyui.app.state.fail_prompts = True
+    warmup = worker_app.WarmUp(True)
+    asyncio.run(warmup.run())
+    assert warmup.state == 'ready' and warmup.error
+    assert not warmup.models_loaded
+
+
+def test_unreachable_comfyui_fails_after_timeout(worker_app, monkeypatch):
+    monkeypatch.setattr(worker_app, 'comfy', ComfyUIClient('http://127.0.0.1:9', ws_enabled=False))
+    monkeypatch.setattr(worker_app, 'WARMUP_TIMEOUT_SECONDS', 0.3)
+    warmup = worker_app.WarmUp(True)
+    asyncio.run(warmup.run())
+    assert warmup.state == 'failed'
+    assert warmup.error == 'Timed out after 0.3s'
+
+
+def test_disabled_warmup_is_ready(worker_app):
+    assert worker_app.WarmUp(False).state == 'ready'
@@ -20,16 +20,161 @@ Run on Vast.ai:
 4. In another terminal: npx localtunnel --port 8000 --subdomain textile-gpu-worker
 """
 
-from fastapi import FastAPI, BackgroundTasks
-from pydantic import BaseModel
-from typing import Optional, Literal
-import httpx, base64, asyncio, random
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from pydantic import BaseModel, ValidationError
+from typing import Optional, Literal, List
+import httpx, base64, binascii, asyncio, random, os, io, json, uuid, math, time, functools, hashlib, re, shutil, heapq, itertools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image, ImageOps
 import uvicorn
 
-app = FastAPI()
-COMFYUI = 'http://localhost:18188'
+from comfyui_api import COMFYUI_URL, ComfyUIClient, HTTPPool, get_registry
+
+# Module body cost (config, template compilation), reported at startup and on /stats
+IMPORT_STARTED = time.perf_counter()
+
+COMFYUI = COMFYUI_URL  # COMFYUI_URL env, shared with comfyui_api
 API_SECRET = 'my-secret-key-123'
 
+# Completion tracking: ComfyUI /ws events, with /history polling as fallback
+COMFYUI_WS_ENABLED = os.getenv('COMFYUI_WS_ENABLED', '1') == '1'
+HISTORY_POLL_SECONDS = float(os.getenv('HISTORY_POLL_SECONDS', '2'))
+CLIENT_ID = uuid.uuid4().hex
+
+# Admission control: jobs beyond JOB_QUEUE_DEPTH are rejected with 429
+JOB_QUEUE_DEPTH = int(os.getenv('JOB_QUEUE_DEPTH', '16'))
+JOB_CONCURRENCY = int(os.getenv('JOB_CONCURRENCY', '2'))
+
+# Cross-job micro-batching: hold jobs up to MICROBATCH_WINDOW_MS and merge
+# compatible ones (up to MICROBATCH_MAX) into one ComfyUI prompt; 0 disables.
+# Batched jobs wait in job runner slots, so batches are capped at JOB_CONCURRENCY
+MICROBATCH_WINDOW_MS = float(os.getenv('MICROBATCH_WINDOW_MS', '0'))
+MICROBATCH_MAX = int(os.getenv('MICROBATCH_MAX', '4'))
+
+# Upper bound on n_variants per request (one batched prompt)
+MAX_VARIANTS = int(os.getenv('MAX_VARIANTS', '8'))
+
+# Upload both input images at once and build the graph meanwhile (0 = one after another)
+PIPELINE_UPLOADS = os.getenv('PIPELINE_UPLOADS', '1') == '1'
+
+# Input normalization (off by default): decode on the CPU, apply EXIF orientation, downscale
+# to the Kontext resolution and re-encode before upload, in the CPU executor.
+# NORMALIZE_FORMAT: 'png' (fast lossless), 'jpeg' or 'webp' (NORMALIZE_QUALITY)
+NORMALIZE_INPUTS = os.getenv('NORMALIZE_INPUTS', '0') == '1'
+NORMALIZE_FORMAT = os.getenv('NORMALIZE_FORMAT', 'png')
+NORMALIZE_QUALITY = int(os.getenv('NORMALIZE_QUALITY', '95'))
+
+# CPU-bound work (base64, hashing, JSON bodies, image processing) runs in a 'thread' or
+# 'process' pool instead of on the event loop; inputs under CPU_OFFLOAD_MIN_BYTES stay inline
+CPU_EXECUTOR = os.getenv('CPU_EXECUTOR', 'thread')
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', str(min(4, os.cpu_count() or 1))))
+CPU_OFFLOAD_MIN_BYTES = int(os.getenv('CPU_OFFLOAD_MIN_BYTES', str(64 * 1024)))
+
+# Event-loop lag monitor: a ticker every LOOP_LAG_INTERVAL_MS; waking up more than
+# LOOP_LAG_THRESHOLD_MS late is recorded as a stall
+LOOP_LAG_INTERVAL_MS = float(os.getenv('LOOP_LAG_INTERVAL_MS', '100'))
+LOOP_LAG_THRESHOLD_MS = float(os.getenv('LOOP_LAG_THRESHOLD_MS', '50'))
+
+# Multipart ingest streams uploads to ComfyUI in chunks of this size
+UPLOAD_CHUNK_BYTES = int(os.getenv('UPLOAD_CHUNK_BYTES', str(256 * 1024)))
+
+# Content-addressed upload cache: repeat input images reuse the file ComfyUI holds
+UPLOAD_CACHE_MAX_ENTRIES = int(os.getenv('UPLOAD_CACHE_MAX_ENTRIES', '512'))
+UPLOAD_CACHE_MAX_BYTES = int(os.getenv('UPLOAD_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+UPLOAD_CACHE_VERIFY_SECONDS = float(os.getenv('UPLOAD_CACHE_VERIFY_SECONDS', '60'))
+
+# Result cache: identical graphs (same inputs, prompt, seed, ...) reuse stored outputs
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', '1') == '1'
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', '/tmp/textile-result-cache')
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(1024 ** 3)))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv('RESULT_CACHE_TTL_SECONDS', str(24 * 3600)))
+
+# Warm-up: queue a tiny 1-step graph at startup so models are loaded before the first job
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', '1') == '1'
+WARMUP_TIMEOUT_SECONDS = int(os.getenv('WARMUP_TIMEOUT_SECONDS', '600'))
+
+# Result delivery to the webhook: 'json' (base64 in the body), 'multipart' or 'raw'
+# (image bytes streamed from ComfyUI), 'url' (image put in the object store, URL sent)
+DELIVERY_MODE = os.getenv('DELIVERY_MODE', 'json')
+OBJECT_STORE_DIR = os.getenv('OBJECT_STORE_DIR', '/tmp/textile-results')
+OBJECT_STORE_BASE_URL = os.getenv('OBJECT_STORE_BASE_URL', 'http://localhost:8000/results')
+OBJECT_STORE_TTL_SECONDS = float(os.getenv('OBJECT_STORE_TTL_SECONDS', str(24 * 3600)))
+
+# Connection pool sizing (one pool for ComfyUI, one for webhook destinations)
+COMFYUI_MAX_CONNECTIONS = int(os.getenv('COMFYUI_MAX_CONNECTIONS', '20'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '10'))
+POOL_KEEPALIVE_SECONDS = float(os.getenv('POOL_KEEPALIVE_SECONDS', '30'))
+
+# Callbacks are spooled to disk and retried with jittered exponential backoff until the
+# webhook accepts them; CALLBACK_BATCH_MAX > 1 merges callbacks that carry no image bytes
+CALLBACK_SPOOL_DIR = os.getenv('CALLBACK_SPOOL_DIR', '/tmp/textile-callbacks')
+CALLBACK_MAX_ATTEMPTS = int(os.getenv('CALLBACK_MAX_ATTEMPTS', '8'))
+CALLBACK_BACKOFF_SECONDS = float(os.getenv('CALLBACK_BACKOFF_SECONDS', '1'))
+CALLBACK_BACKOFF_MAX_SECONDS = float(os.getenv('CALLBACK_BACKOFF_MAX_SECONDS', '300'))
+CALLBACK_CONCURRENCY = int(os.getenv('CALLBACK_CONCURRENCY', str(WEBHOOK_MAX_CONNECTIONS)))
+CALLBACK_BATCH_MAX = int(os.getenv('CALLBACK_BATCH_MAX', '1'))
+CALLBACK_BATCH_WINDOW_MS = float(os.getenv('CALLBACK_BATCH_WINDOW_MS', '200'))
+
+# =============================================================================
+# CONNECTION POOLS (ComfyUI traffic goes through `comfy`, webhooks through this pool)
+# =============================================================================
+
+POOLS = {}
+
+def get_pool(name):
+    """Return the named pool, creating it on first use outside the app lifespan"""
+    if name not in POOLS:
+        POOLS[name] = HTTPPool(name, WEBHOOK_MAX_CONNECTIONS, keepalive=POOL_KEEPALIVE_SECONDS)
+    return POOLS[name]
+
+def webhook_client():
+    return get_pool('webhook').client
+
+@asynccontextmanager
+async def lifespan(app):
+    print(f"⏱️ Worker module loaded in {IMPORT_SECONDS * 1000:.0f} ms "
+          f"(templates {TEMPLATE_COMPILE_SECONDS * 1000:.0f} ms)")
+    await asyncio.to_thread(get_registry)
+    comfy.start()
+    get_pool('webhook')
+    print(f"🔌 HTTP pools ready (comfyui={COMFYUI_MAX_CONNECTIONS}, webhook={WEBHOOK_MAX_CONNECTIONS})")
+    if RESULT_CACHE_ENABLED:
+        await asyncio.to_thread(result_cache.load)
+    await asyncio.to_thread(callbacks.load)
+    callbacks.start()
+    if MICROBATCH_WINDOW_MS > 0 and batcher.configured_max > batcher.max_batch:
+        print(f"⚠️ MICROBATCH_MAX={batcher.configured_max} but JOB_CONCURRENCY={JOB_CONCURRENCY}: "
+              f"batches are capped at {batcher.max_batch} (raise JOB_CONCURRENCY to batch more)")
+    cpu.start()
+    lag_monitor.start()
+    jobs.start()
+    warmup_task = asyncio.create_task(warmup.run()) if WARMUP_ENABLED else None
+    try:
+        yield
+    finally:
+        await jobs.stop()
+        await callbacks.stop()
+        await lag_monitor.stop()
+        cpu.stop()
+        if warmup_task:
+            warmup_task.cancel()
+            try:
+                await warmup_task
+            except asyncio.CancelledError:
+                pass
+        await comfy.aclose()
+        for pool in list(POOLS.values()):
+            await pool.aclose()
+        POOLS.clear()
+
+app = FastAPI(lifespan=lifespan)
+
 # Aspect ratio to dimensions for EmptySD3LatentImage
 ASPECT_SIZES = {
     "1:1": (1024, 1024),
@@ -41,10 +186,9 @@ ASPECT_SIZES = {
     "2:3": (832, 1216),
 }
 
-class GenerateReq(BaseModel):
+class GenerateParams(BaseModel):
+    """Generation settings shared by the JSON and multipart endpoints"""
     job_id: str
-    image_base64: str
-    image2_base64: Optional[str] = None
     prompt: str
     negative_prompt: Optional[str] = ""
     seed: Optional[int] = None
@@ -56,64 +200,896 @@ class GenerateReq(BaseModel):
     output_format: Optional[str] = "png"
     steps: Optional[int] = 25
     workflow_type: Optional[str] = "creative_edit"  # NEW!
+    n_variants: Optional[int] = None  # images from one batched prompt (1 if unset)
     webhook_url: Optional[str] = None
 
+class GenerateReq(GenerateParams):
+    image_base64: str
+    image2_base64: Optional[str] = None
+
 class UpscaleReq(BaseModel):
     job_id: str
     image_filename: str
     webhook_url: Optional[str] = None
 
+# =============================================================================
+# METRICS (Prometheus text exposition, no client library needed)
+# =============================================================================
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+def escape_label(value):
+    """Escape a label value as the text exposition format requires (backslash, quote, newline)"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in labels) + '}'
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a sorted label tuple"""
+
+    def __init__(self, name, help_text, buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, series in self.series.items():
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{format_labels(key + (("le", bound),))} {count}')
+            lines.append(f'{self.name}_bucket{format_labels(key + (("le", "+Inf"),))} {series[-1]}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{format_labels(key)} {series[-1]}')
+        return lines
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.series = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{format_labels(key)} {value}' for key, value in self.series.items()]
+        return lines
+
+def render_gauge(name, help_text, value):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+
+STAGE_SECONDS = Histogram('worker_stage_seconds',
+    'Time spent per job stage (decode, upload, graph_build, queue_wait, submit, sampling, cache_store, download, webhook)')
+JOBS_TOTAL = Counter('worker_jobs_total', 'Finished jobs by workflow and outcome')
+
+# Labels of the job the current task is working on
+job_labels = ContextVar('job_labels', default={'workflow_type': 'none', 'aspect_ratio': 'none'})
+
+def labels_for(req):
+    """Job labels, mapped to the values the job actually runs with so clients cannot add series"""
+    if not hasattr(req, 'workflow_type'):
+        return {'workflow_type': 'upscale', 'aspect_ratio': 'none'}
+    workflow_type = req.workflow_type if req.workflow_type in WORKFLOW_TEMPLATES else 'creative_edit'
+    aspect_ratio = req.aspect_ratio if req.aspect_ratio in ASPECT_SIZES else '1:1'
+    return {'workflow_type': workflow_type, 'aspect_ratio': aspect_ratio}
+
+def observe_stage(name, seconds):
+    STAGE_SECONDS.observe(seconds, stage=name, **job_labels.get())
+
+TIME_TO_PROMPT = Histogram('worker_time_to_prompt_seconds',
+    'Job start to ComfyUI prompt_id (decode, uploads, graph build, submit)')
+COMFYUI_CALL_SECONDS = Histogram('worker_comfyui_call_seconds', 'ComfyUI API call latency by call')
+
+def observe_comfyui_call(name, seconds):
+    COMFYUI_CALL_SECONDS.observe(seconds, call=name)
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block into worker_stage_seconds{stage=name} for the current job"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+comfy = ComfyUIClient(COMFYUI, CLIENT_ID, max_connections=COMFYUI_MAX_CONNECTIONS,
+                      keepalive=POOL_KEEPALIVE_SECONDS, ws_enabled=COMFYUI_WS_ENABLED,
+                      poll_interval=HISTORY_POLL_SECONDS, on_call=observe_comfyui_call)
+
+# =============================================================================
+# JOB QUEUE (bounded depth, fixed concurrency)
+# =============================================================================
+
+class JobQueue:
+    """Bounded asyncio queue drained by a fixed number of runner tasks"""
+
+    def __init__(self, depth, concurrency):
+        self.queue = asyncio.Queue(maxsize=depth)
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.reserved = 0  # slots held by requests still uploading their inputs
+        self.avg_job_seconds = 30.0  # EWMA, seeded with a typical FLUX run
+        self.runners = []
+
+    def full(self):
+        return self.queue.qsize() + self.reserved >= self.queue.maxsize
+
+    def reserve(self):
+        """Hold a slot for a job that has work to do before submit(); False when full"""
+        if self.full():
+            self.rejected += 1
+            return False
+        self.reserved += 1
+        return True
+
+    def release(self):
+        """Give back a reserved slot whose job was never submitted"""
+        self.reserved -= 1
+
+    def submit(self, func, req, reserved=False):
+        """Enqueue func(req) (into its reserved slot if `reserved`); returns False when the queue is full"""
+        if reserved:
+            self.release()
+        elif self.full():
+            self.rejected += 1
+            return False
+        self.queue.put_nowait((func, req, time.monotonic()))
+        return True
+
+    def estimated_wait(self):
+        ahead = self.queue.qsize() + self.reserved + self.in_flight
+        return ahead * self.avg_job_seconds / max(self.concurrency, 1)
+
+    async def runner(self):
+        while True:
+            func, req, enqueued_at = await self.queue.get()
+            self.in_flight += 1
+            started = time.monotonic()
+            job_labels.set(labels_for(req))
+            observe_stage('queue_wait', started - enqueued_at)
+            try:
+                await func(req)
+            except Exception as e:
+                print(f"❌ Job runner error: {e}")
+            finally:
+                self.in_flight -= 1
+                self.completed += 1
+                elapsed = time.monotonic() - started
+                self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+                self.queue.task_done()
+
+    def start(self):
+        self.runners = [asyncio.create_task(self.runner()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self.runners:
+            task.cancel()
+        await asyncio.gather(*self.runners, return_exceptions=True)
+        self.runners = []
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'max_depth': self.queue.maxsize,
+            'in_flight': self.in_flight,
+            'reserved': self.reserved,
+            'concurrency': self.concurrency,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_job_seconds': round(self.avg_job_seconds, 2),
+            'estimated_wait_seconds': round(self.estimated_wait(), 1),
+        }
+
+jobs = JobQueue(JOB_QUEUE_DEPTH, JOB_CONCURRENCY)
+
+def queue_full_response(job_id):
+    retry_after = max(1, math.ceil(jobs.estimated_wait()))
+    print(f"🚫 Queue full, rejecting {job_id} (retry in {retry_after}s)")
+    return JSONResponse(status_code=429, headers={'Retry-After': str(retry_after)},
+                        content={'success': False, 'job_id': job_id, 'error': 'Queue full',
+                                 'retry_after': retry_after})
+
 @app.get('/health')
 async def health():
-    return {'status': 'healthy', 'workflows': list(WORKFLOW_BUILDERS.keys())}
+    return {
+        'status': 'healthy',
+        'state': warmup.state,
+        'comfyui': await comfy.is_up(),
+        'models_loaded': warmup.models_loaded,
+        'warmup_seconds': warmup.seconds,
+        'workflows': list(WORKFLOW_BUILDERS.keys()),
+    }
+
+@app.get('/stats')
+async def stats():
+    return {
+        'pools': {'comfyui': comfy.pool.stats() if comfy.pool else None,
+                  **{name: pool.stats() for name, pool in POOLS.items()}},
+        'events': comfy.events.stats(),
+        'comfyui_calls': {name: stats.as_dict() for name, stats in comfy.calls.items()},
+        'queue': jobs.stats(),
+        'upload_cache': upload_cache.stats(),
+        'normalize': normalizer.stats(),
+        'cpu': cpu.stats(),
+        'loop_lag': lag_monitor.stats(),
+        'result_cache': result_cache.stats(),
+        'microbatch': batcher.stats(),
+        'callbacks': callbacks.stats(),
+        'startup': {
+            'import_ms': round(IMPORT_SECONDS * 1000, 1),
+            'template_compile_ms': round(TEMPLATE_COMPILE_SECONDS * 1000, 1),
+            'workflow_files': get_registry().stats(),
+        },
+    }
+
+@app.get('/metrics')
+async def metrics():
+    lines = STAGE_SECONDS.render() + JOBS_TOTAL.render()
+    lines += TIME_TO_PROMPT.render() + LOOP_LAG_SECONDS.render() + LOOP_STALLS_TOTAL.render()
+    lines += COMFYUI_CALL_SECONDS.render() + CALLBACK_DELIVERY_SECONDS.render() + CALLBACKS_TOTAL.render()
+    lines += render_gauge('worker_queue_depth', 'Jobs waiting in the worker queue', jobs.queue.qsize())
+    lines += render_gauge('worker_jobs_in_flight', 'Jobs currently being processed', jobs.in_flight)
+    lines += render_gauge('worker_upload_cache_hit_rate', 'Upload cache hit rate', upload_cache.stats()['hit_rate'])
+    lines += render_gauge('worker_result_cache_hit_rate', 'Result cache hit rate', result_cache.stats()['hit_rate'])
+    lines += render_gauge('worker_callback_backlog', 'Callbacks waiting for the webhook', len(callbacks.entries))
+    lines += render_gauge('worker_callback_oldest_seconds', 'Age of the oldest undelivered callback',
+                          round(callbacks.oldest_seconds(), 3))
+    return PlainTextResponse('\n'.join(lines) + '\n', media_type='text/plain; version=0.0.4')
+
+@app.get('/queue')
+async def queue_status():
+    return jobs.stats()
 
 @app.post('/generate/async')
-async def generate(r: GenerateReq, bg: BackgroundTasks):
+async def generate(r: GenerateReq):
     print(f"📥 Job {r.job_id}")
     print(f"   workflow={r.workflow_type}, prompt={r.prompt[:40]}...")
     print(f"   guidance={r.guidance}, steps={r.steps}, structure={r.structure_strength}")
     print(f"   has_image2={bool(r.image2_base64)}, aspect={r.aspect_ratio}")
-    bg.add_task(process_generate, r)
-    return {'success': True, 'job_id': r.job_id}
+    if not jobs.submit(process_generate, r):
+        return queue_full_response(r.job_id)
+    return {'success': True, 'job_id': r.job_id, 'queue_depth': jobs.queue.qsize()}
+
+@app.post('/generate/async/upload')
+async def generate_upload(params: str = Form(...), image: UploadFile = File(...),
+                          image2: Optional[UploadFile] = File(None)):
+    """Multipart variant of /generate/async: raw image files instead of base64.
+
+    `params` is the GenerateReq JSON without the image fields. Files are streamed
+    to ComfyUI before the job is queued, so nothing is base64 decoded or held
+    in memory as a whole.
+    """
+    # Bad params get the same 422 FastAPI returns for an invalid /generate/async body
+    try:
+        fields = json.loads(params)
+    except json.JSONDecodeError as e:
+        raise RequestValidationError([{'type': 'json_invalid', 'loc': ('body', 'params'), 'msg': str(e)}])
+    if not isinstance(fields, dict):
+        raise RequestValidationError([{'type': 'dict_type', 'loc': ('body', 'params'),
+                                       'msg': 'params must be a JSON object'}])
+    try:
+        r = GenerateParams(**fields)
+    except ValidationError as e:
+        raise RequestValidationError([dict(error, loc=('body', 'params', *error['loc'])) for error in e.errors()])
+    print(f"📥 Job {r.job_id} (multipart)")
+    print(f"   workflow={r.workflow_type}, prompt={r.prompt[:40]}...")
+    print(f"   has_image2={image2 is not None}, aspect={r.aspect_ratio}")
+    # Hold the queue slot while uploading, so a burst of uploads can't overrun the queue
+    if not jobs.reserve():
+        return queue_full_response(r.job_id)
+    try:
+        job_labels.set(labels_for(r))
+        uploaded1 = await upload_file(image)
+        uploaded2 = None
+        if image2 is not None:
+            uploaded2 = await upload_file(image2)
+    except BaseException:
+        jobs.release()
+        raise
+    print(f"📤 Streamed: {uploaded1}" + (f", {uploaded2}" if uploaded2 else ""))
+
+    task = functools.partial(process_generate, uploaded1=uploaded1, uploaded2=uploaded2)
+    jobs.submit(task, r, reserved=True)
+    return {'success': True, 'job_id': r.job_id, 'queue_depth': jobs.queue.qsize()}
 
 @app.post('/upscale/async')
-async def upscale(r: UpscaleReq, bg: BackgroundTasks):
+async def upscale(r: UpscaleReq):
     print(f"🔍 Upscale job {r.job_id}: {r.image_filename}")
-    bg.add_task(process_upscale, r)
-    return {'success': True, 'job_id': r.job_id}
-
-async def upload_image(img_b64: str, filename: str) -> str:
-    img = base64.b64decode(img_b64)
-    async with httpx.AsyncClient(timeout=30.0) as c:
-        resp = await c.post(f'{COMFYUI}/upload/image',
-            files={'image': (filename, img, 'image/png')},
-            data={'overwrite': 'true'})
-        result = resp.json()
-        return result.get('name', filename)
-
-async def process_generate(r: GenerateReq):
+    if not jobs.submit(process_upscale, r):
+        return queue_full_response(r.job_id)
+    return {'success': True, 'job_id': r.job_id, 'queue_depth': jobs.queue.qsize()}
+
+@app.get('/results/{key}')
+async def result_file(key: str):
+    """Serve the local object store for DELIVERY_MODE=url (keys are unguessable)"""
+    path = object_store.path(key)
+    if not os.path.isfile(path):
+        return JSONResponse({'error': 'not found'}, status_code=404)
+    return FileResponse(path, media_type='image/png')
+
+# =============================================================================
+# CPU OFFLOAD (executor for base64/hash/image work, event-loop lag monitor)
+# =============================================================================
+
+class CPUExecutor:
+    """Thread or process pool for CPU-bound work, so the event loop keeps serving requests.
+
+    Threads suit hashing and Pillow, which release the GIL; base64 and JSON hold it,
+    so 'process' keeps the loop free at the cost of pickling arguments and results.
+    Functions run here must be module-level so a process pool can pickle them.
+    """
+
+    def __init__(self, kind, workers, min_bytes):
+        self.kind = kind
+        self.workers = workers
+        self.min_bytes = min_bytes
+        self.executor = None
+        self.calls = {}  # function name -> [offloaded, inline, seconds]
+
+    def start(self):
+        if self.executor is None:
+            pool = ProcessPoolExecutor if self.kind == 'process' else ThreadPoolExecutor
+            self.executor = pool(max_workers=self.workers)
+            print(f"🧮 CPU executor: {self.workers} {self.kind} workers")
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, fn, *args, size=None):
+        """fn(*args) in the pool; inline when `size` (input bytes) is under min_bytes"""
+        started = time.perf_counter()
+        offload = size is None or size >= self.min_bytes
+        if offload:
+            self.start()
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        else:
+            result = fn(*args)
+        calls = self.calls.setdefault(fn.__name__, [0, 0, 0.0])
+        calls[0 if offload else 1] += 1
+        calls[2] += time.perf_counter() - started
+        return result
+
+    def stats(self):
+        return {
+            'executor': self.kind,
+            'workers': self.workers,
+            'min_bytes': self.min_bytes,
+            'calls': {name: {'offloaded': offloaded, 'inline': inline,
+                             'avg_ms': round(seconds / (offloaded + inline) * 1000, 2)}
+                      for name, (offloaded, inline, seconds) in self.calls.items()},
+        }
+
+cpu = CPUExecutor(CPU_EXECUTOR, CPU_WORKERS, CPU_OFFLOAD_MIN_BYTES)
+
+# base64 runs in slices of this many bytes: the C call holds the GIL, so a pool
+# thread hands it back to the event loop between slices instead of once per image
+B64_SLICE_BYTES = 3 * 256 * 1024
+
+def decode_b64(img_b64: str, key: bytes = b''):
+    """base64 → (bytes, content hash); runs in the CPU executor"""
+    step = B64_SLICE_BYTES // 3 * 4
+    try:
+        img = b''.join(base64.b64decode(img_b64[i:i + step], validate=True)
+                       for i in range(0, len(img_b64), step))
+    except binascii.Error:
+        img = base64.b64decode(img_b64)  # stray whitespace etc. shifts the slices: decode leniently
+    return img, content_hash(img, key)
+
+def json_callback(payload: dict, images: List[bytes]) -> bytes:
+    """JSON callback body with the images base64-encoded into image_base64 / images_base64.
+
+    The base64 is spliced in as bytes (it needs no JSON escaping), so multi-MB strings
+    are never built or scanned by json.dumps. Runs in the CPU executor.
+    """
+    encoded = [b''.join(base64.b64encode(view[i:i + B64_SLICE_BYTES])
+                        for i in range(0, len(view), B64_SLICE_BYTES))
+               for view in map(memoryview, images)]
+    parts = [json.dumps(payload)[:-1].encode()]
+    if encoded:
+        parts += [b', "image_base64": "', encoded[0], b'"']
+    if len(encoded) > 1:
+        parts += [b', "images_base64": ["', b'", "'.join(encoded), b'"]']
+    parts.append(b'}')
+    return b''.join(parts)
+
+LOOP_LAG_SECONDS = Histogram('worker_event_loop_lag_seconds',
+    'How late the event loop ran a timer (time it was blocked by synchronous work)')
+LOOP_STALLS_TOTAL = Counter('worker_event_loop_stalls_total', 'Event loop lags above LOOP_LAG_THRESHOLD_MS')
+
+class LoopLagMonitor:
+    """Sleeps `interval` in a loop; every bit it wakes up late is time the loop was blocked"""
+
+    def __init__(self, interval_ms, threshold_ms):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self.task = None
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self.max_lag = 0.0
+        self.last_stall = None
+
+    def start(self):
+        if self.task is None and self.interval > 0:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                self.stalled_seconds += lag
+                self.last_stall = time.time()
+                LOOP_STALLS_TOTAL.inc()
+                print(f"🐢 Event loop stalled {lag * 1000:.0f} ms")
+
+    def stats(self):
+        return {
+            'interval_ms': self.interval * 1000,
+            'threshold_ms': self.threshold * 1000,
+            'stalls': self.stalls,
+            'stalled_ms': round(self.stalled_seconds * 1000, 1),
+            'max_lag_ms': round(self.max_lag * 1000, 1),
+            'last_stall_ago_s': round(time.time() - self.last_stall, 1) if self.last_stall else None,
+        }
+
+lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL_MS, LOOP_LAG_THRESHOLD_MS)
+
+# =============================================================================
+# INPUT NORMALIZATION (CPU-side orient/downscale/re-encode before upload)
+# =============================================================================
+
+NORMALIZE_CODECS = {
+    'png': ('PNG', '.png', 'image/png'),
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+    'webp': ('WEBP', '.webp', 'image/webp'),
+}
+
+# Longest Kontext edge; JPEG decode can be downscaled (DCT scaling) to no less than this
+KONTEXT_MAX_EDGE = max(max(size) for size in ASPECT_SIZES.values())
+
+def kontext_size(width, height):
+    """ASPECT_SIZES entry closest to the image's own aspect ratio, as FluxKontextImageScale picks"""
+    ratio = width / height
+    return min(ASPECT_SIZES.values(), key=lambda size: abs(math.log(size[0] / size[1] / ratio)))
+
+def normalize_image(data: bytes, fmt: str = NORMALIZE_FORMAT, quality: int = NORMALIZE_QUALITY):
+    """Orient, downscale and re-encode one image; None if it is already upright and small enough.
+
+    The result still covers the Kontext size for its aspect ratio, so ComfyUI's rescale
+    only trims the last few pixels. Module-level so a process pool can pickle it.
+    """
+    codec, _, _ = NORMALIZE_CODECS[fmt]
+    with Image.open(io.BytesIO(data)) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (KONTEXT_MAX_EDGE, KONTEXT_MAX_EDGE))
+        rotated = img.getexif().get(0x0112, 1) != 1
+        oriented = ImageOps.exif_transpose(img) if rotated else img
+        target_w, target_h = kontext_size(*oriented.size)
+        scale = max(target_w / oriented.width, target_h / oriented.height)
+        if scale >= 1 and not rotated:
+            return None
+        if scale < 1:
+            size = (max(1, round(oriented.width * scale)), max(1, round(oriented.height * scale)))
+            oriented = oriented.resize(size, Image.LANCZOS)
+
+        if fmt == 'jpeg' and oriented.mode not in ('RGB', 'L'):
+            oriented = oriented.convert('RGB')
+        elif fmt == 'webp' and oriented.mode not in ('RGB', 'RGBA'):
+            oriented = oriented.convert('RGBA')
+        options = {'compress_level': 1} if fmt == 'png' else {'quality': quality}
+        if fmt == 'jpeg':
+            options['subsampling'] = 0
+        out = io.BytesIO()
+        oriented.save(out, format=codec, **options)
+    return out.getvalue()
+
+class InputNormalizer:
+    """Runs normalize_image in the CPU executor and counts bytes before/after.
+
+    The upload name is fixed by the content hash before normalizing (pipelined uploads
+    predict it), so an image passed through unchanged keeps its original encoding.
+    """
+
+    def __init__(self, enabled, fmt, quality):
+        self.enabled = enabled
+        self.fmt = fmt
+        self.quality = quality
+        self.images = 0
+        self.unchanged = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    @property
+    def key(self) -> bytes:
+        """Folded into content hashes so changed settings never reuse old uploads or results"""
+        return f'normalize:{self.fmt}:{self.quality}'.encode() if self.enabled else b''
+
+    @property
+    def extension(self):
+        return NORMALIZE_CODECS[self.fmt][1] if self.enabled else '.png'
+
+    @property
+    def content_type(self):
+        return NORMALIZE_CODECS[self.fmt][2] if self.enabled else 'image/png'
+
+    async def run(self, data: bytes) -> bytes:
+        """Normalized bytes, or the input as is (disabled, nothing to do, or undecodable)"""
+        if not self.enabled:
+            return data
+        started = time.perf_counter()
+        try:
+            with stage('normalize'):
+                out = await cpu.run(normalize_image, data, self.fmt, self.quality)
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️ Normalization failed, uploading as is: {e}")
+            return data
+        self.seconds += time.perf_counter() - started
+        self.images += 1
+        if out is None:
+            self.unchanged += 1
+            out = data
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return out
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'format': self.fmt,
+            'images': self.images,
+            'unchanged': self.unchanged,
+            'errors': self.errors,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else 1.0,
+            'avg_ms': round(self.seconds / self.images * 1000, 1) if self.images else 0.0,
+        }
+
+normalizer = InputNormalizer(NORMALIZE_INPUTS, NORMALIZE_FORMAT, NORMALIZE_QUALITY)
+
+# =============================================================================
+# UPLOAD CACHE (content hash → filename already in ComfyUI's input dir)
+# =============================================================================
+
+def content_hash(data: bytes, key: bytes = b'') -> str:
+    return hashlib.blake2b(data, digest_size=16, key=key).hexdigest()
+
+class UploadCache:
+    """LRU map of image content hash to the ComfyUI input filename holding it.
+
+    Entries are evicted by count and total bytes. Eviction only forgets the
+    mapping; ComfyUI has no delete API, but content-addressed names mean a
+    re-upload overwrites the same file instead of adding a duplicate.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.entries = OrderedDict()  # digest -> [filename, size, verified_at]
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    async def lookup(self, digest):
+        entry = self.entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        filename, size, verified_at = entry
+        if time.monotonic() - verified_at > UPLOAD_CACHE_VERIFY_SECONDS:
+            if not await comfy.image_exists(filename, 'input'):
+                self.forget(digest)
+                self.stale += 1
+                self.misses += 1
+                return None
+            entry[2] = time.monotonic()
+        self.entries.move_to_end(digest)
+        self.hits += 1
+        return filename
+
+    def put(self, digest, filename, size):
+        self.forget(digest)
+        self.entries[digest] = [filename, size, time.monotonic()]
+        self.total_bytes += size
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self.forget(next(iter(self.entries)))
+
+    def forget(self, digest):
+        entry = self.entries.pop(digest, None)
+        if entry:
+            self.total_bytes -= entry[1]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+upload_cache = UploadCache(UPLOAD_CACHE_MAX_ENTRIES, UPLOAD_CACHE_MAX_BYTES)
+
+# =============================================================================
+# RESULT CACHE (normalized graph hash → output images on disk)
+# =============================================================================
+
+class ResultCache:
+    """Disk-backed store of generated images keyed by a canonical graph hash.
+
+    Each entry is a directory `<key>/` holding the output images in order,
+    streamed from ComfyUI to disk as soon as a job's outputs are ready (see
+    store), whether or not the job has a webhook. A job whose key is already
+    being generated waits for that job instead of sampling the same graph
+    (see lookup). Entries expire after `ttl` seconds; the oldest go first once
+    the total size passes `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes, ttl):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (size, created), oldest first
+        self.inflight = {}  # key -> future resolved when the job generating it is done
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def load(self):
+        """Rebuild the index from disk (run once at startup)"""
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for key in os.listdir(self.root):
+            path = os.path.join(self.root, key)
+            if not os.path.isdir(path):
+                continue
+            if key.endswith('.part'):
+                shutil.rmtree(path, ignore_errors=True)  # a store that never finished
+                continue
+            files = [os.path.join(path, f) for f in os.listdir(path)]
+            found.append((os.path.getmtime(path), key, sum(os.path.getsize(f) for f in files)))
+        for created, key, size in sorted(found):
+            self.entries[key] = (size, created)
+            self.total_bytes += size
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        while self.entries:
+            key, (size, created) = next(iter(self.entries.items()))
+            if self.total_bytes <= self.max_bytes and now - created <= self.ttl:
+                break
+            self.entries.pop(key)
+            self.total_bytes -= size
+            self.evictions += 1
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def get(self, key):
+        """Return the cached images for key, or None"""
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        path = os.path.join(self.root, key)
+        try:
+            names = sorted(os.listdir(path), key=lambda n: int(n.split('.')[0]))
+            images = []
+            for name in names:
+                with open(os.path.join(path, name), 'rb') as f:
+                    images.append(f.read())
+        except (OSError, ValueError):
+            self.entries.pop(key, None)
+            self.total_bytes -= entry[0]
+            self.misses += 1
+            return None
+        self.hits += 1
+        return images
+
+    async def lookup(self, key):
+        """Cached images for key, or None, in which case the caller must release(key) when done.
+
+        While another job is generating the same key this waits for it first.
+        """
+        while key in self.inflight:
+            await asyncio.shield(self.inflight[key])
+        self.inflight[key] = asyncio.get_running_loop().create_future()
+        images = await asyncio.to_thread(self.get, key)
+        if images is not None:
+            self.release(key)
+        return images
+
+    def release(self, key):
+        """The job that missed on key stored its outputs or failed: wake the jobs waiting on it"""
+        waiting = self.inflight.pop(key, None)
+        if waiting is not None and not waiting.done():
+            waiting.set_result(None)
+
+    async def store(self, key, filenames):
+        """Stream the outputs from ComfyUI into a `<key>.<id>.part/` directory, then commit it"""
+        part = os.path.join(self.root, f'{key}.{uuid.uuid4().hex[:8]}.part')
+        os.makedirs(part, exist_ok=True)
+        try:
+            for i, filename in enumerate(filenames):
+                with open(os.path.join(part, f'{i}.png'), 'wb') as f:
+                    async for chunk in stream_output(filename):
+                        f.write(chunk)
+        except BaseException:
+            shutil.rmtree(part, ignore_errors=True)
+            raise
+        await asyncio.to_thread(self.commit, key, part)
+
+    def commit(self, key, part):
+        path = os.path.join(self.root, key)
+        if key in self.entries:
+            shutil.rmtree(part, ignore_errors=True)  # stored meanwhile
+            return
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(part, path)
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        self.entries[key] = (size, time.time())
+        self.total_bytes += size
+        self.stores += 1
+        self.evict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': RESULT_CACHE_ENABLED,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_SECONDS)
+
+def input_digest(filename):
+    """Content hash behind a content-addressed upload name (input_<hash>.<ext>)"""
+    stem = os.path.splitext(filename)[0]
+    return stem[len('input_'):] if stem.startswith('input_') else filename
+
+def result_key(workflow_type, params):
+    """Canonical hash of the graph a request builds, independent of job_id and upload names"""
+    normalized = dict(params, job_id='')
+    normalized['image1'] = input_digest(params['image1'])
+    if params.get('image2'):
+        normalized['image2'] = input_digest(params['image2'])
+    graph = render_workflow(workflow_type, **normalized)
+    return hashlib.blake2b(graph.encode(), digest_size=20).hexdigest()
+
+async def decode_image(img_b64: str):
+    """Decode a base64 image, return (bytes, content hash keyed by the normalization settings)"""
+    with stage('decode'):
+        return await cpu.run(decode_b64, img_b64, normalizer.key, size=len(img_b64))
+
+def input_name(digest: str) -> str:
+    return f'input_{digest}{normalizer.extension}'
+
+async def upload_image(img_b64: str) -> str:
+    return await upload_decoded(*await decode_image(img_b64))
+
+async def upload_decoded(img: bytes, digest: str) -> str:
+    """Normalize and upload under the content-addressed input name, unless ComfyUI already has it"""
+    cached = await upload_cache.lookup(digest)
+    if cached:
+        print(f"♻️ Upload cache hit: {cached}")
+        return cached
+
+    img = await normalizer.run(img)
+    with stage('upload'):
+        name = await comfy.upload_image(img, input_name(digest), normalizer.content_type)
+    upload_cache.put(digest, name, len(img))
+    return name
+
+async def upload_file(upload: UploadFile) -> str:
+    """Upload a multipart file via the cache, hashing the spooled file before streaming it"""
+    hasher = hashlib.blake2b(digest_size=16)
+    size = 0
+    async for chunk in read_chunks(upload):
+        hasher.update(chunk)
+        size += len(chunk)
+    digest = hasher.hexdigest()
+    cached = await upload_cache.lookup(digest)
+    if cached:
+        print(f"♻️ Upload cache hit: {cached}")
+        return cached
+
+    await upload.seek(0)
+    # Only the extension comes from the client, and only from this list (it ends up in a part header)
+    ext = os.path.splitext(upload.filename or '')[1].lower()
+    if ext not in INPUT_EXTENSIONS:
+        ext = '.png'
+    name = await upload_image_stream(read_chunks(upload), f'input_{digest}{ext}', INPUT_EXTENSIONS[ext])
+    upload_cache.put(digest, name, size)
+    return name
+
+INPUT_EXTENSIONS = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.webp': 'image/webp'}
+
+async def read_chunks(upload: UploadFile):
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        yield chunk
+
+async def upload_image_stream(chunks, filename: str, content_type: Optional[str] = None) -> str:
+    """Upload an image to ComfyUI from an async chunk iterator without buffering it"""
+    with stage('upload'):
+        return await comfy.upload_stream(chunks, filename, content_type or 'image/png')
+
+async def queue_prompt(workflow):
+    """POST a graph (dict or pre-rendered JSON string) to ComfyUI, return its prompt_id"""
+    with stage('submit'):
+        return await comfy.queue_prompt(workflow)
+
+async def process_generate(r: GenerateParams, uploaded1=None, uploaded2=None):
+    started = time.perf_counter()
+    uploads = []
+    cache_key = None
     try:
         print(f"🎨 Processing {r.job_id} with {r.workflow_type}...")
         
-        # Upload images
-        filename1 = f'input_{r.job_id[:8]}_1.png'
-        uploaded1 = await upload_image(r.image_base64, filename1)
-        print(f"📤 Uploaded: {uploaded1}")
-        
-        uploaded2 = None
-        if r.image2_base64:
-            filename2 = f'input_{r.job_id[:8]}_2.png'
-            uploaded2 = await upload_image(r.image2_base64, filename2)
-            print(f"📤 Uploaded secondary: {uploaded2}")
-        
-        # Get workflow builder
-        builder = WORKFLOW_BUILDERS.get(r.workflow_type, build_creative_edit)
+        # Upload images (multipart jobs arrive already uploaded). Pipelined, both uploads
+        # run at once while the graph is built on the names they will get
+        if uploaded1 is None:
+            images = await asyncio.gather(*(decode_image(b64) for b64 in (r.image_base64, r.image2_base64) if b64))
+            if PIPELINE_UPLOADS:
+                uploads = [asyncio.create_task(upload_decoded(img, digest)) for img, digest in images]
+                names = [input_name(digest) for _, digest in images]
+            else:
+                names = [await upload_decoded(img, digest) for img, digest in images]
+                print(f"📤 Uploaded: {', '.join(names)}")
+            uploaded1, uploaded2 = names[0], names[1] if len(names) > 1 else None
         
         # Get output dimensions from aspect ratio
         width, height = ASPECT_SIZES.get(r.aspect_ratio, (1024, 1024))
         
-        # Build workflow
-        workflow = builder(
+        params = dict(
             image1=uploaded1,
             image2=uploaded2,
             prompt=r.prompt,
@@ -124,36 +1100,84 @@ async def process_generate(r: GenerateReq):
             structure_strength=r.structure_strength or 0.5,
             width=width,
             height=height,
-            job_id=r.job_id
+            job_id=r.job_id,
+            batch=variant_count(r.n_variants)
         )
         
-        # Queue workflow
-        async with httpx.AsyncClient(timeout=300.0) as c:
-            resp = await c.post(f'{COMFYUI}/prompt', json={"prompt": workflow})
-            result = resp.json()
-            prompt_id = result.get('prompt_id')
-            if not prompt_id:
-                print(f"⚠️ Queue error: {result}")
-                raise Exception(f"Queue failed: {result}")
-            print(f"🚀 Queued: {prompt_id}")
+        # Identical graph already generated? Reply from the result cache. Only an
+        # explicit seed can repeat; random-seed jobs skip the lookup and the store
+        if RESULT_CACHE_ENABLED and r.seed:
+            key = result_key(r.workflow_type, params)
+            cached = await result_cache.lookup(key)
+            if cached is None:
+                cache_key = key  # ours to store, released in finally
+            else:
+                print(f"♻️ Result cache hit: {key[:12]}")
+                for task in uploads:
+                    task.cancel()
+                JOBS_TOTAL.inc(status='cached', **job_labels.get())
+                await send_callback(r.webhook_url, r.job_id, None, success=True, images=cached,
+                                    execution_time=time.perf_counter() - started)
+                return
         
-        # Wait for completion
-        output_filename = await wait_for_completion(prompt_id)
+        # Fill the compiled workflow template
+        with stage('graph_build'):
+            workflow = render_workflow(r.workflow_type, **params)
+        
+        if uploads:
+            names = await asyncio.gather(*uploads)
+            print(f"📤 Uploaded: {', '.join(names)}")
+            if names != [params['image1'], params['image2']][:len(names)]:
+                # Cached under another name (e.g. a multipart upload): rebuild with the real ones
+                params['image1'], params['image2'] = names[0], names[1] if len(names) > 1 else None
+                with stage('graph_build'):
+                    workflow = render_workflow(r.workflow_type, **params)
+        
+        if batcher.enabled:
+            # Coalesce with compatible jobs into one prompt (includes the batching window)
+            with stage('sampling'):
+                graph = json.loads(workflow)
+                output_filenames = await batcher.run(batch_key(graph), graph)
+        else:
+            # Queue workflow
+            prompt_id = await queue_prompt(workflow)
+            TIME_TO_PROMPT.observe(time.perf_counter() - started, **job_labels.get())
+            print(f"🚀 Queued: {prompt_id}")
+            
+            # Wait for completion
+            with stage('sampling'):
+                output_filenames = await wait_for_completion(prompt_id)
         
-        if output_filename:
-            print(f"✅ Generated: {output_filename}")
-            await send_callback(r.webhook_url, r.job_id, output_filename, success=True)
+        if output_filenames:
+            print(f"✅ Generated: {', '.join(output_filenames)}")
+            execution_time = time.perf_counter() - started
+            JOBS_TOTAL.inc(status='success', **job_labels.get())
+            if cache_key:
+                try:
+                    with stage('cache_store'):
+                        await result_cache.store(cache_key, output_filenames)
+                except Exception as e:
+                    print(f"⚠️ Result cache store failed: {e}")
+            await send_callback(r.webhook_url, r.job_id, output_filenames, success=True,
+                                execution_time=execution_time)
         else:
             raise Exception("Timeout waiting for generation")
                 
     except Exception as e:
+        for task in uploads:
+            task.cancel()
+        JOBS_TOTAL.inc(status='error', **job_labels.get())
         print(f"❌ Error: {e}")
         import traceback
         traceback.print_exc()
         if r.webhook_url:
             await send_callback(r.webhook_url, r.job_id, None, success=False, error=str(e))
+    finally:
+        if cache_key:
+            result_cache.release(cache_key)
 
 async def process_upscale(r: UpscaleReq):
+    started = time.perf_counter()
     try:
         print(f"🔍 Upscaling {r.image_filename}...")
         workflow = {
@@ -170,21 +1194,22 @@ async def process_upscale(r: UpscaleReq):
             }}
         }
         
-        async with httpx.AsyncClient(timeout=300.0) as c:
-            resp = await c.post(f'{COMFYUI}/prompt', json={"prompt": workflow})
-            result = resp.json()
-            prompt_id = result.get('prompt_id')
-            print(f"🚀 Upscale queued: {prompt_id}")
+        prompt_id = await queue_prompt(workflow)
+        print(f"🚀 Upscale queued: {prompt_id}")
         
-        output_filename = await wait_for_completion(prompt_id, timeout=60)
+        with stage('sampling'):
+            output_filenames = await wait_for_completion(prompt_id, timeout=120)
         
-        if output_filename:
-            print(f"✅ Upscaled: {output_filename}")
-            await send_callback(r.webhook_url, r.job_id, output_filename, success=True, is_upscale=True)
+        if output_filenames:
+            print(f"✅ Upscaled: {output_filenames[0]}")
+            JOBS_TOTAL.inc(status='success', **job_labels.get())
+            await send_callback(r.webhook_url, r.job_id, output_filenames, success=True, is_upscale=True,
+                                execution_time=time.perf_counter() - started)
         else:
             raise Exception("Upscale timeout")
             
     except Exception as e:
+        JOBS_TOTAL.inc(status='error', **job_labels.get())
         print(f"❌ Upscale error: {e}")
         if r.webhook_url:
             await send_callback(r.webhook_url, r.job_id, None, success=False, error=str(e))
@@ -224,7 +1249,7 @@ def get_text_encoding(prompt, negative_prompt):
 # WORKFLOW 1: APPLY PATTERN (2 images → design on fabric)
 # =============================================================================
 
-def build_apply_pattern(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_apply_pattern(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Apply pattern from image2 to fabric in image1"""
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
@@ -283,10 +1308,8 @@ def build_apply_pattern(image1, image2, prompt, negative_prompt, seed, steps, gu
 # WORKFLOW 2: CHANGE MATERIAL (1 image → different fabric)
 # =============================================================================
 
-def build_change_material(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_change_material(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Change material/fabric type while preserving design"""
-    denoise = 1 - (structure_strength * 0.5)  # 0.5 structure → 0.75 denoise
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -324,20 +1347,13 @@ def build_change_material(image1, image2, prompt, negative_prompt, seed, steps,
 # WORKFLOW 3: MERGE IMAGES (person + scene → composite)
 # =============================================================================
 
-def build_merge_images(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_merge_images(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Merge two images - put garment from image2 onto person from image1
     
     Key difference from apply_pattern:
     - Uses IMAGE1 (person) as base latent with partial denoise
     - This PRESERVES the person while changing their clothes
     """
-    # Higher guidance for better instruction following
-    guidance = max(guidance, 3.5)
-    
-    # Partial denoise to preserve person structure while changing clothes
-    # 0.85 denoise = keep person pose/face, change clothes
-    denoise = 0.85
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -394,7 +1410,7 @@ def build_merge_images(image1, image2, prompt, negative_prompt, seed, steps, gui
 # WORKFLOW 4: MODEL MOCKUP (design → on model for Instagram)
 # =============================================================================
 
-def build_model_mockup(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_model_mockup(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Put design on fashion model for Instagram"""
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
@@ -437,19 +1453,16 @@ def build_model_mockup(image1, image2, prompt, negative_prompt, seed, steps, gui
 # WORKFLOW 5: STYLE TRANSFER (apply art style)
 # =============================================================================
 
-def build_style_transfer(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_style_transfer(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Apply artistic style from image2 to image1"""
-    return build_apply_pattern(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id)
+    return build_apply_pattern(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id)
 
 # =============================================================================
 # WORKFLOW 6: EXTRACT PATTERN (garment photo → flat tileable pattern)
 # =============================================================================
 
-def build_extract_pattern(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_extract_pattern(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Extract pattern from garment photo to flat tileable surface"""
-    # High structure to preserve pattern details
-    denoise = 0.7
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -491,10 +1504,8 @@ def build_extract_pattern(image1, image2, prompt, negative_prompt, seed, steps,
 # WORKFLOW 7: CREATIVE EDIT (general purpose)
 # =============================================================================
 
-def build_creative_edit(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_creative_edit(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """General purpose image editing"""
-    denoise = 1 - (structure_strength * 0.7)
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -545,11 +1556,9 @@ def build_creative_edit(image1, image2, prompt, negative_prompt, seed, steps, gu
 # WORKFLOW 8: COLOR SWAP (change specific colors only)
 # =============================================================================
 
-def build_color_swap(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_color_swap(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Swap specific colors in garment/fabric while preserving everything else.
     Uses very low denoise to only change colors, not structure."""
-    denoise = 0.45 + (1 - structure_strength) * 0.2  # 0.45-0.65 range, very structural
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -562,7 +1571,7 @@ def build_color_swap(image1, image2, prompt, negative_prompt, seed, steps, guida
             "conditioning": ["6", 0], "latent": ["124", 0]
         }},
         "35": {"class_type": "FluxGuidance", "inputs": {
-            "conditioning": ["177", 0], "guidance": max(guidance, 4.0)
+            "conditioning": ["177", 0], "guidance": guidance
         }},
         
         # Encoded latent preserves structure, low denoise changes only color
@@ -587,11 +1596,9 @@ def build_color_swap(image1, image2, prompt, negative_prompt, seed, steps, guida
 # WORKFLOW 9: BACKGROUND CHANGE (replace product photo background)
 # =============================================================================
 
-def build_background_change(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_background_change(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Replace background of a product/model photo.
     Preserves subject with medium denoise, lets background regenerate."""
-    denoise = 0.75 + (1 - structure_strength) * 0.15  # 0.75-0.90
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -604,7 +1611,7 @@ def build_background_change(image1, image2, prompt, negative_prompt, seed, steps
             "conditioning": ["6", 0], "latent": ["124", 0]
         }},
         "35": {"class_type": "FluxGuidance", "inputs": {
-            "conditioning": ["177", 0], "guidance": max(guidance, 3.5)
+            "conditioning": ["177", 0], "guidance": guidance
         }},
         
         # Use empty latent for fresh background generation
@@ -633,11 +1640,9 @@ def build_background_change(image1, image2, prompt, negative_prompt, seed, steps
 # WORKFLOW 10: DRAPING SIMULATION (flat pattern → draped on mannequin/model)
 # =============================================================================
 
-def build_draping_sim(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_draping_sim(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Show flat pattern draped on a mannequin or model.
     Image1 = flat pattern, Image2 = model/mannequin. Stitches both as reference."""
-    guidance = max(guidance, 4.0)
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -656,11 +1661,9 @@ def build_draping_sim(image1, image2, prompt, negative_prompt, seed, steps, guid
         workflow["model_scale"] = {"class_type": "FluxKontextImageScale", "inputs": {"image": ["147", 0]}}
         workflow["model_latent"] = {"class_type": "VAEEncode", "inputs": {"pixels": ["model_scale", 0], "vae": ["39", 0]}}
         base_latent = ["model_latent", 0]
-        denoise = 0.85
     else:
         ref_source = ["142", 0]
         base_latent = None
-        denoise = 1.0
     
     workflow.update({
         "42": {"class_type": "FluxKontextImageScale", "inputs": {"image": ref_source}},
@@ -711,11 +1714,9 @@ def build_draping_sim(image1, image2, prompt, negative_prompt, seed, steps, guid
 # WORKFLOW 11: BATCH COLORWAYS (same design, multiple color variations)
 # =============================================================================
 
-def build_batch_colorways(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_batch_colorways(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Generate the same design in multiple color variations.
-    Uses batch_size=4 to produce 4 colorways simultaneously."""
-    denoise = 0.5 + (1 - structure_strength) * 0.2  # Low denoise to preserve design
-    
+    Request n_variants to sample several colorways in one batched prompt."""
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -728,7 +1729,7 @@ def build_batch_colorways(image1, image2, prompt, negative_prompt, seed, steps,
             "conditioning": ["6", 0], "latent": ["124", 0]
         }},
         "35": {"class_type": "FluxGuidance", "inputs": {
-            "conditioning": ["177", 0], "guidance": max(guidance, 3.5)
+            "conditioning": ["177", 0], "guidance": guidance
         }},
         
         # Encoded latent with low denoise for color-only changes
@@ -753,11 +1754,9 @@ def build_batch_colorways(image1, image2, prompt, negative_prompt, seed, steps,
 # WORKFLOW 12: EMBROIDERY EFFECT (flat design → embroidered look)
 # =============================================================================
 
-def build_embroidery_effect(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_embroidery_effect(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Transform flat design to look like embroidery, beadwork, or textile texture.
     Medium denoise to preserve design while adding texture."""
-    denoise = 0.6 + (1 - structure_strength) * 0.2  # 0.60-0.80
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -770,7 +1769,7 @@ def build_embroidery_effect(image1, image2, prompt, negative_prompt, seed, steps
             "conditioning": ["6", 0], "latent": ["124", 0]
         }},
         "35": {"class_type": "FluxGuidance", "inputs": {
-            "conditioning": ["177", 0], "guidance": max(guidance, 4.5)
+            "conditioning": ["177", 0], "guidance": guidance
         }},
         
         # Use encoded image with medium denoise to add texture over design
@@ -779,7 +1778,7 @@ def build_embroidery_effect(image1, image2, prompt, negative_prompt, seed, steps
             "positive": ["35", 0],
             "negative": ["135", 0],
             "latent_image": ["124", 0],
-            "seed": seed, "steps": max(steps, 30), "cfg": 1,
+            "seed": seed, "steps": steps, "cfg": 1,
             "sampler_name": "euler", "scheduler": "simple",
             "denoise": denoise
         }},
@@ -795,11 +1794,9 @@ def build_embroidery_effect(image1, image2, prompt, negative_prompt, seed, steps
 # WORKFLOW 13: AGE & WEAR (simulate aging, washing, distressing)
 # =============================================================================
 
-def build_age_wear(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_age_wear(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Simulate aging, wash effects, or distressing on fabric.
     Preserves garment structure, applies wear effects."""
-    denoise = 0.55 + (1 - structure_strength) * 0.2  # 0.55-0.75
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -836,12 +1833,9 @@ def build_age_wear(image1, image2, prompt, negative_prompt, seed, steps, guidanc
 # WORKFLOW 14: PRINT PLACEMENT (place print/logo on garment)
 # =============================================================================
 
-def build_print_placement(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_print_placement(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Place a print/logo precisely on a garment.
     Image1 = garment, Image2 = print/logo. Preserves garment, adds print."""
-    guidance = max(guidance, 4.0)
-    denoise = 0.75
-    
     workflow = get_model_loaders()
     workflow.update(get_text_encoding(prompt, negative_prompt))
     
@@ -895,7 +1889,7 @@ def build_print_placement(image1, image2, prompt, negative_prompt, seed, steps,
 # WORKFLOW 15: FABRIC TEXTURE (sketch/description → realistic texture)
 # =============================================================================
 
-def build_fabric_texture(image1, image2, prompt, negative_prompt, seed, steps, guidance, structure_strength, width, height, job_id):
+def build_fabric_texture(image1, image2, prompt, negative_prompt, seed, steps, guidance, denoise, width, height, job_id):
     """Generate realistic fabric texture from a sketch or rough input.
     High denoise for maximum creativity, square output for textile use."""
     workflow = get_model_loaders()
@@ -910,7 +1904,7 @@ def build_fabric_texture(image1, image2, prompt, negative_prompt, seed, steps, g
             "conditioning": ["6", 0], "latent": ["124", 0]
         }},
         "35": {"class_type": "FluxGuidance", "inputs": {
-            "conditioning": ["177", 0], "guidance": max(guidance, 4.0)
+            "conditioning": ["177", 0], "guidance": guidance
         }},
         
         # Square output for tileable fabric texture
@@ -923,7 +1917,7 @@ def build_fabric_texture(image1, image2, prompt, negative_prompt, seed, steps, g
             "positive": ["35", 0],
             "negative": ["135", 0],
             "latent_image": ["188", 0],
-            "seed": seed, "steps": max(steps, 30), "cfg": 1,
+            "seed": seed, "steps": steps, "cfg": 1,
             "sampler_name": "euler", "scheduler": "simple",
             "denoise": 0.95
         }},
@@ -958,43 +1952,716 @@ WORKFLOW_BUILDERS = {
     'fabric_texture': build_fabric_texture,
 }
 
+# Per-workflow shaping of UI values before they fill the template slots:
+# guidance/steps floors and how structure_strength maps to denoise
+WORKFLOW_TUNING = {
+    'change_material': {'denoise': lambda s: 1 - (s * 0.5)},  # 0.5 structure → 0.75 denoise
+    # Higher guidance for better instruction following;
+    # 0.85 denoise = keep person pose/face, change clothes
+    'merge_images': {'min_guidance': 3.5, 'denoise': lambda s: 0.85},
+    'extract_pattern': {'denoise': lambda s: 0.7},  # High structure to preserve pattern details
+    'creative_edit': {'denoise': lambda s: 1 - (s * 0.7)},
+    'color_swap': {'min_guidance': 4.0, 'denoise': lambda s: 0.45 + (1 - s) * 0.2},  # 0.45-0.65, very structural
+    'background_change': {'min_guidance': 3.5},
+    'draping_sim': {'min_guidance': 4.0, 'denoise': lambda s: 0.85},  # only used with a model image
+    'batch_colorways': {'min_guidance': 3.5, 'denoise': lambda s: 0.5 + (1 - s) * 0.2},  # Low denoise to preserve design
+    'embroidery_effect': {'min_guidance': 4.5, 'min_steps': 30, 'denoise': lambda s: 0.6 + (1 - s) * 0.2},  # 0.60-0.80
+    'age_wear': {'denoise': lambda s: 0.55 + (1 - s) * 0.2},  # 0.55-0.75
+    'print_placement': {'min_guidance': 4.0, 'denoise': lambda s: 0.75},
+    'fabric_texture': {'min_guidance': 4.0, 'min_steps': 30},
+}
+
+def variant_count(n_variants):
+    """Images per prompt: the request's n_variants (default 1), capped at MAX_VARIANTS.
+
+    The app's webhook stores only the first image, so no workflow samples more
+    unless the caller asks for it.
+    """
+    return max(1, min(n_variants or 1, MAX_VARIANTS))
+
+def tune_params(workflow_type, guidance, steps, structure_strength):
+    tuning = WORKFLOW_TUNING.get(workflow_type, {})
+    guidance = max(guidance, tuning.get('min_guidance', guidance))
+    steps = max(steps, tuning.get('min_steps', steps))
+    denoise = tuning['denoise'](structure_strength) if 'denoise' in tuning else 1.0
+    return guidance, steps, denoise
+
+# =============================================================================
+# COMPILED WORKFLOW TEMPLATES
+# =============================================================================
+
+SLOT_PARAMS = ('image1', 'image2', 'prompt', 'negative_prompt', 'seed', 'steps',
+               'guidance', 'denoise', 'width', 'height', 'job_id')
+BATCH_SLOT = '@@batch@@'
+SLOT_PATTERN = re.compile(r'"@@(\w+)@@"|@@(\w+)@@')
+
+class WorkflowTemplate:
+    """A workflow graph pre-serialized to JSON fragments with parameter slots.
+
+    The builder runs once with `@@name@@` markers in place of every parameter.
+    A marker that is a whole JSON value is replaced by json.dumps(value); one
+    embedded in a string (e.g. the SaveImage prefix) by the escaped text.
+    Batched variants sample `@@batch@@` latents in one KSampler pass.
+    """
+
+    def __init__(self, builder, with_image2, batched=False):
+        markers = {name: f'@@{name}@@' for name in SLOT_PARAMS}
+        if not with_image2:
+            markers['image2'] = None
+        graph = builder(**markers)
+        if batched:
+            batch_latents(graph)
+        text = json.dumps(graph, separators=(',', ':'))
+        self.parts = []  # (literal, slot_name, whole_value)
+        pos = 0
+        for m in SLOT_PATTERN.finditer(text):
+            self.parts.append((text[pos:m.start()], m.group(1) or m.group(2), m.group(1) is not None))
+            pos = m.end()
+        self.tail = text[pos:]
+
+    def render(self, values):
+        out = []
+        for literal, name, whole in self.parts:
+            out.append(literal)
+            encoded = json.dumps(values[name])
+            out.append(encoded if whole else encoded[1:-1])
+        out.append(self.tail)
+        return ''.join(out)
+
+def batch_latents(graph):
+    """Make the KSampler ("31") sample a batch of latents, sharing loaders and text encoding.
+
+    Empty latents get batch_size; encoded image latents go through RepeatLatentBatch.
+    """
+    sampler = graph["31"]["inputs"]
+    source = sampler["latent_image"]
+    if source[0] in graph and graph[source[0]]["class_type"] == "EmptySD3LatentImage":
+        graph[source[0]]["inputs"]["batch_size"] = BATCH_SLOT
+    else:
+        graph["batch"] = {"class_type": "RepeatLatentBatch", "inputs": {
+            "samples": source, "amount": BATCH_SLOT
+        }}
+        sampler["latent_image"] = ["batch", 0]
+    return graph
+
+templates_started = time.perf_counter()
+WORKFLOW_TEMPLATES = {
+    name: {(with_image2, batched): WorkflowTemplate(builder, with_image2, batched)
+           for with_image2 in (False, True) for batched in (False, True)}
+    for name, builder in WORKFLOW_BUILDERS.items()
+}
+TEMPLATE_COMPILE_SECONDS = time.perf_counter() - templates_started
+
+def render_workflow(workflow_type, image1, image2, prompt, negative_prompt, seed, steps,
+                    guidance, structure_strength, width, height, job_id, batch=1):
+    """Return the API-format graph for one request as a JSON string"""
+    if workflow_type not in WORKFLOW_TEMPLATES:
+        workflow_type = 'creative_edit'
+    guidance, steps, denoise = tune_params(workflow_type, guidance, steps, structure_strength)
+    template = WORKFLOW_TEMPLATES[workflow_type][(bool(image2), batch > 1)]
+    return template.render({
+        'image1': image1, 'image2': image2, 'prompt': prompt, 'negative_prompt': negative_prompt,
+        'seed': seed, 'steps': steps, 'guidance': guidance, 'denoise': denoise,
+        'width': width, 'height': height, 'job_id': job_id, 'batch': batch,
+    })
+
+def build_workflow(*args, **kwargs):
+    """Same as render_workflow but returns the graph as a dict"""
+    return json.loads(render_workflow(*args, **kwargs))
+
+# =============================================================================
+# WARM-UP (load models into VRAM before the first real job)
+# =============================================================================
+
+def build_warmup():
+    """Smallest graph that touches every model: 64x64 latent, 1 sampling step"""
+    workflow = get_model_loaders()
+    workflow.update(get_text_encoding('warm-up', ''))
+    workflow.update({
+        "35": {"class_type": "FluxGuidance", "inputs": {"conditioning": ["6", 0], "guidance": 1.0}},
+        "188": {"class_type": "EmptySD3LatentImage", "inputs": {"width": 64, "height": 64, "batch_size": 1}},
+        "31": {"class_type": "KSampler", "inputs": {
+            "model": ["37", 0],
+            "positive": ["35", 0],
+            "negative": ["135", 0],
+            "latent_image": ["188", 0],
+            "seed": 0, "steps": 1, "cfg": 1,
+            "sampler_name": "euler", "scheduler": "simple",
+            "denoise": 1.0
+        }},
+        "8": {"class_type": "VAEDecode", "inputs": {"samples": ["31", 0], "vae": ["39", 0]}},
+        "136": {"class_type": "SaveImage", "inputs": {"images": ["8", 0], "filename_prefix": "warmup"}},
+    })
+    return workflow
+
+class WarmUp:
+    """Runs build_warmup() once; /health reports 'warming' until it is done"""
+
+    def __init__(self, enabled):
+        self.state = 'warming' if enabled else 'ready'
+        self.seconds = None
+        self.error = None
+
+    @property
+    def models_loaded(self):
+        return self.seconds is not None
+
+    async def load(self):
+        # The worker can come up before ComfyUI does
+        while not await comfy.is_up():
+            await asyncio.sleep(1)
+        print("🔥 Warming up models...")
+        prompt_id = await queue_prompt(build_warmup())
+        if await wait_for_completion(prompt_id, timeout=WARMUP_TIMEOUT_SECONDS) is None:
+            raise Exception("Timeout waiting for warm-up")
+
+    async def run(self):
+        """Warm up within WARMUP_TIMEOUT_SECONDS, including the wait for ComfyUI.
+
+        If ComfyUI never answered the state becomes 'failed' (no jobs can run);
+        if only the warm-up graph failed it becomes 'ready' and the first job
+        loads the models itself.
+        """
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.load(), timeout=WARMUP_TIMEOUT_SECONDS)
+            self.seconds = round(time.perf_counter() - started, 2)
+            print(f"🔥 Models loaded in {self.seconds}s")
+            self.state = 'ready'
+        except Exception as e:
+            self.error = str(e) or f"Timed out after {WARMUP_TIMEOUT_SECONDS}s"
+            self.state = 'ready' if await comfy.is_up() else 'failed'
+            print(f"❌ Warm-up failed: {self.error} (state: {self.state})")
+
+warmup = WarmUp(WARMUP_ENABLED)
+
+# =============================================================================
+# MICRO-BATCHING (merge compatible jobs into one ComfyUI prompt)
+# =============================================================================
+
+SHARED_NODES = ("37", "38", "39")  # model loaders, identical in every graph
+
+def batch_key(graph):
+    """Jobs can share a prompt when their loader nodes match; every other node stays per job"""
+    return json.dumps([graph.get(nid) for nid in SHARED_NODES], sort_keys=True)
+
+def merge_graphs(graphs):
+    """Combine job graphs into one prompt sharing the loader nodes.
+
+    Every other node is renamed `b<i>_<id>`. Returns the merged graph and, per
+    job, the ids of its SaveImage nodes.
+    """
+    merged = {}
+    save_nodes = []
+    for i, graph in enumerate(graphs):
+        rename = {nid: nid if nid in SHARED_NODES else f'b{i}_{nid}' for nid in graph}
+        for nid, node in graph.items():
+            if nid in SHARED_NODES:
+                merged.setdefault(nid, node)
+                continue
+            inputs = {}
+            for name, value in node["inputs"].items():
+                if isinstance(value, list) and len(value) == 2 and value[0] in rename:
+                    value = [rename[value[0]], value[1]]
+                inputs[name] = value
+            merged[rename[nid]] = {"class_type": node["class_type"], "inputs": inputs}
+        save_nodes.append([rename[nid] for nid, node in graph.items() if node["class_type"] == "SaveImage"])
+    return merged, save_nodes
+
+def split_outputs(outputs, save_nodes):
+    """Per job, the filenames its SaveImage nodes produced in the merged prompt (None if none)"""
+    return [[name for nid in nodes for name in outputs.get(nid, [])] or None for nodes in save_nodes]
+
+class MicroBatcher:
+    """Holds jobs for a short window and submits each compatible group as one prompt.
+
+    ComfyUI runs the merged graph in one execution, so the per-prompt cost
+    (submit, validation, queueing, history) is paid once, then each job's
+    SaveImage outputs are handed back to its own caller. Sampling is not
+    batched: every job keeps its own KSampler, so once models are loaded the
+    gain is that per-prompt overhead only.
+    A waiting job holds its JobQueue runner, so a batch never gets bigger than
+    `slots` (JOB_CONCURRENCY); max_batch is capped to that.
+    """
+
+    def __init__(self, window_ms, max_batch, slots):
+        self.window = window_ms / 1000.0
+        self.configured_max = max_batch
+        self.max_batch = min(max_batch, slots)
+        self.pending = {}  # key -> [(graph, future)]
+        self.timers = {}
+        self.tasks = set()
+        self.batches = 0
+        self.batched_jobs = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_batch > 1
+
+    async def run(self, key, graph):
+        """Queue graph with its group and return its output filenames"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        group = self.pending.setdefault(key, [])
+        group.append((graph, future))
+        if len(group) >= self.max_batch:
+            self.flush(key)
+        elif len(group) == 1:
+            self.timers[key] = loop.call_later(self.window, self.flush, key)
+        return await future
+
+    def flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        group = self.pending.pop(key, None)
+        if group:
+            task = asyncio.create_task(self.execute(group))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def execute(self, group):
+        try:
+            merged, save_nodes = merge_graphs([graph for graph, _ in group])
+            prompt_id = await queue_prompt(merged)
+            print(f"🚀 Queued: {prompt_id} (micro-batch of {len(group)})")
+            self.batches += 1
+            self.batched_jobs += len(group)
+            outputs = await comfy.wait_for_outputs(prompt_id, timeout=240 * len(group),
+                                             expected=sum(len(nodes) for nodes in save_nodes))
+            if outputs is None:
+                raise Exception("Timeout waiting for generation")
+            for (_, future), filenames in zip(group, split_outputs(outputs, save_nodes)):
+                if not future.done():
+                    future.set_result(filenames)
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'window_ms': self.window * 1000,
+            'max_batch': self.max_batch,
+            'configured_max_batch': self.configured_max,
+            'batches': self.batches,
+            'batched_jobs': self.batched_jobs,
+            'avg_batch_size': round(self.batched_jobs / self.batches, 2) if self.batches else 0.0,
+            'waiting': sum(len(group) for group in self.pending.values()),
+        }
+
+batcher = MicroBatcher(MICROBATCH_WINDOW_MS, MICROBATCH_MAX, JOB_CONCURRENCY)
+
 # =============================================================================
 # UTILITIES
 # =============================================================================
 
-async def wait_for_completion(prompt_id, timeout=120):
-    for i in range(timeout):
-        await asyncio.sleep(2)
-        async with httpx.AsyncClient() as c:
-            resp = await c.get(f'{COMFYUI}/history/{prompt_id}')
-            history = resp.json()
-            if prompt_id in history:
-                for node_output in history[prompt_id].get('outputs', {}).values():
-                    if 'images' in node_output:
-                        return node_output['images'][0]['filename']
-        if i % 15 == 0: 
-            print(f"⏳ Waiting... {i*2}s")
+async def wait_for_completion(prompt_id, timeout=240):
+    """Return the output filenames for prompt_id, or None on timeout"""
+    outputs = await comfy.wait_for_outputs(prompt_id, timeout)
+    if outputs:
+        return [name for filenames in outputs.values() for name in filenames]
     return None
 
-async def send_callback(webhook_url, job_id, filename, success, error=None, is_upscale=False):
+# =============================================================================
+# RESULT DELIVERY (how output images reach the webhook, see DELIVERY_MODE)
+# =============================================================================
+
+def stream_output(filename):
+    """Yield an output image from ComfyUI /view chunk by chunk"""
+    return comfy.stream_image(filename, UPLOAD_CHUNK_BYTES)
+
+async def iter_image(image):
+    yield image
+
+async def read_file(path):
+    with open(path, 'rb') as f:
+        while chunk := f.read(UPLOAD_CHUNK_BYTES):
+            yield chunk
+
+class ObjectStore(ABC):
+    """Destination for DELIVERY_MODE=url: stores a byte stream, returns a URL for it"""
+
+    @abstractmethod
+    async def put(self, key, chunks):
+        """Store the async iterable of byte `chunks` under `key`; returns its URL"""
+
+class LocalObjectStore(ObjectStore):
+    """Directory stand-in for S3/GCS, served by the worker at /results/{key}"""
+
+    def __init__(self, root, base_url, ttl_seconds):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+        self.ttl_seconds = ttl_seconds
+        self.pruned = 0.0
+
+    def path(self, key):
+        return os.path.join(self.root, os.path.basename(key))
+
+    async def put(self, key, chunks):
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(key)
+        with open(f'{path}.part', 'wb') as f:
+            async for chunk in chunks:
+                f.write(chunk)
+        os.replace(f'{path}.part', path)
+        if time.time() - self.pruned > 600:
+            self.pruned = time.time()
+            await asyncio.to_thread(self.prune)
+        return f'{self.base_url}/{os.path.basename(key)}'
+
+    def prune(self):
+        cutoff = time.time() - self.ttl_seconds
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+object_store = LocalObjectStore(OBJECT_STORE_DIR, OBJECT_STORE_BASE_URL, OBJECT_STORE_TTL_SECONDS)
+
+def callback_headers(**extra):
+    return {'X-API-Secret': API_SECRET, **extra}
+
+async def deliver_json(webhook_url, payload, outputs):
+    """Whole images in memory, base64-encoded into the JSON body"""
+    images = []
+    if outputs:
+        with stage('download'):
+            images = [b''.join([chunk async for chunk in chunks]) for _, chunks in outputs]
+    body = await cpu.run(json_callback, payload, images, size=sum(map(len, images)))
+    with stage('webhook'):
+        resp = await webhook_client().post(webhook_url, content=body, timeout=30.0,
+                                           headers=callback_headers(**{'Content-Type': 'application/json'}))
+        resp.raise_for_status()
+
+async def multipart_result(boundary, payload, outputs):
+    """Encode the callback as multipart/form-data: a `metadata` JSON part, then one `image` part per output"""
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="metadata"\r\n'
+           f'Content-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n').encode()
+    for name, chunks in outputs:
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{name}"\r\n'
+               f'Content-Type: image/png\r\n\r\n').encode()
+        async for chunk in chunks:
+            yield chunk
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
+
+async def deliver_multipart(webhook_url, payload, outputs):
+    """One multipart POST, image bytes piped from ComfyUI without buffering"""
+    boundary = uuid.uuid4().hex
+    with stage('webhook'):
+        resp = await webhook_client().post(webhook_url, content=multipart_result(boundary, payload, outputs),
+            headers=callback_headers(**{'Content-Type': f'multipart/form-data; boundary={boundary}'}),
+            timeout=30.0)
+        resp.raise_for_status()
+
+async def deliver_raw(webhook_url, payload, outputs):
+    """One POST per image with the bytes as the body and the metadata in X-Job-Metadata"""
+    with stage('webhook'):
+        for index, (_, chunks) in enumerate(outputs):
+            metadata = {**payload, 'image_index': index, 'image_count': len(outputs)}
+            resp = await webhook_client().post(webhook_url, content=chunks,
+                headers=callback_headers(**{'Content-Type': 'image/png', 'X-Job-Metadata': json.dumps(metadata)}),
+                timeout=30.0)
+            resp.raise_for_status()
+
+async def store_outputs(payload, outputs):
+    """Stream the images into the object store and add their URLs to the payload"""
+    with stage('download'):
+        urls = [await object_store.put(f'{uuid.uuid4().hex}_{name}', chunks) for name, chunks in outputs]
+    payload['image_url'] = urls[0]
+    if len(urls) > 1:
+        payload['image_urls'] = urls
+
+async def deliver_url(webhook_url, payload, outputs):
+    """Images streamed into the object store; the JSON body carries only their URLs"""
+    if outputs:
+        await store_outputs(payload, outputs)
+    await deliver_json(webhook_url, payload, [])
+
+DELIVERY_MODES = {
+    'json': deliver_json,
+    'multipart': deliver_multipart,
+    'raw': deliver_raw,
+    'url': deliver_url,
+}
+
+# =============================================================================
+# CALLBACK QUEUE (durable webhook delivery: disk spool, retries, batching)
+# =============================================================================
+
+CALLBACK_DELIVERY_SECONDS = Histogram('worker_callback_delivery_seconds',
+    'Time from job completion until the webhook accepted its callback')
+CALLBACKS_TOTAL = Counter('worker_callbacks_total', 'Callback send outcomes (delivered, retry, dropped)')
+
+def retryable(error):
+    """Network errors, timeouts, 408/429 and 5xx are worth another try; other 4xx are not"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status in (408, 429) or status >= 500
+    return True
+
+class CallbackQueue:
+    """Outbound webhook callbacks, kept on disk until the webhook accepts them.
+
+    Every callback is a JSON entry in `spool_dir`. Images that are only in
+    memory (result cache hits) are spooled next to it; ComfyUI outputs are
+    re-read from /view on each attempt. Entries left over from a previous run
+    are resent at startup. Failed sends back off exponentially with full
+    jitter; after `max_attempts` (or a 4xx) the entry is renamed to
+    `.failed` for inspection. With `batch_max` > 1, callbacks without image
+    bytes (failures, url delivery) to the same webhook are held for
+    `batch_window` seconds and sent together as `{"batch": [...]}`.
+    """
+
+    def __init__(self, spool_dir, max_attempts, backoff, backoff_max, concurrency, batch_max, batch_window):
+        self.spool_dir = spool_dir
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.batch_max = batch_max
+        self.batch_window = batch_window
+        self.slots = asyncio.Semaphore(concurrency)
+        self.entries = {}  # id -> entry
+        self.due = []      # heap of (send_at, seq, id)
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.sending = set()
+        self.task = None
+        self.delivered = 0
+        self.retries = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def spool_path(self, entry_id, suffix='.json'):
+        return os.path.join(self.spool_dir, f'{entry_id}{suffix}')
+
+    def save(self, entry):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        tmp = self.spool_path(entry['id'], '.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.spool_path(entry['id']))
+
+    def spool_images(self, entry_id, images):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        paths = []
+        for i, image in enumerate(images):
+            paths.append(self.spool_path(entry_id, f'_{i}.png'))
+            with open(paths[-1], 'wb') as f:
+                f.write(image)
+        return paths
+
+    def remove(self, entry):
+        for path in [self.spool_path(entry['id'])] + (entry['images'] or []):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def load(self):
+        """Queue the callbacks a previous run left in the spool"""
+        if not os.path.isdir(self.spool_dir):
+            return
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.spool_dir, name)) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self.entries[entry['id']] = entry
+            self.schedule(entry)
+        if self.entries:
+            print(f"📮 Resending {len(self.entries)} spooled callback(s)")
+
+    def batchable(self, entry):
+        return self.batch_max > 1 and (DELIVERY_MODE == 'url' or not (entry['filenames'] or entry['images']))
+
+    def schedule(self, entry, delay=0.0):
+        heapq.heappush(self.due, (time.time() + delay, next(self.seq), entry['id']))
+        self.wakeup.set()
+
+    async def submit(self, webhook_url, payload, filenames=None, images=None):
+        """Spool a callback and queue it for sending"""
+        entry_id = f"{payload['job_id']}_{uuid.uuid4().hex[:8]}"
+        entry = {
+            'id': entry_id,
+            'webhook_url': webhook_url,
+            'payload': payload,
+            'filenames': filenames,
+            'images': None,
+            'labels': job_labels.get(),
+            'attempts': 0,
+            'created': time.time(),
+        }
+        if images:
+            entry['images'] = await asyncio.to_thread(self.spool_images, entry_id, images)
+        await asyncio.to_thread(self.save, entry)
+        self.entries[entry_id] = entry
+        self.schedule(entry, self.batch_window if self.batchable(entry) else 0.0)
+
+    def outputs(self, entry):
+        if entry['images']:
+            return [(os.path.basename(path), read_file(path)) for path in entry['images']]
+        return [(name, stream_output(name)) for name in entry['filenames'] or []]
+
+    async def prepare(self, entry):
+        """url delivery: store the images once, so retries only resend their URLs"""
+        if DELIVERY_MODE == 'url' and (entry['filenames'] or entry['images']):
+            await store_outputs(entry['payload'], self.outputs(entry))
+            images = entry['images'] or []
+            entry['filenames'] = entry['images'] = None
+            await asyncio.to_thread(self.save, entry)
+            for path in images:
+                os.remove(path)
+
+    async def deliver(self, entry):
+        await self.prepare(entry)
+        outputs = self.outputs(entry)
+        deliver = DELIVERY_MODES.get(DELIVERY_MODE, deliver_json) if outputs else deliver_json
+        await deliver(entry['webhook_url'], dict(entry['payload']), outputs)
+
+    async def deliver_batch(self, group):
+        for entry in group:
+            await self.prepare(entry)
+        with stage('webhook'):
+            resp = await webhook_client().post(group[0]['webhook_url'], headers=callback_headers(),
+                json={'batch': [entry['payload'] for entry in group]}, timeout=30.0)
+            resp.raise_for_status()
+        self.batches += 1
+
+    async def send(self, group):
+        async with self.slots:
+            job_labels.set(group[0]['labels'])
+            try:
+                if len(group) > 1:
+                    await self.deliver_batch(group)
+                else:
+                    await self.deliver(group[0])
+            except Exception as e:
+                for entry in group:
+                    await self.failed(entry, e)
+                return
+            for entry in group:
+                self.done(entry)
+
+    def done(self, entry):
+        self.entries.pop(entry['id'], None)
+        self.remove(entry)
+        self.delivered += 1
+        CALLBACKS_TOTAL.inc(result='delivered')
+        CALLBACK_DELIVERY_SECONDS.observe(time.time() - entry['created'])
+        print(f"📧 Callback sent for {entry['payload']['job_id']} (attempt {entry['attempts'] + 1})")
+
+    def spool_failed(self, entry):
+        """Keep a dropped callback in the spool as `<id>.failed`"""
+        self.save(entry)
+        os.replace(self.spool_path(entry['id']), self.spool_path(entry['id'], '.failed'))
+
+    async def failed(self, entry, error):
+        entry['attempts'] += 1
+        job_id = entry['payload']['job_id']
+        if entry['attempts'] >= self.max_attempts or not retryable(error):
+            print(f"❌ Callback for {job_id} dropped after {entry['attempts']} attempt(s): {error!r}")
+            self.entries.pop(entry['id'], None)
+            await asyncio.to_thread(self.spool_failed, entry)
+            self.dropped += 1
+            CALLBACKS_TOTAL.inc(result='dropped')
+            return
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** entry['attempts']))
+        print(f"⚠️ Callback for {job_id} failed ({error!r}), attempt {entry['attempts']}, retry in {delay:.1f}s")
+        self.retries += 1
+        CALLBACKS_TOTAL.inc(result='retry')
+        await asyncio.to_thread(self.save, entry)
+        self.schedule(entry, delay)
+
+    def spawn(self, group):
+        task = asyncio.create_task(self.send(group))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def run(self):
+        while True:
+            ready, until = [], time.time()
+            while self.due and self.due[0][0] <= until:
+                ready.append(self.entries[heapq.heappop(self.due)[2]])
+                if self.batchable(ready[-1]):
+                    # Take what would join this batch within the window now rather than later
+                    until = max(until, time.time() + self.batch_window)
+            batches = {}
+            for entry in ready:
+                if self.batchable(entry):
+                    batches.setdefault(entry['webhook_url'], []).append(entry)
+                else:
+                    self.spawn([entry])
+            for group in batches.values():
+                for i in range(0, len(group), self.batch_max):
+                    self.spawn(group[i:i + self.batch_max])
+            self.wakeup.clear()
+            timeout = self.due[0][0] - time.time() if self.due else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop sending; whatever is still queued stays in the spool for the next start"""
+        tasks = [self.task, *self.sending] if self.task else list(self.sending)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+        self.entries.clear()
+        self.due.clear()
+
+    def oldest_seconds(self):
+        if not self.entries:
+            return 0.0
+        return time.time() - min(entry['created'] for entry in self.entries.values())
+
+    def stats(self):
+        return {
+            'backlog': len(self.entries),
+            'sending': len(self.sending),
+            'oldest_seconds': round(self.oldest_seconds(), 1),
+            'delivered': self.delivered,
+            'retries': self.retries,
+            'dropped': self.dropped,
+            'batches': self.batches,
+        }
+
+callbacks = CallbackQueue(CALLBACK_SPOOL_DIR, CALLBACK_MAX_ATTEMPTS, CALLBACK_BACKOFF_SECONDS,
+                          CALLBACK_BACKOFF_MAX_SECONDS, CALLBACK_CONCURRENCY, CALLBACK_BATCH_MAX,
+                          CALLBACK_BATCH_WINDOW_MS / 1000)
+
+async def send_callback(webhook_url, job_id, filenames, success, error=None, is_upscale=False, images=None,
+                        execution_time=None):
+    """Queue the job result for the webhook (see CallbackQueue).
+
+    Metadata is the same in every mode; DELIVERY_MODE picks how the images
+    travel (see DELIVERY_MODES). Failures always go as plain JSON. Pass
+    `images` to skip downloading `filenames`.
+    """
     if not webhook_url:
         return
         
     payload = {'success': success, 'job_id': job_id, 'is_upscale': is_upscale}
     
-    if success and filename:
-        async with httpx.AsyncClient() as c:
-            img_resp = await c.get(f'{COMFYUI}/view?filename={filename}')
-            payload['image_base64'] = base64.b64encode(img_resp.content).decode()
-            payload['execution_time'] = 40
+    if success and (filenames or images):
+        payload['execution_time'] = round(execution_time, 2) if execution_time is not None else None
     else:
         payload['error'] = error or 'Unknown error'
+        filenames = images = None
     
-    async with httpx.AsyncClient(timeout=30.0) as c:
-        await c.post(webhook_url, 
-            headers={'X-API-Secret': API_SECRET},
-            json=payload)
-        print(f"📧 Callback sent! (upscale={is_upscale})")
+    await callbacks.submit(webhook_url, payload, filenames, images)
+    print(f"📧 Callback queued (upscale={is_upscale}, delivery={DELIVERY_MODE if filenames or images else 'json'})")
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 
 if __name__ == '__main__':
     print("🚀 FLUX Kontext Worker v2.0")
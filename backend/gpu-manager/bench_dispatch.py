@@ -0,0 +1,114 @@
+"""
+GPU manager benchmarks against a local fake cluster (fake_cluster.py).
+
+    python bench_dispatch.py latency --jobs 8 --poll-interval 10
+        time-to-dispatch, polling vs push (/wake) mode
+    python bench_dispatch.py pool --jobs 40 --instances 1 2 4
+        throughput of a burst of jobs as the instance pool grows
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import httpx
+
+import gpu_manager as gm
+from gpu_manager import GPUManager
+from ledger import DispatchLedger
+from fake_cluster import FakeCluster
+
+
+async def start_manager(cluster, poll_interval, wake_port=0):
+    gm.WEBHOOK_BASE_URL = cluster.base_url
+    gm.POLL_INTERVAL_SECONDS = poll_interval
+    gm.WAKE_PORT = wake_port
+    gm.SAFETY_POLL_SECONDS = 300
+    manager = GPUManager(cluster.instance_ids, ledger=DispatchLedger(":memory:"))
+    manager.VASTAI_API_URL = cluster.vastai_url
+    manager.api_key = "fake"
+    return manager, asyncio.create_task(manager.run())
+
+
+async def run_latency(mode, jobs, poll_interval, port, wake_port, seed):
+    cluster = FakeCluster(instances=1, port=port, job_seconds=0.1)
+    await cluster.start()
+    manager, loop_task = await start_manager(cluster, poll_interval, wake_port if mode == "push" else 0)
+    await asyncio.sleep(0.5)
+
+    rng = random.Random(seed)
+    async with httpx.AsyncClient() as client:
+        for i in range(jobs):
+            await asyncio.sleep(rng.uniform(0, poll_interval))
+            cluster.submit(f"{mode}-{i}")
+            if mode == "push":
+                await client.post(f"http://127.0.0.1:{wake_port}/wake", headers={"X-API-Secret": gm.API_SECRET})
+
+    while len(cluster.dispatched) < jobs:
+        await asyncio.sleep(0.05)
+    await manager.stop()
+    await cluster.stop()
+    return sorted(cluster.dispatched[j] - cluster.submitted[j] for j in cluster.dispatched)
+
+
+async def run_pool(instances, jobs, job_seconds, port):
+    cluster = FakeCluster(instances=instances, port=port, job_seconds=job_seconds, running=False)
+    await cluster.start()
+    gm.JOBS_PER_INSTANCE = max(jobs // instances, 1)
+    for i in range(jobs):
+        cluster.submit(f"pool-{i}")
+    started = time.monotonic()
+    manager, loop_task = await start_manager(cluster, poll_interval=1)
+
+    while len(cluster.completed) < jobs:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    await manager.stop()
+    await cluster.stop()
+    per_instance = [w.completed for w in cluster.workers.values()]
+    return elapsed, per_instance
+
+
+def bench_latency(args):
+    print(f"{'mode':<6} {'mean':>8} {'p50':>8} {'max':>8}")
+    for mode in ("poll", "push"):
+        waits = asyncio.run(run_latency(mode, args.jobs, args.poll_interval, args.port, args.wake_port, args.seed))
+        print(f"{mode:<6} {statistics.mean(waits):>7.2f}s {statistics.median(waits):>7.2f}s {waits[-1]:>7.2f}s")
+
+
+def bench_pool(args):
+    results = []
+    for instances in args.instances:
+        elapsed, per_instance = asyncio.run(run_pool(instances, args.jobs, args.job_seconds, args.port))
+        results.append((instances, elapsed, per_instance))
+    print(f"{'instances':>9} {'total':>8} {'jobs/s':>8}  per instance")
+    for instances, elapsed, per_instance in results:
+        print(f"{instances:>9} {elapsed:>7.2f}s {args.jobs / elapsed:>8.2f}  {per_instance}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=18500)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    latency = sub.add_parser("latency", help="time-to-dispatch, polling vs push")
+    latency.add_argument("--jobs", type=int, default=8)
+    latency.add_argument("--poll-interval", type=int, default=10)
+    latency.add_argument("--wake-port", type=int, default=18490)
+    latency.add_argument("--seed", type=int, default=1)
+    latency.set_defaults(func=bench_latency)
+
+    pool = sub.add_parser("pool", help="burst throughput vs pool size")
+    pool.add_argument("--jobs", type=int, default=40)
+    pool.add_argument("--instances", type=int, nargs="+", default=[1, 2, 4])
+    pool.add_argument("--job-seconds", type=float, default=0.25)
+    pool.set_defaults(func=bench_pool)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
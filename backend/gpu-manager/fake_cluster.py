@@ -0,0 +1,185 @@
+"""
+Fake Vast.ai API, jobs API and GPU workers on localhost, for exercising
+GPUManager without real instances.
+
+One server on `port` answers the Vast.ai instance API (/api/v0/instances/)
+and the app's jobs API (/api/jobs/pending); each instance gets a worker on
+`port + 1 + i` that queues jobs and "renders" them one at a time.
+
+    cluster = FakeCluster(instances=3, port=18500, job_seconds=0.5)
+    await cluster.start()
+    manager = GPUManager(cluster.instance_ids)
+    manager.VASTAI_API_URL = cluster.vastai_url
+"""
+
+import asyncio
+import json
+import time
+
+from gpu_manager import read_http_request, http_response
+
+
+class FakeWorker:
+    """One instance: Vast.ai state plus a worker with a bounded job queue"""
+
+    def __init__(self, cluster, instance_id, port, running):
+        self.cluster = cluster
+        self.instance_id = instance_id
+        self.port = port
+        self.state = "running" if running else "stopped"
+        self.booted_at = time.monotonic() if running else None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=cluster.max_depth)
+        self.in_flight = 0
+        self.completed = 0
+        self.server = None
+        self.runner = None
+
+    @property
+    def actual_status(self):
+        if self.state == "running" and time.monotonic() >= self.booted_at:
+            return "running"
+        return "loading" if self.state == "running" else "stopped"
+
+    def set_state(self, state):
+        if state == "running" and self.state != "running":
+            self.booted_at = time.monotonic() + self.cluster.boot_seconds
+        self.state = state
+
+    def describe(self):
+        running = self.actual_status == "running"
+        return {
+            "id": self.instance_id,
+            "actual_status": self.actual_status,
+            "public_ipaddr": "127.0.0.1" if running else None,
+            "ports": {"8000/tcp": [{"HostPort": self.port}]} if running else {},
+            "gpu_name": "FAKE",
+            "dph_total": self.cluster.cost_per_hour,
+        }
+
+    async def run(self):
+        while True:
+            job_id = await self.queue.get()
+            self.in_flight += 1
+            await asyncio.sleep(self.cluster.job_seconds)
+            self.in_flight -= 1
+            self.completed += 1
+            self.cluster.complete(job_id)
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _, body = await read_http_request(reader)
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            writer.close()  # client hung up without a request
+            return
+        if self.actual_status != "running" or time.monotonic() < self.booted_at + self.cluster.worker_seconds:
+            writer.close()
+            return
+        if path == "/health":
+            warm = time.monotonic() >= self.booted_at + self.cluster.worker_seconds + self.cluster.warmup_seconds
+            writer.write(http_response(200, {
+                "status": "healthy", "state": "ready" if warm else "warming", "comfyui": True, "models_loaded": warm}))
+        elif path == "/queue":
+            writer.write(http_response(200, {
+                "depth": self.queue.qsize(), "max_depth": self.queue.maxsize, "in_flight": self.in_flight}))
+        elif path == "/generate/async":
+            job_id = json.loads(body)["job_id"]
+            if self.cluster.fail_sends > 0:
+                self.cluster.fail_sends -= 1
+                writer.write(http_response(500, {"status": "error"}))
+            elif self.queue.full():
+                writer.write(http_response(429, {"status": "queue_full"}))
+            else:
+                self.queue.put_nowait(job_id)
+                self.cluster.accept(job_id, self.instance_id)
+                writer.write(http_response(200, {"status": "queued"}))
+        else:
+            writer.write(http_response(404, {}))
+        await writer.drain()
+        writer.close()
+
+
+class FakeCluster:
+    def __init__(self, instances=1, port=18500, job_seconds=0.5, boot_seconds=0.0, worker_seconds=0.0,
+                 warmup_seconds=0.0, max_depth=20, running=True, cost_per_hour=0.5, pending_until_done=False,
+                 fail_sends=0):
+        self.port = port
+        self.job_seconds = job_seconds
+        self.boot_seconds = boot_seconds
+        self.worker_seconds = worker_seconds  # instance running -> worker answering
+        self.warmup_seconds = warmup_seconds  # worker answering -> models loaded
+        self.max_depth = max_depth
+        self.cost_per_hour = cost_per_hour
+        # Like the real app: a job stays pending until its webhook arrives
+        self.pending_until_done = pending_until_done
+        self.fail_sends = fail_sends  # answer this many /generate/async calls with a 500
+        self.workers = {
+            str(1000 + i): FakeWorker(self, str(1000 + i), port + 1 + i, running) for i in range(instances)
+        }
+        self.pending = {}      # job_id -> job
+        self.submitted = {}    # job_id -> submit time
+        self.dispatched = {}   # job_id -> time a worker accepted it
+        self.completed = {}    # job_id -> time a worker finished it
+        self.sent_to = {}      # job_id -> instance id
+        self.sends = {}        # job_id -> times a worker accepted it
+        self.server = None
+
+    @property
+    def instance_ids(self):
+        return list(self.workers)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def vastai_url(self):
+        return f"{self.base_url}/api/v0"
+
+    def submit(self, job_id):
+        self.pending[job_id] = {"_id": job_id, "input": {"prompt": "fake", "settings": {}}}
+        self.submitted[job_id] = time.monotonic()
+
+    def accept(self, job_id, instance_id):
+        self.sends[job_id] = self.sends.get(job_id, 0) + 1
+        self.dispatched.setdefault(job_id, time.monotonic())
+        self.sent_to[job_id] = instance_id
+        if not self.pending_until_done:
+            self.pending.pop(job_id, None)
+
+    def complete(self, job_id):
+        self.completed[job_id] = time.monotonic()
+        self.pending.pop(job_id, None)
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _, body = await read_http_request(reader)
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            writer.close()  # client hung up without a request
+            return
+        if path == "/api/v0/instances/":
+            writer.write(http_response(200, {"instances": [w.describe() for w in self.workers.values()]}))
+        elif path.startswith("/api/v0/instances/") and method == "PUT":
+            worker = self.workers.get(path.strip("/").split("/")[-1])
+            if worker is None:
+                writer.write(http_response(404, {}))
+            else:
+                worker.set_state(json.loads(body)["state"])
+                writer.write(http_response(200, {"success": True}))
+        elif path == "/api/jobs/pending":
+            writer.write(http_response(200, {"jobs": list(self.pending.values())}))
+        else:
+            writer.write(http_response(404, {}))
+        await writer.drain()
+        writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", self.port)
+        for worker in self.workers.values():
+            worker.server = await asyncio.start_server(worker.handle, "127.0.0.1", worker.port)
+            worker.runner = asyncio.create_task(worker.run())
+
+    async def stop(self):
+        for worker in self.workers.values():
+            worker.runner.cancel()
+            worker.server.close()
+        self.server.close()
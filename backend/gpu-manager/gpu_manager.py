@@ -5,15 +5,23 @@ Manages GPU instance lifecycle and job queue processing
 
 import os
 import asyncio
+import json
 import time
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime
 from typing import Optional, Dict, Any
 import httpx
 
+from ledger import DispatchLedger
+from scaling import ScalingPolicy, make_policy, load_policy_state, save_policy_state
+
 
 # Configuration
 VASTAI_API_KEY = os.getenv("VASTAI_API_KEY", "")
 VASTAI_INSTANCE_ID = os.getenv("VASTAI_INSTANCE_ID", "")
+# Pool of instances (comma-separated); defaults to the single VASTAI_INSTANCE_ID
+VASTAI_INSTANCE_IDS = [i.strip() for i in os.getenv("VASTAI_INSTANCE_IDS", VASTAI_INSTANCE_ID).split(",") if i.strip()]
+VASTAI_API_URL = os.getenv("VASTAI_API_URL", "https://console.vast.ai/api/v0")
 MONGODB_URI = os.getenv("MONGODB_URI", "")
 API_SECRET = os.getenv("API_SECRET", "")
 WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
@@ -21,25 +29,187 @@ WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
 # Timing settings
 IDLE_TIMEOUT_MINUTES = int(os.getenv("IDLE_TIMEOUT_MINUTES", "10"))
 POLL_INTERVAL_SECONDS = int(os.getenv("POLL_INTERVAL_SECONDS", "30"))
-STARTUP_WAIT_SECONDS = int(os.getenv("STARTUP_WAIT_SECONDS", "120"))
+# Cold start budget: instance boot plus the worker warm-up (up to its WARMUP_TIMEOUT_SECONDS)
+STARTUP_WAIT_SECONDS = int(os.getenv("STARTUP_WAIT_SECONDS", "900"))
+
+# Push mode: POST /wake on this port runs the loop immediately (0 = polling only).
+# With push enabled polling is only a safety net, so SAFETY_POLL_SECONDS can be long.
+WAKE_PORT = int(os.getenv("WAKE_PORT", "0"))
+SAFETY_POLL_SECONDS = int(os.getenv("SAFETY_POLL_SECONDS", "300"))
+
+# Dispatch: at most this many sends in flight (further capped by the worker's free
+# queue slots), each retried with exponential backoff
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", "8"))
+DISPATCH_RETRIES = int(os.getenv("DISPATCH_RETRIES", "3"))
+DISPATCH_BACKOFF_SECONDS = float(os.getenv("DISPATCH_BACKOFF_SECONDS", "1.0"))
+
+# Readiness probing after a start: first probe after PROBE_MIN_SECONDS, backing off
+# x1.5 up to PROBE_MAX_SECONDS (reset whenever the instance gets one stage further)
+PROBE_MIN_SECONDS = float(os.getenv("PROBE_MIN_SECONDS", "0.5"))
+PROBE_MAX_SECONDS = float(os.getenv("PROBE_MAX_SECONDS", "5"))
+
+# Vast.ai status is cached this long (concurrent callers share one fetch)
+STATUS_CACHE_SECONDS = float(os.getenv("STATUS_CACHE_SECONDS", "5"))
+
+# Pool scaling: one running instance per this many pending jobs
+JOBS_PER_INSTANCE = int(os.getenv("JOBS_PER_INSTANCE", "10"))
+
+# Scaling policy (see scaling.py): "reactive" (idle timeout) or "predictive" (arrival-rate based)
+SCALING_POLICY = os.getenv("SCALING_POLICY", "reactive")
+COLD_START_SECONDS = float(os.getenv("COLD_START_SECONDS", "90"))
+COLD_START_PENALTY = float(os.getenv("COLD_START_PENALTY", "0.05"))
+JOB_SECONDS_ESTIMATE = float(os.getenv("JOB_SECONDS_ESTIMATE", "40"))
+PREWARM_JOBS = float(os.getenv("PREWARM_JOBS", "1.0"))
+GPU_COST_PER_HOUR = float(os.getenv("GPU_COST_PER_HOUR", "0.5"))
+SCALING_STATE_FILE = os.getenv("SCALING_STATE_FILE", "")
+
+# Dispatch ledger (see ledger.py): a dispatched job is not sent again until its lease runs out
+LEDGER_PATH = os.getenv("LEDGER_PATH", "dispatch_ledger.db")
+DISPATCH_LEASE_SECONDS = float(os.getenv("DISPATCH_LEASE_SECONDS", "900"))
+DISPATCH_MAX_ATTEMPTS = int(os.getenv("DISPATCH_MAX_ATTEMPTS", "3"))
+
+
+async def read_http_request(reader: asyncio.StreamReader):
+    """Minimal HTTP/1.1 request parser: returns (method, path, headers, body)"""
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    method, path, _ = request_line.split(" ", 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+def http_response(status: int, payload: Dict[str, Any]) -> bytes:
+    body = json.dumps(payload).encode()
+    reason = {200: "OK", 401: "Unauthorized", 404: "Not Found"}.get(status, "Error")
+    return (f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body
+
+
+class WorkerInstance:
+    """State of one Vast.ai instance and the worker running on it"""
+    
+    def __init__(self, instance_id: str):
+        self.instance_id = instance_id
+        self.status = "unknown"
+        self.ip: Optional[str] = None
+        self.ports: Dict[str, Any] = {}
+        self.cost_per_hour = 0.0
+        self.worker_url: Optional[str] = None
+        self.last_job_time: Optional[datetime] = None
+        self.warming: Optional[asyncio.Task] = None
+        self.start_requested: Optional[float] = None
+        self.timeline: Dict[str, float] = {}  # cold-start stage -> seconds since start request
+        # Load, refreshed from the worker's /queue and counted locally between refreshes
+        self.depth = 0
+        self.in_flight = 0
+        self.max_depth = DISPATCH_CONCURRENCY
+        self.assigned = 0
+        self.latency = 0.0  # EWMA of send round-trip seconds
+        self.failures = 0
+    
+    @property
+    def running(self) -> bool:
+        return self.status == "running"
+    
+    @property
+    def healthy(self) -> bool:
+        return self.running and self.worker_url is not None and self.failures < DISPATCH_RETRIES
+    
+    @property
+    def outstanding(self) -> int:
+        return self.depth + self.in_flight + self.assigned
+    
+    @property
+    def capacity(self) -> int:
+        return max(self.max_depth - self.depth - self.assigned, 0)
+    
+    def record_latency(self, seconds: float):
+        self.latency = seconds if not self.latency else 0.8 * self.latency + 0.2 * seconds
+    
+    def mark(self, stage: str) -> bool:
+        """Record the first time a cold-start stage is reached"""
+        if stage in self.timeline:
+            return False
+        self.timeline[stage] = round(time.monotonic() - self.start_requested, 2)
+        return True
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "cold_start": self.timeline,
+            "worker_url": self.worker_url,
+            "outstanding": self.outstanding,
+            "latency": round(self.latency, 3),
+            "failures": self.failures,
+        }
 
 
 class GPUManager:
     """
-    Manages GPU instance and job queue.
-    - Starts GPU when jobs are pending
-    - Stops GPU after idle timeout
-    - Processes jobs from queue
+    Manages a pool of GPU instances and the job queue.
+    - Starts instances when jobs are pending (more as the queue grows)
+    - Stops instances after idle timeout
+    - Routes each job to the least-loaded healthy worker
     """
     
-    VASTAI_API_URL = "https://console.vast.ai/api/v0"
+    VASTAI_API_URL = VASTAI_API_URL
     
-    def __init__(self):
+    def __init__(self, instance_ids: Optional[list] = None, policy: Optional[ScalingPolicy] = None,
+                 ledger: Optional[DispatchLedger] = None):
         self.api_key = VASTAI_API_KEY
-        self.instance_id = VASTAI_INSTANCE_ID
+        self.instances: Dict[str, WorkerInstance] = {
+            str(i): WorkerInstance(str(i)) for i in (instance_ids or VASTAI_INSTANCE_IDS)
+        }
+        self.policy = policy or make_policy(
+            SCALING_POLICY,
+            jobs_per_instance=JOBS_PER_INSTANCE,
+            idle_timeout_seconds=IDLE_TIMEOUT_MINUTES * 60,
+            cold_start_seconds=COLD_START_SECONDS,
+            cold_start_penalty=COLD_START_PENALTY,
+            job_seconds=JOB_SECONDS_ESTIMATE,
+            prewarm_jobs=PREWARM_JOBS,
+            cost_per_hour=GPU_COST_PER_HOUR,
+        )
+        load_policy_state(self.policy, SCALING_STATE_FILE)
+        self.seen_jobs: set = set()
+        self.ledger = ledger or DispatchLedger(LEDGER_PATH, DISPATCH_LEASE_SECONDS, DISPATCH_MAX_ATTEMPTS)
         self.last_job_time: Optional[datetime] = None
-        self.worker_url: Optional[str] = None
         self._running = False
+        self._wake = asyncio.Event()
+        self._wake_server: Optional[asyncio.AbstractServer] = None
+        self._run_task: Optional[asyncio.Task] = None
+        self.wakes = 0
+        # One pooled client per upstream: "vastai", "app" (jobs API), "worker" (all GPU workers)
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self._statuses: Optional[Dict[str, Dict[str, Any]]] = None
+        self._statuses_at = 0.0
+        self._status_fetch: Optional[asyncio.Task] = None
+        self._status_generation = 0  # bumped on invalidation; older fetches are not cached
+        self.status_fetches = 0
+        self.status_hits = 0
+        self.cold_starts = deque(maxlen=20)  # recent cold-start timelines
+    
+    def client(self, upstream: str) -> httpx.AsyncClient:
+        """Long-lived pooled client for an upstream (created on first use)"""
+        client = self.clients.get(upstream)
+        if client is None:
+            client = self.clients[upstream] = httpx.AsyncClient(
+                timeout=30.0,
+                limits=httpx.Limits(max_connections=DISPATCH_CONCURRENCY * max(len(self.instances), 1) + 4,
+                                    max_keepalive_connections=DISPATCH_CONCURRENCY),
+            )
+        return client
+    
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
     
     @property
     def headers(self) -> Dict[str, str]:
@@ -49,228 +219,523 @@ class GPUManager:
             "Authorization": f"Bearer {self.api_key}",
         }
     
-    async def get_instance_status(self) -> Dict[str, Any]:
-        """Get current instance status from Vast.ai"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.VASTAI_API_URL}/instances/",
-                headers=self.headers,
-                timeout=30.0
-            )
-            response.raise_for_status()
-            
-            instances = response.json().get("instances", [])
-            for inst in instances:
-                if str(inst.get("id")) == str(self.instance_id):
-                    return {
-                        "id": inst["id"],
-                        "status": inst.get("actual_status", "unknown"),
-                        "ip": inst.get("public_ipaddr"),
-                        "ports": inst.get("ports", {}),
-                        "gpu": inst.get("gpu_name"),
-                        "cost_per_hour": inst.get("dph_total", 0),
-                    }
-            
-            return {"status": "not_found"}
+    async def fetch_instance_statuses(self) -> Dict[str, Dict[str, Any]]:
+        """Get the status of every instance on the account from Vast.ai"""
+        self.status_fetches += 1
+        generation = self._status_generation
+        response = await self.client("vastai").get(
+            f"{self.VASTAI_API_URL}/instances/",
+            headers=self.headers,
+            timeout=30.0
+        )
+        response.raise_for_status()
+        
+        statuses = {}
+        for inst in response.json().get("instances", []):
+            statuses[str(inst.get("id"))] = {
+                "id": inst["id"],
+                "status": inst.get("actual_status", "unknown"),
+                "ip": inst.get("public_ipaddr"),
+                "ports": inst.get("ports", {}),
+                "gpu": inst.get("gpu_name"),
+                "cost_per_hour": inst.get("dph_total", 0),
+            }
+        if generation == self._status_generation:
+            self._statuses, self._statuses_at = statuses, time.monotonic()
+        return statuses
+    
+    async def get_instance_statuses(self, max_age: float = STATUS_CACHE_SECONDS) -> Dict[str, Dict[str, Any]]:
+        """Instance statuses, cached for up to `max_age`; concurrent callers share one fetch"""
+        if self._statuses is not None and time.monotonic() - self._statuses_at < max_age:
+            self.status_hits += 1
+            return self._statuses
+        if self._status_fetch is None or self._status_fetch.done():
+            self._status_fetch = asyncio.create_task(self.fetch_instance_statuses())
+        # Shield so one caller giving up does not cancel the fetch for the others
+        return await asyncio.shield(self._status_fetch)
     
-    async def start_instance(self) -> bool:
-        """Start the GPU instance"""
-        print(f"🚀 Starting GPU instance {self.instance_id}...")
+    def invalidate_statuses(self):
+        """Drop the cached status (after a start/stop changes it), including a fetch already under way"""
+        self._statuses = None
+        self._status_generation += 1
+        self._status_fetch = None
+    
+    async def refresh_instances(self):
+        """Update the pool from Vast.ai (one API call for all instances)"""
+        statuses = await self.get_instance_statuses()
+        for inst in self.instances.values():
+            status = statuses.get(inst.instance_id, {"status": "not_found"})
+            inst.status = status.get("status", "unknown")
+            inst.ip = status.get("ip")
+            inst.ports = status.get("ports", {})
+            inst.cost_per_hour = status.get("cost_per_hour", 0)
+            if not inst.running:
+                inst.worker_url = None
+    
+    async def set_instance_state(self, inst: WorkerInstance, state: str) -> bool:
+        response = await self.client("vastai").put(
+            f"{self.VASTAI_API_URL}/instances/{inst.instance_id}/",
+            headers=self.headers,
+            json={"state": state},
+            timeout=30.0
+        )
+        self.invalidate_statuses()
         
-        async with httpx.AsyncClient() as client:
-            response = await client.put(
-                f"{self.VASTAI_API_URL}/instances/{self.instance_id}/",
-                headers=self.headers,
-                json={"state": "running"},
-                timeout=30.0
-            )
-            
-            if response.status_code in (200, 202):
-                print("✅ Instance start requested")
-                return True
-            
-            print(f"❌ Failed to start: {response.status_code}")
-            return False
+        if response.status_code in (200, 202):
+            return True
+        
+        print(f"❌ Failed to set {inst.instance_id} {state}: {response.status_code}")
+        return False
     
-    async def stop_instance(self) -> bool:
-        """Stop the GPU instance (keeps storage)"""
-        print(f"⏹️ Stopping GPU instance {self.instance_id}...")
+    async def start_instance(self, inst: WorkerInstance) -> bool:
+        """Start a GPU instance"""
+        print(f"🚀 Starting GPU instance {inst.instance_id}...")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.put(
-                f"{self.VASTAI_API_URL}/instances/{self.instance_id}/",
-                headers=self.headers,
-                json={"state": "stopped"},
-                timeout=30.0
-            )
-            
-            if response.status_code in (200, 202):
-                print("✅ Instance stop requested")
-                self.worker_url = None
-                return True
-            
-            print(f"❌ Failed to stop: {response.status_code}")
-            return False
+        if await self.set_instance_state(inst, "running"):
+            print("✅ Instance start requested")
+            inst.status = "starting"
+            inst.failures = 0
+            inst.start_requested = time.monotonic()
+            inst.timeline = {}
+            return True
+        return False
+    
+    async def stop_instance(self, inst: WorkerInstance) -> bool:
+        """Stop a GPU instance (keeps storage)"""
+        print(f"⏹️ Stopping GPU instance {inst.instance_id}...")
+        
+        if await self.set_instance_state(inst, "stopped"):
+            print("✅ Instance stop requested")
+            inst.status = "stopping"
+            inst.worker_url = None
+            inst.last_job_time = None
+            return True
+        return False
+    
+    def worker_url_for(self, inst: WorkerInstance) -> str:
+        port = 8000  # Default
+        if "8000/tcp" in inst.ports:
+            port = inst.ports["8000/tcp"][0].get("HostPort", 8000)
+        return f"http://{inst.ip}:{port}"
+    
+    async def probe_health(self, worker_url: str) -> Optional[Dict[str, Any]]:
+        """One quick /health probe; None if the worker is not answering yet"""
+        try:
+            response = await self.client("worker").get(f"{worker_url}/health", timeout=2.0)
+            if response.status_code == 200:
+                return response.json()
+        except Exception:
+            pass
+        return None
     
-    async def wait_for_worker(self, timeout: int = STARTUP_WAIT_SECONDS) -> bool:
-        """Wait for worker to be ready after instance starts"""
-        print("⏳ Waiting for worker to initialize...")
+    def record_health(self, inst: WorkerInstance, health: Dict[str, Any]) -> bool:
+        """Advance the cold-start timeline from a /health answer; True if a new stage was reached"""
+        progressed = inst.mark("worker_up")
+        if health.get("comfyui"):
+            progressed |= inst.mark("comfyui_up")
+        if health.get("models_loaded"):
+            progressed |= inst.mark("models_loaded")
+        return progressed
+    
+    async def wait_for_worker(self, inst: WorkerInstance, timeout: int = STARTUP_WAIT_SECONDS) -> bool:
+        """
+        Wait for an instance's worker to be ready (healthy and warmed up) after it starts.
+        
+        Until Vast.ai reports an address the status is polled (with /health probed
+        in parallel on the last known address); after that only the worker is
+        probed. Intervals start at PROBE_MIN_SECONDS and back off to
+        PROBE_MAX_SECONDS, resetting whenever a new stage is reached.
+        """
+        print(f"⏳ Waiting for worker on {inst.instance_id} to initialize...")
         
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            status = await self.get_instance_status()
+        if inst.start_requested is None:
+            # Already running when the manager came up: time from now
+            inst.start_requested, inst.timeline = time.monotonic(), {}
+        deadline = time.monotonic() + timeout
+        interval = PROBE_MIN_SECONDS
+        
+        while time.monotonic() < deadline:
+            progressed = False
+            worker_url = self.worker_url_for(inst) if inst.ip and "running" in inst.timeline else None
             
-            if status.get("status") == "running" and status.get("ip"):
-                # Get worker port
-                ports = status.get("ports", {})
-                port = 8000  # Default
-                if "8000/tcp" in ports:
-                    port = ports["8000/tcp"][0].get("HostPort", 8000)
-                
-                worker_url = f"http://{status['ip']}:{port}"
-                
-                # Check health
-                try:
-                    async with httpx.AsyncClient(timeout=10.0) as client:
-                        response = await client.get(f"{worker_url}/health")
-                        if response.status_code == 200:
-                            data = response.json()
-                            if data.get("status") == "healthy":
-                                print(f"✅ Worker ready at {worker_url}")
-                                self.worker_url = worker_url
-                                return True
-                except Exception:
-                    pass
+            if worker_url is None:
+                # Ask Vast.ai, probing the previous address at the same time
+                probe = self.probe_health(self.worker_url_for(inst)) if inst.ip else asyncio.sleep(0)
+                statuses, health = await asyncio.gather(self.get_instance_statuses(max_age=interval), probe)
+                status = statuses.get(inst.instance_id, {})
+                if status.get("status") == "running" and status.get("ip"):
+                    inst.status = "running"
+                    inst.ip = status["ip"]
+                    inst.ports = status.get("ports", {})
+                    progressed = inst.mark("running")
+                    worker_url = self.worker_url_for(inst)
+                    if health is None:
+                        health = await self.probe_health(worker_url)
+            else:
+                health = await self.probe_health(worker_url)
+            
+            if health:
+                progressed |= self.record_health(inst, health)
+                # Workers that warm up report state "warming" until models are loaded
+                if health.get("status") == "healthy" and health.get("state", "ready") == "ready":
+                    inst.mark("running")
+                    inst.mark("ready")
+                    print(f"✅ Worker ready at {worker_url}")
+                    stages = sorted(inst.timeline.items(), key=lambda item: item[1])
+                    print(f"⏱️ Cold start {inst.instance_id}: " +
+                          " → ".join(f"{stage} +{seconds}s" for stage, seconds in stages))
+                    self.cold_starts.append({"instance": inst.instance_id, **inst.timeline})
+                    inst.worker_url = worker_url
+                    inst.failures = 0
+                    inst.start_requested = None
+                    # Idle time counts from when the worker came up
+                    inst.last_job_time = inst.last_job_time or datetime.now()
+                    return True
             
-            await asyncio.sleep(10)
+            interval = PROBE_MIN_SECONDS if progressed else min(interval * 1.5, PROBE_MAX_SECONDS)
+            await asyncio.sleep(interval)
         
-        print("❌ Timeout waiting for worker")
+        print(f"❌ Timeout waiting for worker on {inst.instance_id}")
+        inst.start_requested = None
         return False
     
+    def warm_up(self, inst: WorkerInstance):
+        """Wait for a worker in the background (no-op if already waiting)"""
+        if inst.warming is None or inst.warming.done():
+            inst.warming = asyncio.create_task(self.wait_for_worker(inst))
+    
     async def get_pending_jobs(self) -> list:
         """Get pending jobs from MongoDB via Vercel API"""
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(
-                    f"{WEBHOOK_BASE_URL}/api/jobs/pending",
-                    headers={"X-API-Secret": API_SECRET}
-                )
-                if response.status_code == 200:
-                    return response.json().get("jobs", [])
+            response = await self.client("app").get(
+                f"{WEBHOOK_BASE_URL}/api/jobs/pending",
+                headers={"X-API-Secret": API_SECRET},
+                timeout=30.0
+            )
+            if response.status_code == 200:
+                return response.json().get("jobs", [])
         except Exception as e:
             print(f"⚠️ Failed to get pending jobs: {e}")
         
         return []
     
+    async def refresh_load(self, inst: WorkerInstance):
+        """Queue depth and capacity from the worker's /queue endpoint.
+        
+        A worker that answers is reachable again, so its dispatch failures are cleared.
+        """
+        inst.assigned = 0
+        try:
+            response = await self.client("worker").get(f"{inst.worker_url}/queue", timeout=10.0)
+            if response.status_code == 200:
+                queue = response.json()
+                if inst.failures:
+                    print(f"♻️ Worker {inst.instance_id} answering again, clearing {inst.failures} failure(s)")
+                    inst.failures = 0
+                inst.depth = queue["depth"]
+                inst.in_flight = queue.get("in_flight", 0)
+                inst.max_depth = queue["max_depth"]
+                return
+        except Exception as e:
+            print(f"⚠️ Failed to get load of {inst.instance_id}: {e}")
+        
+        inst.depth = inst.in_flight = 0
+        inst.max_depth = DISPATCH_CONCURRENCY
+    
+    def pick_worker(self, exclude=()) -> Optional[WorkerInstance]:
+        """Least-loaded healthy worker with free capacity (ties go to the fastest)"""
+        candidates = [inst for inst in self.instances.values()
+                      if inst.healthy and inst.capacity > 0 and inst not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda inst: (inst.outstanding, inst.latency))
+    
+    async def send_job(self, inst: WorkerInstance, job: Dict[str, Any]) -> httpx.Response:
+        """POST one job to a GPU worker"""
+        job_id = job.get("_id") or job.get("id")
+        
+        started = time.monotonic()
+        response = await self.client("worker").post(
+            f"{inst.worker_url}/generate/async",
+            json={
+                "job_id": str(job_id),
+                "image_base64": job.get("input", {}).get("imageData", ""),
+                "prompt": job.get("input", {}).get("prompt", ""),
+                "seed": job.get("input", {}).get("settings", {}).get("seed"),
+                "guidance": job.get("input", {}).get("settings", {}).get("guidance", 3.0),
+                "denoise": job.get("input", {}).get("settings", {}).get("denoise", 0.98),
+                "steps": job.get("input", {}).get("settings", {}).get("steps", 25),
+                "webhook_url": f"{WEBHOOK_BASE_URL}/api/webhook/comfyui",
+            },
+            headers={"X-API-Secret": API_SECRET},
+            timeout=120.0
+        )
+        inst.record_latency(time.monotonic() - started)
+        return response
+    
+    def undispatched(self, pending_jobs: list) -> list:
+        """Pending jobs not already in flight according to the ledger"""
+        leased = self.ledger.leased(str(job.get("_id") or job.get("id")) for job in pending_jobs)
+        return [job for job in pending_jobs if str(job.get("_id") or job.get("id")) not in leased]
+    
     async def process_job(self, job: Dict[str, Any]) -> bool:
-        """Send a job to the GPU worker"""
-        if not self.worker_url:
+        """Claim a job in the ledger and send it, releasing the claim if every attempt fails"""
+        job_id = str(job.get("_id") or job.get("id"))
+        if not self.ledger.claim(job_id):
             return False
         
-        try:
-            job_id = job.get("_id") or job.get("id")
+        inst = await self.send_with_retry(job)
+        if inst is None:
+            self.ledger.release(job_id)
+            return False
+        
+        self.ledger.confirm(job_id, inst.instance_id)
+        return True
+    
+    async def send_with_retry(self, job: Dict[str, Any]) -> Optional[WorkerInstance]:
+        """Send a job to the least-loaded worker, retrying with backoff (on another worker if possible)"""
+        job_id = job.get("_id") or job.get("id")
+        tried = []
+        
+        for attempt in range(DISPATCH_RETRIES + 1):
+            inst = self.pick_worker(exclude=tried) or self.pick_worker()
+            if inst is None:
+                return None
             
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    f"{self.worker_url}/generate/async",
-                    json={
-                        "job_id": str(job_id),
-                        "image_base64": job.get("input", {}).get("imageData", ""),
-                        "prompt": job.get("input", {}).get("prompt", ""),
-                        "seed": job.get("input", {}).get("settings", {}).get("seed"),
-                        "guidance": job.get("input", {}).get("settings", {}).get("guidance", 3.0),
-                        "denoise": job.get("input", {}).get("settings", {}).get("denoise", 0.98),
-                        "steps": job.get("input", {}).get("settings", {}).get("steps", 25),
-                        "webhook_url": f"{WEBHOOK_BASE_URL}/api/webhook/comfyui",
-                    },
-                    headers={"X-API-Secret": API_SECRET}
-                )
+            delay = DISPATCH_BACKOFF_SECONDS * 2 ** attempt
+            inst.assigned += 1
+            try:
+                response = await self.send_job(inst, job)
                 
                 if response.status_code == 200:
-                    self.last_job_time = datetime.now()
-                    print(f"✅ Job {job_id} sent to worker")
-                    return True
+                    inst.failures = 0
+                    inst.last_job_time = self.last_job_time = datetime.now()
+                    print(f"✅ Job {job_id} sent to {inst.instance_id}")
+                    return inst
+                
+                print(f"❌ Failed to send job {job_id} to {inst.instance_id}: {response.status_code}")
+                inst.assigned -= 1
+                if response.status_code == 429:
+                    # Worker queue full: mark it full until the next refresh
+                    inst.max_depth = inst.depth + inst.assigned
+                    delay = max(delay, float(response.headers.get("Retry-After", delay)))
+                elif response.status_code < 500:
+                    return None
                 else:
-                    print(f"❌ Failed to send job: {response.status_code}")
+                    inst.failures += 1
                     
-        except Exception as e:
-            print(f"❌ Error processing job: {e}")
+            except Exception as e:
+                print(f"❌ Error processing job {job_id} on {inst.instance_id}: {e}")
+                inst.assigned -= 1
+                inst.failures += 1
+            
+            tried.append(inst)
+            if attempt < DISPATCH_RETRIES:
+                # Retry at once if another worker can take it, otherwise back off
+                if self.pick_worker(exclude=tried) is None:
+                    await asyncio.sleep(delay)
         
-        return False
+        return None
+    
+    async def dispatch_jobs(self, jobs: list) -> int:
+        """Send jobs concurrently across the pool, bounded by the workers' free capacity"""
+        # Refresh every reachable worker, not only healthy ones: a worker that failed
+        # DISPATCH_RETRIES sends only becomes healthy again when its /queue answers
+        reachable = [inst for inst in self.instances.values() if inst.running and inst.worker_url]
+        if not jobs or not reachable:
+            return 0
+        
+        await asyncio.gather(*(self.refresh_load(inst) for inst in reachable))
+        ready = [inst for inst in reachable if inst.healthy]
+        if not ready:
+            return 0
+        limit = max(min(DISPATCH_CONCURRENCY * len(ready), sum(inst.capacity for inst in ready)), 1)
+        semaphore = asyncio.Semaphore(limit)
+        
+        async def dispatch(job):
+            async with semaphore:
+                return await self.process_job(job)
+        
+        results = await asyncio.gather(*(dispatch(job) for job in jobs))
+        sent = sum(results)
+        print(f"📤 Dispatched {sent}/{len(jobs)} jobs to {len(ready)} workers (concurrency {limit})")
+        return sent
+    
+    def count_arrivals(self, pending_jobs: list) -> int:
+        """Jobs pending now that were not pending at the last check"""
+        ids = {str(job.get("_id") or job.get("id")) for job in pending_jobs}
+        arrivals = len(ids - self.seen_jobs)
+        self.seen_jobs = ids
+        return arrivals
+    
+    def instances_wanted(self, pending: int) -> int:
+        """Instances the scaling policy wants up, capped to the pool size"""
+        return min(self.policy.desired_instances(time.time(), pending), len(self.instances))
+    
+    async def scale_up(self, wanted: int):
+        """Start stopped instances until `wanted` are up"""
+        active = [inst for inst in self.instances.values()
+                  if inst.running or (inst.warming is not None and not inst.warming.done())]
+        stopped = [inst for inst in self.instances.values() if inst not in active]
+        for inst in stopped[:max(wanted - len(active), 0)]:
+            if await self.start_instance(inst):
+                self.warm_up(inst)
+        for inst in active:
+            if inst.running and not inst.worker_url:
+                self.warm_up(inst)
+    
+    async def scale_down(self, wanted: int):
+        """Stop idle instances above `wanted` once the policy says idling costs more than a cold start"""
+        running = [inst for inst in self.instances.values() if inst.running]
+        surplus = len(running) - wanted
+        # Longest idle first
+        for inst in sorted(running, key=lambda inst: inst.last_job_time or datetime.max):
+            if surplus <= 0:
+                break
+            if await self.should_stop_gpu(inst):
+                idle_mins = (datetime.now() - inst.last_job_time).seconds // 60
+                print(f"💤 GPU {inst.instance_id} idle for {idle_mins} minutes, stopping...")
+                if await self.stop_instance(inst):
+                    surplus -= 1
+            elif inst.last_job_time:
+                idle_mins = (datetime.now() - inst.last_job_time).seconds // 60
+                print(f"⏰ GPU {inst.instance_id} idle for {idle_mins} minutes")
+    
+    def wake(self):
+        """Run the manager loop now instead of at the next poll"""
+        self.wakes += 1
+        self._wake.set()
     
-    async def should_stop_gpu(self) -> bool:
-        """Check if GPU should be stopped due to idle timeout"""
-        if not self.last_job_time:
+    async def handle_wake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """POST /wake (called by the app when a job is enqueued), GET /health"""
+        try:
+            method, path, headers, _ = await read_http_request(reader)
+            if method == "POST" and path == "/wake":
+                if headers.get("x-api-secret") != API_SECRET:
+                    writer.write(http_response(401, {"error": "Unauthorized"}))
+                else:
+                    self.wake()
+                    writer.write(http_response(200, {"success": True}))
+            elif method == "GET" and path == "/health":
+                writer.write(http_response(200, {
+                    "status": "ok",
+                    "wakes": self.wakes,
+                    "ledger": self.ledger.stats(),
+                    "status_cache": {"fetches": self.status_fetches, "hits": self.status_hits},
+                    "cold_starts": list(self.cold_starts),
+                    "instances": {i: inst.stats() for i, inst in self.instances.items()},
+                }))
+            else:
+                writer.write(http_response(404, {"error": "Not found"}))
+            await writer.drain()
+        except Exception as e:
+            print(f"⚠️ Bad wake request: {e}")
+        finally:
+            writer.close()
+    
+    async def start_wake_server(self, port: Optional[int] = None):
+        port = port or WAKE_PORT
+        self._wake_server = await asyncio.start_server(self.handle_wake, "0.0.0.0", port)
+        print(f"👂 Wake endpoint listening on :{port}/wake")
+    
+    async def sleep_until_wake(self, timeout: float):
+        """Sleep until the next poll or until woken by a new job"""
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    async def should_stop_gpu(self, inst: WorkerInstance) -> bool:
+        """Check if an idle instance should be stopped (per the scaling policy)"""
+        if not inst.last_job_time:
             return False
         
-        idle_time = datetime.now() - self.last_job_time
-        return idle_time > timedelta(minutes=IDLE_TIMEOUT_MINUTES)
+        idle_time = datetime.now() - inst.last_job_time
+        return self.policy.should_stop(time.time(), idle_time.total_seconds(), inst.cost_per_hour)
     
     async def run(self):
         """Main loop for GPU management"""
         print("🔄 GPU Manager starting...")
-        print(f"   Instance ID: {self.instance_id}")
-        print(f"   Idle timeout: {IDLE_TIMEOUT_MINUTES} minutes")
-        print(f"   Poll interval: {POLL_INTERVAL_SECONDS} seconds")
+        print(f"   Instances: {', '.join(self.instances)}")
+        print(f"   Scaling policy: {type(self.policy).__name__}")
         
-        self._running = True
+        poll_interval = POLL_INTERVAL_SECONDS
+        if WAKE_PORT:
+            await self.start_wake_server()
+            poll_interval = SAFETY_POLL_SECONDS
+        if self.policy.tick_seconds:
+            poll_interval = min(poll_interval, self.policy.tick_seconds)
+        print(f"   Poll interval: {poll_interval} seconds")
         
+        self._running = True
+        self._run_task = asyncio.current_task()
+        try:
+            await self.loop(poll_interval)
+        finally:
+            await self.aclose()
+    
+    async def loop(self, poll_interval: float):
+        """Poll, scale and dispatch until stop()"""
         while self._running:
+            # Wakes that arrive while this iteration runs trigger the next one
+            self._wake.clear()
             try:
                 # Get current instance status
-                status = await self.get_instance_status()
-                instance_running = status.get("status") == "running"
+                await self.refresh_instances()
                 
-                # Get pending jobs
-                pending_jobs = await self.get_pending_jobs()
+                # Get pending jobs, minus those already dispatched and awaiting their webhook
+                all_pending = await self.get_pending_jobs()
+                pending_jobs = self.undispatched(all_pending)
                 has_pending = len(pending_jobs) > 0
                 
-                print(f"\n📊 Status: GPU={'🟢' if instance_running else '🔴'} | "
-                      f"Pending jobs: {len(pending_jobs)} | "
+                print(f"\n📊 Status: GPUs={''.join('🟢' if inst.running else '🔴' for inst in self.instances.values())} | "
+                      f"Pending jobs: {len(pending_jobs)} (+{len(all_pending) - len(pending_jobs)} in flight) | "
                       f"Last job: {self.last_job_time or 'Never'}")
                 
                 # Decision logic
-                if has_pending and not instance_running:
-                    # Start GPU for pending jobs
-                    if await self.start_instance():
-                        if await self.wait_for_worker():
-                            # Process all pending jobs
-                            for job in pending_jobs:
-                                await self.process_job(job)
-                                await asyncio.sleep(2)  # Small delay between jobs
+                self.policy.observe(time.time(), self.count_arrivals(all_pending))
+                save_policy_state(self.policy, SCALING_STATE_FILE)
+                wanted = self.instances_wanted(len(pending_jobs))
                 
-                elif has_pending and instance_running:
-                    # Ensure worker is available
-                    if not self.worker_url:
-                        await self.wait_for_worker()
-                    
-                    if self.worker_url:
-                        # Process pending jobs
-                        for job in pending_jobs:
-                            await self.process_job(job)
-                            await asyncio.sleep(2)
+                # Start instances for the queue (or expected demand)
+                await self.scale_up(wanted)
+                
+                if has_pending:
+                    # Send to whichever workers are ready
+                    if not any(inst.healthy for inst in self.instances.values()):
+                        warming = [inst.warming for inst in self.instances.values() if inst.warming]
+                        if warming:
+                            await asyncio.wait(warming, return_when=asyncio.FIRST_COMPLETED)
+                    await self.dispatch_jobs(pending_jobs)
                 
-                elif not has_pending and instance_running:
-                    # Check for idle timeout
-                    if await self.should_stop_gpu():
-                        print(f"💤 GPU idle for {IDLE_TIMEOUT_MINUTES} minutes, stopping...")
-                        await self.stop_instance()
-                    else:
-                        if self.last_job_time:
-                            idle_mins = (datetime.now() - self.last_job_time).seconds // 60
-                            remaining = IDLE_TIMEOUT_MINUTES - idle_mins
-                            print(f"⏰ GPU will stop in {remaining} minutes if no new jobs")
+                else:
+                    # Stop idle instances the policy no longer wants
+                    await self.scale_down(wanted)
+                    self.ledger.prune()
                 
-                # Wait before next poll
-                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                # Wait before next poll (or until a job is pushed)
+                await self.sleep_until_wake(poll_interval)
                 
             except Exception as e:
                 print(f"❌ Error in manager loop: {e}")
-                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                await self.sleep_until_wake(poll_interval)
     
-    def stop(self):
-        """Stop the manager"""
+    async def stop(self):
+        """Stop the manager: end the loop, then close the ledger it uses"""
         self._running = False
+        self._wake.set()
+        for inst in self.instances.values():
+            if inst.warming:
+                inst.warming.cancel()
+        if self._wake_server:
+            self._wake_server.close()
+        # A dispatch in progress must not touch the ledger after it is closed
+        task = self._run_task
+        if task and task is not asyncio.current_task() and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.aclose()
+        self.ledger.close()
 
 
 async def main():
@@ -281,7 +746,7 @@ async def main():
         await manager.run()
     except KeyboardInterrupt:
         print("\n👋 Shutting down GPU manager...")
-        manager.stop()
+        await manager.stop()
 
 
 if __name__ == "__main__":
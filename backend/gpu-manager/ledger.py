@@ -0,0 +1,109 @@
+"""
+Dispatch ledger for the GPU manager.
+
+The jobs API keeps returning a job as pending until the worker's webhook
+updates it, so without a memory of what was sent the manager would dispatch
+the same job again on every poll. The ledger records each dispatched job ID
+with a lease in a local SQLite file (so it survives restarts):
+
+- claim() takes a lease before sending; jobs with a live lease are skipped
+- confirm() extends the lease once the worker accepted the job
+- release() drops the lease when the send failed, so the next poll retries
+- a job whose lease expired while still pending is dispatched again, up to
+  `max_attempts` times, after which it is marked exhausted and reported;
+  exhausted entries are kept by prune() so the job is never sent again
+"""
+
+import sqlite3
+import time
+from typing import Iterable, Optional
+
+
+class DispatchLedger:
+    def __init__(self, path: str = "dispatch_ledger.db", lease_seconds: float = 900,
+                 max_attempts: int = 3, retention_seconds: float = 86400):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS dispatches (
+                job_id TEXT PRIMARY KEY,
+                instance_id TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dispatched_at REAL,
+                lease_until REAL NOT NULL
+            )
+        """)
+
+    def leased(self, job_ids: Iterable[str], now: Optional[float] = None) -> set:
+        """IDs that must not be dispatched now (live lease or out of attempts)"""
+        now = now or time.time()
+        ids = list(job_ids)
+        if not ids:
+            return set()
+        placeholders = ",".join("?" * len(ids))
+        # Still pending after the last attempt's lease: give up on the job for good
+        exhausted = [row[0] for row in self.db.execute(
+            f"SELECT job_id FROM dispatches WHERE job_id IN ({placeholders}) "
+            "AND status != 'exhausted' AND attempts >= ? AND lease_until <= ?",
+            (*ids, self.max_attempts, now),
+        )]
+        for job_id in exhausted:
+            self.db.execute("UPDATE dispatches SET status = 'exhausted' WHERE job_id = ?", (job_id,))
+            print(f"⚠️ Job {job_id} still pending after {self.max_attempts} dispatches, not sending again")
+        rows = self.db.execute(
+            f"SELECT job_id FROM dispatches WHERE job_id IN ({placeholders}) "
+            "AND (lease_until > ? OR attempts >= ?)",
+            (*ids, now, self.max_attempts),
+        )
+        return {row[0] for row in rows}
+
+    def claim(self, job_id: str, now: Optional[float] = None) -> bool:
+        """Take the lease for a job; False if it is in flight or out of attempts"""
+        now = now or time.time()
+        cursor = self.db.execute(
+            """
+            INSERT INTO dispatches (job_id, status, attempts, lease_until) VALUES (?, 'sending', 1, ?)
+            ON CONFLICT(job_id) DO UPDATE SET
+                status = 'sending', attempts = attempts + 1, lease_until = excluded.lease_until
+            WHERE lease_until <= ? AND attempts < ?
+            """,
+            (job_id, now + self.lease_seconds, now, self.max_attempts),
+        )
+        return cursor.rowcount > 0
+
+    def confirm(self, job_id: str, instance_id: str, now: Optional[float] = None):
+        """The worker accepted the job: hold the lease while it runs"""
+        now = now or time.time()
+        self.db.execute(
+            "UPDATE dispatches SET status = 'dispatched', instance_id = ?, dispatched_at = ?, lease_until = ? "
+            "WHERE job_id = ?",
+            (instance_id, now, now + self.lease_seconds, job_id),
+        )
+
+    def release(self, job_id: str):
+        """The send failed: let the next poll pick the job up again"""
+        self.db.execute(
+            "UPDATE dispatches SET status = 'failed', attempts = attempts - 1, lease_until = 0 WHERE job_id = ?",
+            (job_id,),
+        )
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """Forget entries whose lease ran out more than `retention_seconds` ago (except exhausted ones)"""
+        now = now or time.time()
+        cursor = self.db.execute(
+            "DELETE FROM dispatches WHERE lease_until < ? AND status != 'exhausted'",
+            (now - self.retention_seconds,),
+        )
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        rows = self.db.execute("SELECT status, COUNT(*) FROM dispatches GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        self.db.close()
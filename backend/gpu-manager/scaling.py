@@ -0,0 +1,181 @@
+"""
+Scaling policies for the GPU manager.
+
+A policy decides how many instances should be up and when an idle one may be
+stopped. Policies are plain synchronous objects driven with explicit
+timestamps, so the manager loop and the trace simulator (simulate.py) run
+exactly the same code.
+
+- ReactivePolicy: the original behaviour. Start one instance per
+  `jobs_per_instance` pending jobs, stop after a fixed idle timeout.
+- PredictivePolicy: learns the arrival rate (EWMA plus a time-of-day profile).
+  It keeps idle instances only as long as idling is cheaper than another cold
+  start, and pre-warms one a cold start ahead of expected jobs.
+"""
+
+import inspect
+import json
+import math
+import os
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+
+class ScalingPolicy(ABC):
+    """Base policy: subclasses implement desired_instances and should_stop"""
+
+    # Seconds between manager ticks this policy needs (None = poll interval is fine)
+    tick_seconds: Optional[float] = None
+
+    def observe(self, now: float, arrivals: int):
+        """Record `arrivals` new jobs seen at time `now` (epoch seconds)"""
+
+    @abstractmethod
+    def desired_instances(self, now: float, pending: int) -> int:
+        """Instances that should be up with `pending` jobs waiting"""
+
+    @abstractmethod
+    def should_stop(self, now: float, idle_seconds: float, cost_per_hour: float) -> bool:
+        """Whether an instance idle for `idle_seconds` may be stopped"""
+
+    def state(self) -> Dict[str, Any]:
+        return {}
+
+    def load_state(self, state: Dict[str, Any]):
+        pass
+
+
+class ReactivePolicy(ScalingPolicy):
+    def __init__(self, jobs_per_instance: int = 10, idle_timeout_seconds: float = 600):
+        self.jobs_per_instance = jobs_per_instance
+        self.idle_timeout_seconds = idle_timeout_seconds
+
+    def desired_instances(self, now: float, pending: int) -> int:
+        return math.ceil(pending / self.jobs_per_instance)
+
+    def should_stop(self, now: float, idle_seconds: float, cost_per_hour: float) -> bool:
+        return idle_seconds > self.idle_timeout_seconds
+
+
+class PredictivePolicy(ReactivePolicy):
+    """
+    Arrival-rate driven scaling.
+
+    Scale-down follows the ski-rental rule: idling for break_even() seconds costs
+    as much as one cold start (boot time plus `cold_start_penalty` dollars of user
+    wait), so idle instances stop after that long. An instance started now is
+    ready after a cold start and then kept for the break-even time; while at
+    least `prewarm_jobs` jobs are expected over that span one is started ahead
+    of demand (pre-warm), with enough instances for the expected load at
+    `target_utilization`.
+
+    The rate estimate is the larger of a short EWMA (recent traffic) and the
+    learned profile for the hours the window covers (traffic that usually comes
+    at this time of day).
+    """
+
+    tick_seconds = 60.0
+
+    def __init__(self, jobs_per_instance: int = 10, cold_start_seconds: float = 90,
+                 cold_start_penalty: float = 0.05, job_seconds: float = 40,
+                 prewarm_jobs: float = 1.0, cost_per_hour: float = 0.5, target_utilization: float = 0.7,
+                 ewma_seconds: float = 600, profile_weight: float = 0.3):
+        super().__init__(jobs_per_instance)
+        self.cold_start_seconds = cold_start_seconds
+        self.cold_start_penalty = cold_start_penalty
+        self.job_seconds = job_seconds
+        self.prewarm_jobs = prewarm_jobs
+        self.cost_per_hour = cost_per_hour
+        self.target_utilization = target_utilization
+        self.ewma_seconds = ewma_seconds
+        self.profile_weight = profile_weight
+        self.rate = 0.0                 # recent arrivals per second (EWMA)
+        self.profile = [None] * 24      # arrivals per second by UTC hour of day
+        self.last_observed: Optional[float] = None
+        self.hour: Optional[int] = None
+        self.hour_arrivals = 0
+
+    def observe(self, now: float, arrivals: int):
+        if self.last_observed is not None and now > self.last_observed:
+            dt = now - self.last_observed
+            alpha = 1 - math.exp(-dt / self.ewma_seconds)
+            self.rate += alpha * (arrivals / dt - self.rate)
+        self.last_observed = now
+
+        # Close out finished hours into the time-of-day profile
+        hour = int(now // 3600)
+        if self.hour is None:
+            self.hour = hour
+        while self.hour < hour:
+            slot = self.hour % 24
+            observed = self.hour_arrivals / 3600
+            previous = self.profile[slot]
+            self.profile[slot] = observed if previous is None else (
+                previous + self.profile_weight * (observed - previous))
+            self.hour += 1
+            self.hour_arrivals = 0
+        self.hour_arrivals += arrivals
+
+    def expected_rate(self, now: float, horizon: float) -> float:
+        """Arrivals per second expected over [now, now + horizon]"""
+        first, last = int(now // 3600), int((now + horizon) // 3600)
+        learned = [self.profile[h % 24] for h in range(first, last + 1) if self.profile[h % 24] is not None]
+        return max([self.rate] + learned)
+
+    def break_even(self, cost_per_hour: float) -> float:
+        """Idle seconds that cost as much as one cold start"""
+        if cost_per_hour <= 0:
+            return float("inf")
+        return self.cold_start_seconds + self.cold_start_penalty / (cost_per_hour / 3600)
+
+    def demand_expected(self, now: float, window: float) -> bool:
+        """Whether enough jobs are expected within `window` seconds to keep an instance up"""
+        window = window if math.isfinite(window) else self.cold_start_seconds
+        return self.expected_rate(now, window) * window >= self.prewarm_jobs
+
+    def desired_instances(self, now: float, pending: int) -> int:
+        reactive = super().desired_instances(now, pending)
+        # Jobs an instance started now could serve: after its cold start, until it idles out
+        horizon = self.cold_start_seconds + self.break_even(self.cost_per_hour)
+        if not self.demand_expected(now, horizon):
+            return reactive
+        rate = self.expected_rate(now, self.cold_start_seconds)
+        for_load = math.ceil(rate * self.job_seconds / self.target_utilization)
+        return max(reactive, for_load, 1)
+
+    def should_stop(self, now: float, idle_seconds: float, cost_per_hour: float) -> bool:
+        return idle_seconds >= self.break_even(cost_per_hour or self.cost_per_hour)
+
+    def state(self) -> Dict[str, Any]:
+        return {"rate": self.rate, "profile": self.profile}
+
+    def load_state(self, state: Dict[str, Any]):
+        self.rate = state.get("rate", 0.0)
+        self.profile = state.get("profile", self.profile)
+
+
+POLICIES = {
+    "reactive": ReactivePolicy,
+    "predictive": PredictivePolicy,
+}
+
+
+def make_policy(name: str, **kwargs) -> ScalingPolicy:
+    """Build a policy by name, passing only the options it accepts"""
+    cls = POLICIES[name]
+    accepted = inspect.signature(cls).parameters
+    return cls(**{k: v for k, v in kwargs.items() if k in accepted})
+
+
+def load_policy_state(policy: ScalingPolicy, path: str):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            policy.load_state(json.load(f))
+
+
+def save_policy_state(policy: ScalingPolicy, path: str):
+    if path:
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(policy.state(), f)
+        os.replace(tmp, path)
@@ -0,0 +1,154 @@
+"""
+Replay a job arrival trace through the scaling policies (scaling.py) and
+compare cost against queueing delay.
+
+A trace is a text file with one arrival per line: epoch seconds, an ISO 8601
+timestamp, or a JSON object with a `createdAt` field (e.g. a mongoexport of
+the jobs collection). Without a trace a synthetic diurnal one is generated.
+
+    python simulate.py --trace arrivals.txt --instances 2
+    python simulate.py --synthetic-days 5 --peak-per-hour 40
+"""
+
+import argparse
+import json
+import math
+import random
+import statistics
+from collections import deque
+from datetime import datetime
+
+import gpu_manager as gm
+from scaling import POLICIES, make_policy
+
+
+def parse_arrival(line: str) -> float:
+    line = line.strip()
+    if line.startswith("{"):
+        line = str(json.loads(line)["createdAt"])
+        if line.startswith("{"):  # {"$date": ...}
+            line = str(json.loads(line.replace("'", '"'))["$date"])
+    try:
+        return float(line)
+    except ValueError:
+        return datetime.fromisoformat(line.replace("Z", "+00:00")).timestamp()
+
+
+def load_trace(path: str) -> list:
+    with open(path) as f:
+        return sorted(parse_arrival(line) for line in f if line.strip())
+
+
+def synthetic_trace(days: int, peak_per_hour: float, seed: int) -> list:
+    """Poisson arrivals with a working-hours peak (UTC 08-20) and a quiet night"""
+    rng = random.Random(seed)
+    arrivals, t, end = [], 0.0, days * 86400.0
+    while t < end:
+        t += rng.expovariate(peak_per_hour / 3600)
+        hour = (t % 86400) / 3600
+        # Thinning: keep a peak-rate arrival with probability rate(t) / peak
+        if rng.random() < max(math.sin(math.pi * (hour - 8) / 12), 0.02):
+            arrivals.append(t)
+    return arrivals
+
+
+class SimInstance:
+    def __init__(self):
+        self.state = "stopped"
+        self.ready_at = 0.0
+        self.busy_until = 0.0
+        self.idle_since = 0.0
+
+
+def simulate(arrivals, policy, instances, cold_start, job_seconds, cost_per_hour, step=5.0):
+    pool = [SimInstance() for _ in range(instances)]
+    queue = deque()
+    waits, cold_starts, up_seconds = [], 0, 0.0
+    i, t = 0, math.floor(arrivals[0] / step) * step
+
+    while i < len(arrivals) or queue or any(inst.busy_until > t for inst in pool):
+        new = 0
+        while i < len(arrivals) and arrivals[i] <= t:
+            queue.append(arrivals[i])
+            i += 1
+            new += 1
+        policy.observe(t, new)
+
+        for inst in pool:
+            if inst.state == "booting" and t >= inst.ready_at:
+                inst.state, inst.idle_since = "ready", t
+
+        wanted = min(policy.desired_instances(t, len(queue)), instances)
+        active = [inst for inst in pool if inst.state != "stopped"]
+        for inst in [inst for inst in pool if inst.state == "stopped"][:max(wanted - len(active), 0)]:
+            inst.state, inst.ready_at = "booting", t + cold_start
+            cold_starts += 1
+
+        for inst in pool:
+            if inst.state == "ready" and inst.busy_until <= t and queue:
+                waits.append(t - queue.popleft())
+                inst.busy_until = inst.idle_since = t + job_seconds
+
+        if not queue:
+            up = [inst for inst in pool if inst.state != "stopped"]
+            surplus = len(up) - wanted
+            for inst in sorted(up, key=lambda inst: inst.idle_since):
+                if surplus <= 0:
+                    break
+                if inst.state == "ready" and inst.busy_until <= t and \
+                        policy.should_stop(t, t - inst.idle_since, cost_per_hour):
+                    inst.state = "stopped"
+                    surplus -= 1
+
+        up_seconds += step * sum(inst.state != "stopped" for inst in pool)
+        t += step
+
+    waits.sort()
+    return {
+        "jobs": len(waits),
+        "mean_wait": statistics.mean(waits),
+        "p95_wait": waits[int(0.95 * (len(waits) - 1))],
+        "cold_starts": cold_starts,
+        "gpu_hours": up_seconds / 3600,
+        "cost": up_seconds / 3600 * cost_per_hour,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace", help="arrival trace file (default: synthetic)")
+    parser.add_argument("--synthetic-days", type=int, default=3)
+    parser.add_argument("--peak-per-hour", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--instances", type=int, default=2)
+    parser.add_argument("--cold-start", type=float, default=gm.COLD_START_SECONDS)
+    parser.add_argument("--job-seconds", type=float, default=gm.JOB_SECONDS_ESTIMATE)
+    parser.add_argument("--cost-per-hour", type=float, default=gm.GPU_COST_PER_HOUR)
+    parser.add_argument("--policies", nargs="+", default=list(POLICIES), choices=list(POLICIES))
+    args = parser.parse_args()
+
+    arrivals = load_trace(args.trace) if args.trace else \
+        synthetic_trace(args.synthetic_days, args.peak_per_hour, args.seed)
+    span_hours = (arrivals[-1] - arrivals[0]) / 3600
+    print(f"{len(arrivals)} arrivals over {span_hours:.1f} h, {args.instances} instances, "
+          f"cold start {args.cold_start:.0f}s, job {args.job_seconds:.0f}s, ${args.cost_per_hour}/h\n")
+
+    print(f"{'policy':<11} {'mean wait':>10} {'p95 wait':>9} {'cold starts':>12} {'GPU hours':>10} {'cost':>8}")
+    for name in args.policies:
+        policy = make_policy(
+            name,
+            jobs_per_instance=gm.JOBS_PER_INSTANCE,
+            idle_timeout_seconds=gm.IDLE_TIMEOUT_MINUTES * 60,
+            cold_start_seconds=args.cold_start,
+            cold_start_penalty=gm.COLD_START_PENALTY,
+            job_seconds=args.job_seconds,
+            prewarm_jobs=gm.PREWARM_JOBS,
+            cost_per_hour=args.cost_per_hour,
+        )
+        r = simulate(arrivals, policy, args.instances, args.cold_start, args.job_seconds, args.cost_per_hour)
+        print(f"{name:<11} {r['mean_wait']:>9.1f}s {r['p95_wait']:>8.1f}s {r['cold_starts']:>12} "
+              f"{r['gpu_hours']:>10.1f} {'$':>3}{r['cost']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""GPUManager dispatch against FakeCluster"""
+
+import asyncio
+
+import bench_dispatch
+import gpu_manager as gm
+from fake_cluster import FakeCluster
+from ledger import DispatchLedger
+
+
+def run_cluster(cluster, check, timeout=5.0):
+    """Run the manager loop against `cluster` until check() or timeout; returns the manager"""
+    async def main():
+        await cluster.start()
+        manager, task = await bench_dispatch.start_manager(cluster, 0.2)
+        try:
+            deadline = asyncio.get_running_loop().time() + timeout
+            while not check() and asyncio.get_running_loop().time() < deadline:
+                await asyncio.sleep(0.05)
+        finally:
+            await manager.stop()
+            await cluster.stop()
+        return manager
+    return asyncio.run(main())
+
+
+def test_dispatch_recovers_after_failed_sends(monkeypatch):
+    # Regression: DISPATCH_RETRIES failed sends used to mark a worker unhealthy for good
+    monkeypatch.setattr(gm, "DISPATCH_BACKOFF_SECONDS", 0.01)
+    cluster = FakeCluster(instances=1, port=18711, job_seconds=0.01, fail_sends=gm.DISPATCH_RETRIES)
+    for i in range(3):
+        cluster.submit(f"job-{i}")
+    manager = run_cluster(cluster, lambda: len(cluster.dispatched) == 3)
+    assert len(cluster.dispatched) == 3
+    assert all(inst.failures == 0 for inst in manager.instances.values())
+
+
+def test_refresh_load_clears_failures():
+    cluster = FakeCluster(instances=1, port=18721)
+
+    async def main():
+        await cluster.start()
+        manager = gm.GPUManager(cluster.instance_ids, ledger=DispatchLedger(":memory:"))
+        inst = next(iter(manager.instances.values()))
+        inst.status = "running"
+        inst.worker_url = f"http://127.0.0.1:{cluster.port + 1}"
+        inst.failures = gm.DISPATCH_RETRIES
+        assert not inst.healthy
+        try:
+            await manager.refresh_load(inst)
+        finally:
+            await manager.stop()
+            await cluster.stop()
+        return inst
+    inst = asyncio.run(main())
+    assert inst.failures == 0
+    assert inst.healthy
+
+
+def test_stop_ends_the_loop_before_closing_the_ledger():
+    cluster = FakeCluster(instances=1, port=18731)
+
+    async def main():
+        await cluster.start()
+        manager, task = await bench_dispatch.start_manager(cluster, 0.2)
+        await asyncio.sleep(0.3)
+        try:
+            await manager.stop()
+            return task.done()
+        finally:
+            await cluster.stop()
+    assert asyncio.run(main())
@@ -0,0 +1,76 @@
+"""DispatchLedger: leases, expiry and requeue, duplicate sends"""
+
+import pytest
+
+from ledger import DispatchLedger
+
+
+@pytest.fixture
+def ledger():
+    ledger = DispatchLedger(":memory:", lease_seconds=60, max_attempts=3, retention_seconds=3600)
+    yield ledger
+    ledger.close()
+
+
+def test_claim_holds_lease_until_expiry(ledger):
+    assert ledger.claim("a", now=1000)
+    assert not ledger.claim("a", now=1030)
+    assert ledger.leased(["a", "b"], now=1030) == {"a"}
+    assert ledger.leased(["a", "b"], now=1061) == set()
+
+
+def test_expired_lease_requeues_until_out_of_attempts(ledger):
+    now = 1000
+    for _ in range(3):
+        assert ledger.claim("a", now=now)
+        ledger.confirm("a", "w1", now=now)
+        now += 61  # still pending when the lease runs out: dispatched again
+    assert not ledger.claim("a", now=now)
+    assert ledger.leased(["a"], now=now) == {"a"}
+
+
+def test_confirm_extends_lease(ledger):
+    ledger.claim("a", now=1000)
+    ledger.confirm("a", "w1", now=1050)
+    assert ledger.leased(["a"], now=1100) == {"a"}
+    assert ledger.leased(["a"], now=1111) == set()
+    assert ledger.stats() == {"dispatched": 1}
+
+
+def test_duplicate_confirm_is_one_attempt(ledger):
+    ledger.claim("a", now=1000)
+    ledger.confirm("a", "w1", now=1000)
+    ledger.confirm("a", "w1", now=1001)
+    attempts = ledger.db.execute("SELECT attempts FROM dispatches WHERE job_id = 'a'").fetchone()[0]
+    assert attempts == 1
+    assert not ledger.claim("a", now=1002)
+
+
+def test_release_does_not_use_up_an_attempt(ledger):
+    for _ in range(5):
+        assert ledger.claim("a", now=1000)
+        ledger.release("a")
+    assert ledger.stats() == {"failed": 1}
+    assert ledger.claim("a", now=1000)
+
+
+def test_prune_forgets_old_entries(ledger):
+    ledger.claim("a", now=1000)
+    ledger.claim("b", now=5000)
+    assert ledger.prune(now=5000) == 1
+    assert ledger.leased(["a", "b"], now=5000) == {"b"}
+
+
+def test_exhausted_jobs_survive_prune(ledger):
+    now = 1000
+    for _ in range(3):
+        ledger.claim("a", now=now)
+        ledger.confirm("a", "w1", now=now)
+        now += 61
+    assert ledger.leased(["a"], now=now) == {"a"}
+    assert ledger.stats() == {"exhausted": 1}
+    # Long after retention the job is still pending: it must not be sent a fourth time
+    later = now + 10 * 3600
+    assert ledger.prune(now=later) == 0
+    assert ledger.leased(["a"], now=later) == {"a"}
+    assert not ledger.claim("a", now=later)
@@ -0,0 +1,53 @@
+"""Readiness probing after a start: cold-start timeline and timeout"""
+
+import asyncio
+
+import pytest
+
+import gpu_manager as gm
+from fake_cluster import FakeCluster
+from ledger import DispatchLedger
+
+
+@pytest.fixture(autouse=True)
+def fast_probes(monkeypatch):
+    monkeypatch.setattr(gm, "PROBE_MIN_SECONDS", 0.02)
+    monkeypatch.setattr(gm, "PROBE_MAX_SECONDS", 0.1)
+
+
+def start_and_wait(cluster, timeout):
+    async def main():
+        await cluster.start()
+        manager = gm.GPUManager(cluster.instance_ids, ledger=DispatchLedger(":memory:"))
+        manager.VASTAI_API_URL = cluster.vastai_url
+        manager.api_key = "fake"
+        inst = next(iter(manager.instances.values()))
+        try:
+            assert await manager.start_instance(inst)
+            ready = await manager.wait_for_worker(inst, timeout=timeout)
+        finally:
+            await manager.stop()
+            await cluster.stop()
+        return ready, inst, manager
+    return asyncio.run(main())
+
+
+def test_timeline_follows_boot_worker_and_warm_up():
+    cluster = FakeCluster(instances=1, port=18741, running=False,
+                          boot_seconds=0.2, worker_seconds=0.2, warmup_seconds=0.2)
+    ready, inst, manager = start_and_wait(cluster, timeout=5)
+    assert ready
+    timeline = inst.timeline
+    assert timeline["running"] <= timeline["worker_up"] <= timeline["models_loaded"] <= timeline["ready"]
+    assert timeline["running"] >= 0.2 and timeline["ready"] >= 0.6
+    assert timeline["ready"] < 1.5  # probes back off, but only to PROBE_MAX_SECONDS
+    assert inst.worker_url and inst.start_requested is None
+    assert manager.cold_starts[-1]["instance"] == inst.instance_id
+
+
+def test_gives_up_while_still_warming():
+    cluster = FakeCluster(instances=1, port=18751, running=False, warmup_seconds=30)
+    ready, inst, _ = start_and_wait(cluster, timeout=0.5)
+    assert not ready
+    assert "worker_up" in inst.timeline and "ready" not in inst.timeline
+    assert inst.worker_url is None
@@ -0,0 +1,69 @@
+"""Scaling policies: break-even, pre-warm lookahead, and low-load replay"""
+
+import math
+
+import pytest
+
+import simulate
+from scaling import PredictivePolicy, ReactivePolicy
+
+HOUR = 3600
+
+
+def profiled(rates_per_hour):
+    """Predictive policy with a learned profile (jobs/hour by UTC hour) and no recent traffic"""
+    policy = PredictivePolicy()
+    policy.profile = [rates_per_hour.get(h, 0.0) / HOUR for h in range(24)]
+    return policy
+
+
+def test_break_even_is_cold_start_plus_penalty():
+    policy = PredictivePolicy(cold_start_seconds=90, cold_start_penalty=0.05)
+    assert policy.break_even(0.5) == pytest.approx(90 + 360)
+    assert policy.break_even(1.0) == pytest.approx(90 + 180)
+    assert math.isinf(policy.break_even(0))
+
+
+def test_idle_instances_stop_at_break_even():
+    policy = profiled({})
+    assert not policy.should_stop(0, idle_seconds=449, cost_per_hour=0.5)
+    assert policy.should_stop(0, idle_seconds=450, cost_per_hour=0.5)
+    # Unknown instance price (0) falls back to the configured one
+    assert policy.should_stop(0, idle_seconds=450, cost_per_hour=0)
+    assert not PredictivePolicy(cost_per_hour=0).should_stop(0, idle_seconds=10 ** 6, cost_per_hour=0)
+
+
+def test_pending_jobs_scale_like_reactive():
+    policy = profiled({})
+    assert policy.desired_instances(0, 0) == 0
+    assert policy.desired_instances(0, 11) == ReactivePolicy().desired_instances(0, 11) == 2
+
+
+def test_prewarms_one_cold_start_before_a_busy_hour():
+    # 12 jobs/h from 09:00: an instance must start by 08:52:30 to be ready and
+    # still up (cold start 90s + break-even 450s) when they come in
+    policy = profiled({9: 12})
+    assert policy.desired_instances(8 * HOUR + 45 * 60, 0) == 0
+    assert policy.desired_instances(8 * HOUR + 52 * 60, 0) == 1
+    assert policy.desired_instances(9 * HOUR + 30 * 60, 0) == 1
+    assert policy.desired_instances(10 * HOUR + 30 * 60, 0) == 0
+
+
+def test_no_prewarm_below_one_expected_job():
+    policy = profiled({h: 5 for h in range(24)})  # 0.75 jobs per cold start + break-even
+    assert policy.desired_instances(12 * HOUR, 0) == 0
+
+
+def test_expected_load_sets_instance_count():
+    assert profiled({12: 60}).desired_instances(12 * HOUR, 0) == 1
+    assert profiled({12: 120}).desired_instances(12 * HOUR, 0) == 2
+
+
+def test_low_load_replay_is_no_worse_than_reactive():
+    arrivals = simulate.synthetic_trace(days=5, peak_per_hour=5, seed=1)
+    run = lambda policy: simulate.simulate(arrivals, policy, 2, 90, 40, 0.5)
+    reactive = run(ReactivePolicy(idle_timeout_seconds=600))
+    predictive = run(PredictivePolicy())
+    assert predictive["mean_wait"] <= reactive["mean_wait"]
+    assert predictive["cold_starts"] <= reactive["cold_starts"]
+    assert predictive["cost"] <= reactive["cost"]
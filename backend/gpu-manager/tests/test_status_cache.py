@@ -0,0 +1,54 @@
+"""GPUManager instance status cache: shared fetches and invalidation"""
+
+import asyncio
+
+import httpx
+
+import gpu_manager as gm
+from ledger import DispatchLedger
+
+
+def vastai_stub(manager, get_gate=None):
+    """Serve the Vast.ai instance API from memory; GETs wait on `get_gate` if given"""
+    state = {"actual_status": "stopped"}
+
+    async def handler(request):
+        if request.method == "PUT":
+            state["actual_status"] = "running"
+            return httpx.Response(200, json={"success": True})
+        snapshot = dict(state)
+        if get_gate:
+            await get_gate.wait()
+        return httpx.Response(200, json={"instances": [{"id": 1, **snapshot}]})
+    manager.clients["vastai"] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_concurrent_callers_share_one_fetch():
+    async def main():
+        manager = gm.GPUManager(["1"], ledger=DispatchLedger(":memory:"))
+        vastai_stub(manager)
+        await asyncio.gather(*(manager.get_instance_statuses() for _ in range(5)))
+        await manager.get_instance_statuses()
+        await manager.stop()
+        return manager
+    manager = asyncio.run(main())
+    assert manager.status_fetches == 1
+    assert manager.status_hits == 1
+
+
+def test_fetch_in_flight_during_start_is_not_cached():
+    async def main():
+        gate = asyncio.Event()
+        manager = gm.GPUManager(["1"], ledger=DispatchLedger(":memory:"))
+        vastai_stub(manager, gate)
+        stale = asyncio.create_task(manager.get_instance_statuses())
+        await asyncio.sleep(0.05)  # the GET has read "stopped"
+        await manager.set_instance_state(manager.instances["1"], "running")
+        gate.set()
+        await stale
+        fresh = await manager.get_instance_statuses()
+        await manager.stop()
+        return manager, fresh
+    manager, fresh = asyncio.run(main())
+    assert fresh["1"]["status"] == "running"
+    assert manager.status_fetches == 2
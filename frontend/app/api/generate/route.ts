@@ -12,6 +12,8 @@ export const dynamic = 'force-dynamic';
 // GPU Worker configuration
 const API_SECRET = process.env.API_SECRET || "your-secret-key";
 const WEBHOOK_BASE_URL = process.env.NEXT_PUBLIC_SITE_URL || "http://localhost:3000";
+// GPU manager push endpoint (e.g. http://gpu-manager:8090/wake); optional
+const GPU_MANAGER_WAKE_URL = process.env.GPU_MANAGER_WAKE_URL || "";
 
 export async function POST(request: NextRequest) {
   try {
@@ -92,6 +94,7 @@ export async function POST(request: NextRequest) {
     const numImages = num_variations || 1;
     const variations = [];
     const savedGenerations = [];
+    let leftPending = false;
 
     // Generate each variation
     for (let i = 0; i < numImages; i++) {
@@ -155,6 +158,7 @@ export async function POST(request: NextRequest) {
 
             if (!workerResponse.ok) {
               console.warn(`Worker returned ${workerResponse.status}, job queued for later`);
+              leftPending = true;
             } else {
               // Update job status
               job.status = 'processing';
@@ -164,7 +168,10 @@ export async function POST(request: NextRequest) {
           } catch (workerError) {
             // Worker not available, job stays in queue for later processing
             console.warn("GPU worker not available, job queued:", workerError);
+            leftPending = true;
           }
+        } else {
+          leftPending = true;
         }
 
         variations.push({
@@ -188,6 +195,14 @@ export async function POST(request: NextRequest) {
       );
     }
 
+    // Wake the GPU manager instead of waiting for its next poll
+    if (leftPending && GPU_MANAGER_WAKE_URL) {
+      fetch(GPU_MANAGER_WAKE_URL, {
+        method: "POST",
+        headers: { "X-API-Secret": API_SECRET },
+      }).catch((wakeError) => console.warn("GPU manager wake failed:", wakeError));
+    }
+
     // Deduct credits (1 credit per job created)
     await user.deductCredits(variations.length);
 
@@ -9,124 +9,213 @@ export const dynamic = 'force-dynamic';
 // Secret for webhook authentication
 const API_SECRET = process.env.API_SECRET || "your-secret-key";
 
+// One job's callback: its metadata and the image (base64 or bytes) if any
+type Callback = { body: any; image: Buffer | string | null };
+
+// url delivery: images are only fetched from the worker's object store, and only up to this size
+const OBJECT_STORE_BASE_URL = process.env.OBJECT_STORE_BASE_URL || "";
+const MAX_CALLBACK_IMAGE_BYTES = parseInt(process.env.MAX_CALLBACK_IMAGE_BYTES || "26214400", 10);
+
+async function fetchImage(url: string): Promise<Buffer> {
+  if (!OBJECT_STORE_BASE_URL || new URL(url).origin !== new URL(OBJECT_STORE_BASE_URL).origin) {
+    throw new Error(`Refusing to fetch ${url}: not on OBJECT_STORE_BASE_URL`);
+  }
+  const response = await fetch(url, { redirect: "error" });
+  if (!response.ok || !response.body) {
+    throw new Error(`Fetching ${url} failed: ${response.status}`);
+  }
+  if (Number(response.headers.get("content-length") || 0) > MAX_CALLBACK_IMAGE_BYTES) {
+    throw new Error(`Image at ${url} exceeds ${MAX_CALLBACK_IMAGE_BYTES} bytes`);
+  }
+
+  // Content-Length may be absent or wrong, so count while reading
+  const chunks: Buffer[] = [];
+  let size = 0;
+  const reader = response.body.getReader();
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    size += value.byteLength;
+    if (size > MAX_CALLBACK_IMAGE_BYTES) {
+      await reader.cancel();
+      throw new Error(`Image at ${url} exceeds ${MAX_CALLBACK_IMAGE_BYTES} bytes`);
+    }
+    chunks.push(Buffer.from(value));
+  }
+  return Buffer.concat(chunks);
+}
+
 /**
- * POST /api/webhook/comfyui
- * Called by GPU worker when generation completes
+ * Read a worker callback in any DELIVERY_MODE: JSON with image_base64 (json)
+ * or image_url (url), multipart with a metadata part and image parts
+ * (multipart), or the raw image with its metadata in X-Job-Metadata (raw).
+ * A batched callback (`{"batch": [...]}`) yields one entry per job.
  */
-export async function POST(request: NextRequest) {
-  try {
-    console.log("📥 Webhook received!");
-    
-    // Verify webhook secret
-    const secret = request.headers.get("X-API-Secret");
-    console.log("🔐 Secret check:", secret ? "provided" : "missing", "Expected:", API_SECRET.substring(0, 5) + "...");
-    
-    if (secret !== API_SECRET) {
-      console.warn("❌ Webhook called with invalid secret:", secret?.substring(0, 10));
-      return NextResponse.json(
-        { error: "Unauthorized" },
-        { status: 401 }
-      );
-    }
+async function readCallbacks(request: NextRequest): Promise<Callback[]> {
+  const contentType = request.headers.get("content-type") || "";
+
+  if (contentType.startsWith("multipart/form-data")) {
+    const form = await request.formData();
+    const body = JSON.parse(String(form.get("metadata") || "{}"));
+    const file = form.get("image");
+    return [{ body, image: file instanceof Blob ? Buffer.from(await file.arrayBuffer()) : null }];
+  }
 
-    const body = await request.json();
-    const { job_id, success, image_base64, execution_time, error, is_upscale } = body;
-    console.log("📦 Webhook body:", { job_id, success, hasImage: !!image_base64, execution_time, error, is_upscale });
+  if (contentType.startsWith("image/")) {
+    const body = JSON.parse(request.headers.get("X-Job-Metadata") || "{}");
+    return [{ body, image: Buffer.from(await request.arrayBuffer()) }];
+  }
 
-    if (!job_id) {
-      return NextResponse.json(
-        { error: "job_id is required" },
-        { status: 400 }
-      );
+  const json = await request.json();
+  const bodies: any[] = Array.isArray(json.batch) ? json.batch : [json];
+  return Promise.all(bodies.map(async (body): Promise<Callback> => {
+    if (body.image_url && !body.image_base64) {
+      return { body, image: await fetchImage(body.image_url) };
     }
+    return { body, image: body.image_base64 || null };
+  }));
+}
 
-    await connectDB();
+/**
+ * Store the result of one job (or mark it failed)
+ */
+async function handleCallback({ body, image }: Callback): Promise<NextResponse> {
+  const { job_id, success, execution_time, error, is_upscale, image_index } = body;
+  console.log("📦 Webhook body:", { job_id, success, hasImage: !!image, execution_time, error, is_upscale });
 
-    // Find the job
-    const job = await Job.findById(job_id);
-    if (!job) {
-      console.error(`Job not found: ${job_id}`);
-      return NextResponse.json(
-        { error: "Job not found" },
-        { status: 404 }
-      );
-    }
+  if (!job_id) {
+    return NextResponse.json(
+      { error: "job_id is required" },
+      { status: 400 }
+    );
+  }
 
-    // Find the associated generation
-    const generation = await Generation.findOne({ jobId: job._id });
-    if (!generation) {
-      console.error(`Generation not found for job: ${job_id}`);
-      return NextResponse.json(
-        { error: "Generation not found" },
-        { status: 404 }
-      );
-    }
+  // Raw delivery posts every variant separately; only the first is stored, as with images_base64
+  if (image_index > 0) {
+    return NextResponse.json({ success: true, message: "Extra variant ignored" });
+  }
 
-    if (success && image_base64) {
-      // Upload image to GridFS
-      const imagePrefix = is_upscale ? 'upscaled_' : 'generation_';
-      const imageId = await uploadImage(
-        image_base64,
-        `${imagePrefix}${generation._id}.png`,
-        {
-          userId: generation.userId,
-          generationId: generation._id,
-          jobId: job._id,
-          isUpscale: is_upscale || false,
-        }
-      );
+  await connectDB();
 
-      if (is_upscale) {
-        // Upscale callback - update upscaled image
-        generation.upscaledImageId = imageId;
-        generation.upscaleStatus = 'completed';
-        await generation.save();
-        
-        console.log(`🔍 Upscale ${generation._id} completed`);
-      } else {
-        // Normal generation callback
-        job.status = 'completed';
-        job.output = {
-          imageId: imageId,
-        };
-        job.execution = {
-          ...job.execution,
-          completedAt: new Date(),
-          executionTime: execution_time,
-        };
-        await job.save();
-
-        // Update generation
-        generation.status = 'completed';
-        generation.generatedImageId = imageId;
-        generation.generationTime = execution_time;
-        await generation.save();
-
-        console.log(`✅ Generation ${generation._id} completed in ${execution_time}s`);
+  // Find the job
+  const job = await Job.findById(job_id);
+  if (!job) {
+    console.error(`Job not found: ${job_id}`);
+    return NextResponse.json(
+      { error: "Job not found" },
+      { status: 404 }
+    );
+  }
+
+  // Find the associated generation
+  const generation = await Generation.findOne({ jobId: job._id });
+  if (!generation) {
+    console.error(`Generation not found for job: ${job_id}`);
+    return NextResponse.json(
+      { error: "Generation not found" },
+      { status: 404 }
+    );
+  }
+
+  if (success && image) {
+    // Upload image to GridFS
+    const imagePrefix = is_upscale ? 'upscaled_' : 'generation_';
+    const imageId = await uploadImage(
+      image,
+      `${imagePrefix}${generation._id}.png`,
+      {
+        userId: generation.userId,
+        generationId: generation._id,
+        jobId: job._id,
+        isUpscale: is_upscale || false,
       }
+    );
 
+    if (is_upscale) {
+      // Upscale callback - update upscaled image
+      generation.upscaledImageId = imageId;
+      generation.upscaleStatus = 'completed';
+      await generation.save();
+      
+      console.log(`🔍 Upscale ${generation._id} completed`);
     } else {
-      // Mark as failed
-      job.status = 'failed';
-      job.error = {
-        message: error || 'Unknown error',
+      // Normal generation callback
+      job.status = 'completed';
+      job.output = {
+        imageId: imageId,
       };
       job.execution = {
         ...job.execution,
         completedAt: new Date(),
+        executionTime: execution_time,
       };
       await job.save();
 
-      generation.status = 'failed';
+      // Update generation
+      generation.status = 'completed';
+      generation.generatedImageId = imageId;
+      generation.generationTime = execution_time;
       await generation.save();
 
-      console.error(`❌ Generation ${generation._id} failed: ${error}`);
+      console.log(`✅ Generation ${generation._id} completed in ${execution_time}s`);
     }
 
-    return NextResponse.json({
-      success: true,
-      message: "Webhook processed",
-    });
+  } else {
+    // Mark as failed
+    job.status = 'failed';
+    job.error = {
+      message: error || 'Unknown error',
+    };
+    job.execution = {
+      ...job.execution,
+      completedAt: new Date(),
+    };
+    await job.save();
+
+    generation.status = 'failed';
+    await generation.save();
+
+    console.error(`❌ Generation ${generation._id} failed: ${error}`);
+  }
+
+  return NextResponse.json({
+    success: true,
+    message: "Webhook processed",
+  });
+}
+
+/**
+ * POST /api/webhook/comfyui
+ * Called by GPU worker when generation completes
+ */
+export async function POST(request: NextRequest) {
+  try {
+    console.log("📥 Webhook received!");
+    
+    // Verify webhook secret
+    const secret = request.headers.get("X-API-Secret");
+    console.log("🔐 Secret check:", secret ? "provided" : "missing", "Expected:", API_SECRET.substring(0, 5) + "...");
+    
+    if (secret !== API_SECRET) {
+      console.warn("❌ Webhook called with invalid secret:", secret?.substring(0, 10));
+      return NextResponse.json(
+        { error: "Unauthorized" },
+        { status: 401 }
+      );
+    }
+
+    const callbacks = await readCallbacks(request);
+    if (callbacks.length === 1) {
+      return await handleCallback(callbacks[0]);
+    }
+
+    // Batched callbacks: handle each job, report per-job status
+    const results = [];
+    for (const callback of callbacks) {
+      const response = await handleCallback(callback);
+      results.push({ job_id: callback.body.job_id, status: response.status });
+    }
+    return NextResponse.json({ success: true, results });
 
   } catch (error) {
     console.error("Webhook error:", error);